@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+"""Times the brain's hot paths on synthetic rosters and prints JSON.
+
+    ./bench/bench_brain.py --sizes 10 100 1000 --output results.json
+
+Each result has the operation, the rules mode, the roster size, the
+database kind and latency percentiles in microseconds, so two runs can
+be diffed to catch regressions.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from twisted.internet import task
+
+import brain
+import settings
+
+MODES = {
+    'highlander': {'mode': 'highlander'},
+    'sixes': {'mode': 'sixes'},
+    'ultiduo': {'mode': 'custom', 'class limits': {'soldier': 1, 'medic': 1}},
+}
+
+class NullDispatcher(object):
+    def queue_message(self, message, channel=None, priority=None):
+        pass
+
+# Servers for pick_games to spread games over; they're never probed, so
+# all of them count as free.
+GAME_SERVERS = 8
+
+def make_settings(mode, database):
+    return settings.validate_settings(settings._deep_merge(settings.DEFAULT_BASE_SETTINGS, {
+        'rules': dict(MODES[mode], **{'max games': GAME_SERVERS}),
+        'servers': dict(
+            ('bench%d' % i, {'server': '127.0.0.1', 'port': 27015 + i}) for i in xrange(GAME_SERVERS)
+        ),
+        'database': {'name': database},
+        'network': {'channel': '#bench'},
+    }))
+
+def make_brain(mode, size, database, rng):
+    my_brain = brain.SqliteBotBrain(make_settings(mode, database), clock=task.Clock(), threaded=False)
+    my_brain.dispatcher = NullDispatcher()
+    my_brain.random.seed(rng.random())
+    classes = my_brain.rules.valid_classes
+    for i in xrange(size):
+        my_brain.player_set_added_classes('player%d' % i, rng.sample(classes, rng.randint(1, min(3, len(classes)))))
+    my_brain.flush()
+    return my_brain
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction*len(ordered)))]
+
+def time_operation(operation, iterations, time_limit):
+    """Runs operation up to iterations times (at least once), stopping
+    early after time_limit seconds, and returns the timings."""
+    timer = timeit.default_timer
+    timings = []
+    deadline = timer() + time_limit
+    while len(timings) < iterations and (not timings or timer() < deadline):
+        start = timer()
+        operation()
+        timings.append(timer() - start)
+    return timings
+
+def summarize(timings):
+    ordered = sorted(t*1e6 for t in timings)
+    return {
+        'iterations': len(ordered),
+        'min': ordered[0],
+        'p50': percentile(ordered, 0.50),
+        'p90': percentile(ordered, 0.90),
+        'p99': percentile(ordered, 0.99),
+        'max': ordered[-1],
+        'mean': sum(ordered)/len(ordered),
+    }
+
+def operations(my_brain, size, rng):
+    classes = my_brain.rules.valid_classes
+
+    def readd():
+        my_brain.player_set_added_classes('player%d' % rng.randrange(size), rng.sample(classes, 1))
+
+    def readd_and_flush():
+        readd()
+        my_brain.flush()
+
+    def record_pick():
+        picked = rng.sample(xrange(size), min(size, 2*len(classes)))
+        my_brain.record_pick({
+            'red': dict(('player%d' % i, cls) for i, cls in zip(picked[::2], classes)),
+            'blu': dict(('player%d' % i, cls) for i, cls in zip(picked[1::2], classes)),
+        })
+
+    def player_stats():
+        my_brain.player_stats('player%d' % rng.randrange(size))
+
+    return [
+        ('random_pick', my_brain.random_pick),
+        ('pick_games', my_brain.pick_games),
+        ('can_pick', my_brain.can_pick),
+        ('classes_needed', my_brain.classes_needed),
+        ('classes_by_player', my_brain.classes_by_player),
+        ('players_by_class', my_brain.players_by_class),
+        ('player_set_added_classes', readd),
+        ('player_set_added_classes+flush', readd_and_flush),
+        ('record_pick', record_pick),
+        ('player_stats', player_stats),
+        ('top_players', my_brain.top_players),
+    ]
+
+def run(sizes, modes, databases, iterations, time_limit, seed):
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='mix-bot-bench-')
+    try:
+        for mode in modes:
+            for size in sizes:
+                for database in databases:
+                    rng = random.Random(seed)
+                    name = ':memory:' if database == 'memory' else os.path.join(tmpdir, '%s-%d.sqlite' % (mode, size))
+                    my_brain = make_brain(mode, size, name, rng)
+                    for op_name, operation in operations(my_brain, size, rng):
+                        result = {
+                            'operation': op_name,
+                            'mode': mode,
+                            'size': size,
+                            'database': database,
+                        }
+                        try:
+                            result.update(summarize(time_operation(operation, iterations, time_limit)))
+                        except brain.PickingError as e:
+                            result['skipped'] = str(e)
+                        results.append(result)
+                        print >>sys.stderr, '%(mode)s/%(size)s/%(database)s %(operation)s' % result, \
+                            result.get('p50', result.get('skipped'))
+                    my_brain._conn.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=sorted(MODES))
+    parser.add_argument('--databases', nargs='+', choices=['memory', 'disk'], default=['memory', 'disk'])
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='most times to run each operation')
+    parser.add_argument('--time-limit', type=float, default=2.0,
+                        help='most seconds to spend on each operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.modes, args.databases, args.iterations, args.time_limit, args.seed)
+    output = json.dumps({'seed': args.seed, 'results': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
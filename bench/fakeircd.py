@@ -0,0 +1,290 @@
+"""A small stand-in IRC server for exercising the bot locally.
+
+It knows just enough of the protocol for the bot (registration, nick
+changes, JOIN/PART/NAMES, PRIVMSG/NOTICE and PING) and applies flood
+control the way RFC 1459 section 8.10 describes: every line a client
+sends costs it `penalty` seconds, lines are held back while the client
+is more than `window` seconds ahead of the clock, and a client with more
+than `max backlog` lines held back is disconnected for excess flood.
+Connections that come less than `throttle` seconds after the last one
+are turned away, like ircd connect throttling, and counted in
+`throttled`. `kill` and `freeze` simulate a netsplit and a hung link.
+
+Simulated users live inside the server (see `add_user` and `say`), so
+hundreds of them cost no connections. Anything interested in traffic
+can append callbacks to `observers`; they are called with the time,
+the sender's nick, a list of targets and the text of every PRIVMSG.
+"""
+
+import collections
+
+from twisted.internet import protocol, reactor
+from twisted.protocols import basic
+from twisted.words.protocols import irc
+
+SERVER_NAME = 'fakeircd.local'
+
+class FakeIRCClientConnection(basic.LineReceiver):
+    delimiter = '\n'
+    MAX_LENGTH = 512
+
+    def __init__(self, server):
+        self.server = server
+        self.nickname = None
+        self.username = None
+        self.registered = False
+        self.backlog = collections.deque()
+        self.penalty_time = 0
+        self.frozen = False
+        self._delayed = None
+
+    def connectionMade(self):
+        if not self.server.accept():
+            self.sendLine('ERROR :Trying to reconnect too fast\r')
+            self.transport.loseConnection()
+
+    @property
+    def prefix(self):
+        return '%s!%s@localhost' % (self.nickname, self.username or self.nickname)
+
+    def send(self, prefix, command, *params):
+        line = ':%s %s' % (prefix, command)
+        if params:
+            middle, trailing = params[:-1], params[-1]
+            line = ' '.join((line,) + middle) + ' :' + trailing
+        self.sendLine(line.replace('\n', '') + '\r')
+
+    def numeric(self, code, *params):
+        self.send(SERVER_NAME, code, self.nickname or '*', *params)
+
+    def lineReceived(self, line):
+        if self.frozen:
+            return
+        self.backlog.append(line.rstrip('\r'))
+        if len(self.backlog) > self.server.max_backlog:
+            self.backlog.clear()
+            self.server.disconnect(self, 'Excess Flood')
+            return
+        self._process()
+
+    def lineLengthExceeded(self, line):
+        self.server.disconnect(self, 'Line too long')
+
+    def _process(self):
+        self._delayed = None
+        now = self.server.clock.seconds()
+        while self.backlog:
+            ahead = self.penalty_time - now
+            if ahead > self.server.window:
+                if self._delayed is None:
+                    self._delayed = self.server.clock.callLater(ahead - self.server.window, self._process)
+                return
+            self.penalty_time = max(self.penalty_time, now) + self.server.penalty
+            self.handle(self.backlog.popleft())
+
+    def handle(self, line):
+        if not line:
+            return
+        prefix, command, params = irc.parsemsg(line)
+        handler = getattr(self, 'irc_%s' % command.upper(), None)
+        if handler is not None:
+            handler(params)
+
+    def irc_NICK(self, params):
+        nick = params[0]
+        if self.server.nick_in_use(nick):
+            self.numeric('433', nick, 'Nickname is already in use')
+            return
+        if self.registered:
+            self.server.rename(self, nick)
+        else:
+            self.nickname = nick
+            self._maybe_register()
+
+    def irc_USER(self, params):
+        self.username = params[0]
+        self._maybe_register()
+
+    def _maybe_register(self):
+        if self.registered or not (self.nickname and self.username):
+            return
+        self.registered = True
+        self.server.clients[self.nickname] = self
+        self.numeric('001', 'Welcome to the fake IRC network %s' % self.prefix)
+        self.numeric('005', 'TARGMAX=PRIVMSG:%i,NOTICE:%i' % (self.server.max_targets, self.server.max_targets),
+                     'are supported by this server')
+        self.numeric('376', 'End of /MOTD command.')
+
+    def irc_PING(self, params):
+        self.send(SERVER_NAME, 'PONG', SERVER_NAME, params[0] if params else '')
+
+    def irc_JOIN(self, params):
+        for channel in params[0].split(','):
+            self.server.join(self.nickname, channel)
+
+    def irc_PART(self, params):
+        for channel in params[0].split(','):
+            self.server.part(self.nickname, channel, params[1] if len(params) > 1 else '')
+
+    def irc_NAMES(self, params):
+        self.server.send_names(self, params[0])
+
+    def irc_PRIVMSG(self, params, command='PRIVMSG'):
+        if len(params) < 2 or not self.registered:
+            return
+        targets = params[0].split(',')
+        if len(targets) > self.server.max_targets:
+            self.numeric('407', params[0], 'Too many recipients')
+            return
+        self.server.privmsg(self.nickname, targets, params[1], command)
+
+    def irc_NOTICE(self, params):
+        self.irc_PRIVMSG(params, command='NOTICE')
+
+    def irc_QUIT(self, params):
+        self.server.disconnect(self, params[0] if params else 'Quit')
+
+    def connectionLost(self, reason):
+        if self.registered:
+            self.server.disconnect(self, 'Connection closed')
+
+class FakeIRCServer(protocol.ServerFactory):
+    def __init__(self, penalty=2.0, window=10.0, max_backlog=30, max_targets=4, throttle=0, clock=None):
+        self.penalty = penalty
+        self.window = window
+        self.max_backlog = max_backlog
+        self.max_targets = max_targets
+        self.throttle = throttle
+        self.throttled = 0
+        self.clock = reactor if clock is None else clock
+        self._last_connection = None
+        self.clients = {}
+        self.users = set()
+        self.channels = {}
+        self.observers = []
+
+    def buildProtocol(self, addr):
+        return FakeIRCClientConnection(self)
+
+    def accept(self):
+        now = self.clock.seconds()
+        if self._last_connection is not None and now - self._last_connection < self.throttle:
+            self.throttled += 1
+            return False
+        self._last_connection = now
+        return True
+
+    def kill(self, nick, reason='Killed'):
+        """Disconnects the client using nick."""
+        if nick in self.clients:
+            self.disconnect(self.clients[nick], reason)
+
+    def freeze(self, nick):
+        """Stops answering the client using nick, without disconnecting it."""
+        if nick in self.clients:
+            self.clients[nick].frozen = True
+
+    def nick_in_use(self, nick):
+        lowered = nick.lower()
+        return any(n.lower() == lowered for n in self.clients) or \
+            any(n.lower() == lowered for n in self.users)
+
+    def _prefix(self, nick):
+        if nick in self.clients:
+            return self.clients[nick].prefix
+        return '%s!%s@simulated' % (nick, nick)
+
+    def _broadcast(self, channel, prefix, command, *params, **kwargs):
+        skip = kwargs.get('skip')
+        for nick in self.channels.get(channel, ()):
+            client = self.clients.get(nick)
+            if client is not None and nick != skip:
+                client.send(prefix, command, *params)
+
+    def join(self, nick, channel):
+        members = self.channels.setdefault(channel, set())
+        if nick in members:
+            return
+        members.add(nick)
+        self._broadcast(channel, self._prefix(nick), 'JOIN', channel)
+        if nick in self.clients:
+            self.send_names(self.clients[nick], channel)
+
+    def part(self, nick, channel, reason=''):
+        if nick in self.channels.get(channel, ()):
+            self._broadcast(channel, self._prefix(nick), 'PART', channel, reason)
+            self.channels[channel].discard(nick)
+
+    def send_names(self, client, channel):
+        names = sorted(self.channels.get(channel, ()))
+        for i in xrange(0, len(names), 40):
+            client.numeric('353', '=', channel, ' '.join(names[i:i+40]))
+        client.numeric('366', channel, 'End of /NAMES list.')
+
+    def rename(self, client, nick):
+        old = client.nickname
+        prefix = client.prefix
+        del self.clients[old]
+        client.nickname = nick
+        self.clients[nick] = client
+        told = set([nick])
+        client.send(prefix, 'NICK', nick)
+        for members in self.channels.values():
+            if old in members:
+                members.discard(old)
+                members.add(nick)
+                for member in members:
+                    if member in self.clients and member not in told:
+                        told.add(member)
+                        self.clients[member].send(prefix, 'NICK', nick)
+
+    def disconnect(self, client, reason):
+        nick = client.nickname
+        if self.clients.get(nick) is not client:
+            return
+        del self.clients[nick]
+        for channel, members in self.channels.items():
+            if nick in members:
+                members.discard(nick)
+                self._broadcast(channel, client.prefix, 'QUIT', reason)
+        client.sendLine('ERROR :Closing link (%s)\r' % reason)
+        client.transport.loseConnection()
+
+    def privmsg(self, nick, targets, text, command='PRIVMSG'):
+        now = self.clock.seconds()
+        for observer in self.observers:
+            observer(now, nick, targets, text)
+        prefix = self._prefix(nick)
+        for target in targets:
+            if target in self.channels:
+                self._broadcast(target, prefix, command, target, text, skip=nick)
+            elif target in self.clients:
+                self.clients[target].send(prefix, command, target, text)
+
+    # Simulated users
+    def add_user(self, nick, channel):
+        self.users.add(nick)
+        self.join(nick, channel)
+
+    def remove_user(self, nick, reason='Quit'):
+        self.users.discard(nick)
+        for channel, members in self.channels.items():
+            if nick in members:
+                members.discard(nick)
+                self._broadcast(channel, self._prefix(nick), 'QUIT', reason)
+
+    def rename_user(self, nick, new_nick):
+        self.users.discard(nick)
+        self.users.add(new_nick)
+        told = set()
+        for members in self.channels.values():
+            if nick in members:
+                members.discard(nick)
+                members.add(new_nick)
+                for member in members:
+                    if member in self.clients and member not in told:
+                        told.add(member)
+                        self.clients[member].send(self._prefix(nick), 'NICK', new_nick)
+
+    def say(self, nick, target, text):
+        self.privmsg(nick, [target], text)
@@ -0,0 +1,84 @@
+"""A stand-in Source RCON server for exercising the bot locally.
+
+It authenticates with `password`, records every command it is sent in
+`commands`, answers each with `responses.get(command, '')` (split over
+several packets if it's long, like a real server), and mirrors empty
+SERVERDATA_RESPONSE_VALUE packets followed by the extra packet real
+servers send after them. Set `delay` to answer commands late. A command
+in `hang` makes its connection stop answering anything, like a server
+stuck on it. `connections` has the connections open right now.
+"""
+
+import struct
+
+from twisted.internet import protocol, reactor
+from twisted.protocols import basic
+
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+PACKET_BODY = 4096
+
+def pack(request_id, packet_type, body):
+    return struct.pack('<ii', request_id, packet_type) + body + '\x00\x00'
+
+class FakeRCONConnection(basic.IntNStringReceiver):
+    structFormat = '<i'
+    prefixLength = struct.calcsize(structFormat)
+
+    def __init__(self, server):
+        self.server = server
+        self.authenticated = False
+        self.hung = False
+
+    def connectionMade(self):
+        self.server.connections.add(self)
+
+    def connectionLost(self, reason):
+        self.server.connections.discard(self)
+
+    def reply(self, request_id, packet_type, body):
+        if self.connected:
+            self.sendString(pack(request_id, packet_type, body))
+
+    def stringReceived(self, packet):
+        request_id, packet_type = struct.unpack_from('<ii', packet)
+        body = packet[8:-2]
+
+        if self.hung:
+            if packet_type == SERVERDATA_EXECCOMMAND:
+                self.server.commands.append(body)
+        elif packet_type == SERVERDATA_AUTH:
+            self.authenticated = body == self.server.password
+            self.reply(request_id, SERVERDATA_RESPONSE_VALUE, '')
+            self.reply(request_id if self.authenticated else -1, SERVERDATA_AUTH_RESPONSE, '')
+        elif not self.authenticated:
+            self.transport.loseConnection()
+        elif packet_type == SERVERDATA_EXECCOMMAND:
+            self.server.commands.append(body)
+            if body in self.server.hang:
+                self.hung = True
+                return
+            response = self.server.responses.get(body, '')
+            parts = [response[i:i + PACKET_BODY] for i in xrange(0, len(response), PACKET_BODY)] or ['']
+            for part in parts:
+                self.server.clock.callLater(self.server.delay, self.reply, request_id, SERVERDATA_RESPONSE_VALUE, part)
+        elif packet_type == SERVERDATA_RESPONSE_VALUE:
+            self.server.clock.callLater(self.server.delay, self.reply, request_id, SERVERDATA_RESPONSE_VALUE, '')
+            self.server.clock.callLater(self.server.delay, self.reply, request_id, SERVERDATA_RESPONSE_VALUE,
+                                        '\x00\x01\x00\x00')
+
+class FakeRCONServer(protocol.ServerFactory):
+    def __init__(self, password, clock=None):
+        self.password = password
+        self.clock = reactor if clock is None else clock
+        self.commands = []
+        self.responses = {}
+        self.delay = 0
+        self.hang = set()
+        self.connections = set()
+
+    def buildProtocol(self, addr):
+        return FakeRCONConnection(self)
@@ -0,0 +1,43 @@
+"""A stand-in Source dedicated server for exercising the bot locally.
+
+It answers A2S_INFO queries over UDP, optionally asking for a challenge
+first the way current servers do, and can be told to stay quiet to
+look like a server that's down. Change `players` to simulate people
+joining and leaving.
+"""
+
+import struct
+
+from twisted.internet import protocol
+
+A2S_HEADER = '\xff\xff\xff\xff'
+A2S_INFO = A2S_HEADER + 'TSource Engine Query\x00'
+
+class FakeSourceServer(protocol.DatagramProtocol):
+    def __init__(self, name='Fake Server', map_name='cp_badlands', players=0, max_players=24,
+                 bots=0, challenge=False):
+        self.name = name
+        self.map_name = map_name
+        self.players = players
+        self.max_players = max_players
+        self.bots = bots
+        self.challenge = challenge
+        self.silent = False
+        self.queries = 0
+
+    def info(self):
+        return ''.join([
+            A2S_HEADER, 'I', chr(17),
+            self.name, '\x00', self.map_name, '\x00', 'tf\x00', 'Team Fortress\x00',
+            struct.pack('<HBBB', 440, self.players, self.max_players, self.bots),
+            'dlwv\x00\x00', # server type, environment, visibility, VAC, version
+        ])
+
+    def datagramReceived(self, data, address):
+        if self.silent or not data.startswith(A2S_INFO):
+            return
+        self.queries += 1
+        if self.challenge and data[len(A2S_INFO):] != 'CHAL':
+            self.transport.write(A2S_HEADER + 'ACHAL', address)
+            return
+        self.transport.write(self.info(), address)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+"""Runs the bot against a local fake IRC server under simulated load.
+
+    ./bench/irc_load.py --users 300 --rate 5 --duration 60 --bots 4
+
+Simulated users in the server issue !add, !remove, !list, !need and
+!pick at the given total rate. The report (JSON) has latency
+percentiles per command, from the server receiving a command to it
+relaying the bot's reply, the outbound queue depth and connected bots over time, and how
+long every player took to get their info after each pick. Each game
+server is a local stand-in answering status queries and RCON.
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from twisted.internet import reactor, task
+
+import commands
+import network
+import settings
+
+from bench_brain import percentile
+from fakeircd import FakeIRCServer
+from fakercon import FakeRCONServer
+from fakesrcds import FakeSourceServer
+from replies import ReplyTimer
+
+CHANNEL = '#load'
+
+COMMAND_WEIGHTS = [
+    ('add', 40),
+    ('remove', 10),
+    ('list', 20),
+    ('need', 20),
+    ('can-pick?', 8),
+    ('pick', 2),
+]
+
+def start_game_servers(count):
+    """Returns {'name': settings} for count local stand-in game servers,
+    and the stand-ins' RCON sides."""
+    servers, rcon_servers = {}, []
+    for i in xrange(1, count + 1):
+        query_port = reactor.listenUDP(0, FakeSourceServer(), interface='127.0.0.1').getHost().port
+        rcon_server = FakeRCONServer('load')
+        rcon_port = reactor.listenTCP(0, rcon_server, interface='127.0.0.1').getHost().port
+        rcon_servers.append(rcon_server)
+        servers['Load Server %d' % i] = {
+            'server': '127.0.0.1',
+            'port': 27015,
+            'query port': query_port,
+            'rcon port': rcon_port,
+            'rcon password': 'load',
+        }
+    return servers, rcon_servers
+
+def make_settings(args, port, database, servers):
+    return settings.validate_settings(settings._deep_merge(settings.DEFAULT_BASE_SETTINGS, {
+        'network': {
+            'server': '127.0.0.1',
+            'port': port,
+            'channel': CHANNEL,
+            'reconnect time': args.connect_interval,
+            'messages per minute': args.messages_per_minute,
+            'bot names': ['LoadBot%d' % i for i in xrange(1, args.bots + 1)],
+            'min bots': args.min_bots,
+            'capture file': args.capture,
+        },
+        'servers': servers,
+        # Nobody really joins the stand-in servers
+        'server pool': {'hold time': args.hold_time},
+        'rules': {'mode': args.mode, 'max games': args.max_games},
+        'database': {'name': database},
+    }))
+
+class LoadTest(object):
+    def __init__(self, args, server, factory, rcon_servers):
+        self.args = args
+        self.server = server
+        self.rcon_servers = rcon_servers
+        self.factory = factory
+        self.rng = random.Random(args.seed)
+        self.users = ['user%d' % i for i in xrange(args.users)]
+        self.bots = set(factory.settings['network']['bot names'])
+        self.classes = factory.settings['rules'].valid_classes
+
+        self.said = collections.defaultdict(collections.deque)
+        self.issued = collections.Counter()
+        self.queue_depth = []
+        self.picks = []
+
+        server.observers.append(self.observe)
+        self.timer = ReplyTimer(factory, reactor, said_at=self.said_at)
+        self._instrument()
+
+    def now(self):
+        return reactor.seconds() - self.started
+
+    def said_at(self, nick, message):
+        """When the server got nick's command, so latencies include the
+        time it spent reaching the bot."""
+        said = self.said[(nick, message)]
+        return said.popleft() if said else reactor.seconds()
+
+    def _instrument(self):
+        my_brain = self.factory.bots[0].brain
+        record_pick = my_brain.record_pick
+
+        def instrumented_record_pick(teams):
+            players = set()
+            for team in teams.values():
+                players.update(team)
+            command = self.timer.current()
+            started = command['at'] if command is not None else reactor.seconds()
+            self.picks.append({'started': started, 'waiting': players, 'players': len(players)})
+            return record_pick(teams)
+
+        my_brain.record_pick = instrumented_record_pick
+
+    def observe(self, when, nick, targets, text):
+        if nick not in self.bots:
+            if text.startswith('!'):
+                self.said[(nick, text)].append(when)
+            return
+
+        self.timer.sent(','.join(targets), text, when)
+        for pick in self.picks:
+            if pick['waiting'] and pick['waiting'].intersection(targets):
+                pick['waiting'].difference_update(targets)
+                if not pick['waiting']:
+                    pick['seconds'] = when - pick['started']
+
+    def start(self):
+        for user in self.users:
+            self.server.add_user(user, CHANNEL)
+        self.started = reactor.seconds()
+        self._sampler = task.LoopingCall(self.sample_queue)
+        self._sampler.start(self.args.sample_interval)
+        self._load = task.LoopingCall(self.issue_command)
+        self._load.start(1.0/self.args.rate)
+        reactor.callLater(self.args.duration, self.stop_load)
+
+    def issue_command(self):
+        user = self.rng.choice(self.users)
+        total = sum(weight for _, weight in COMMAND_WEIGHTS)
+        r = self.rng.uniform(0, total)
+        for command, weight in COMMAND_WEIGHTS:
+            r -= weight
+            if r <= 0:
+                break
+        line = '!' + command
+        if command == 'add':
+            line += ' ' + ' '.join(self.rng.sample(self.classes, self.rng.randint(1, 3)))
+        self.issued[command] += 1
+        self.server.say(user, CHANNEL, line)
+
+    def sample_queue(self):
+        self.queue_depth.append([round(self.now(), 3), len(self.factory.outbound), len(self.factory.transports)])
+
+    def stop_load(self):
+        self._load.stop()
+        self._drain_deadline = reactor.seconds() + self.args.drain_timeout
+        self.wait_for_drain()
+
+    def wait_for_drain(self):
+        waiting = any(pick['waiting'] for pick in self.picks)
+        if (len(self.factory.outbound) or waiting) and reactor.seconds() < self._drain_deadline:
+            reactor.callLater(0.5, self.wait_for_drain)
+            return
+        self._sampler.stop()
+        reactor.stop()
+
+    def report(self):
+        latencies = {}
+        for command, issued in sorted(self.issued.items()):
+            timings = sorted(t*1000 for t in self.timer.reply_times.get(command, ()))
+            latencies[command] = {'issued': issued, 'answered': len(timings)}
+            if timings:
+                latencies[command].update({
+                    'p50_ms': percentile(timings, 0.50),
+                    'p90_ms': percentile(timings, 0.90),
+                    'p99_ms': percentile(timings, 0.99),
+                    'max_ms': timings[-1],
+                })
+        return {
+            'options': vars(self.args),
+            'commands': latencies,
+            'queue_depth': self.queue_depth,
+            'picks': [
+                {
+                    'players': pick['players'],
+                    'notified': pick['players'] - len(pick['waiting']),
+                    'seconds_until_all_notified': pick.get('seconds'),
+                }
+                for pick in self.picks
+            ],
+            # The bots have disconnected by now; this is as of the last sample
+            'bots_connected': self.queue_depth[-1][2] if self.queue_depth else 0,
+            'connections_throttled': self.server.throttled,
+            'rcon_commands': sum(len(rcon_server.commands) for rcon_server in self.rcon_servers),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=5.0, help='commands per second, across all users')
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds to issue commands for')
+    parser.add_argument('--drain-timeout', type=float, default=120.0,
+                        help='most seconds to wait for replies after the load stops')
+    parser.add_argument('--bots', type=int, default=4, help='how many bot names there are')
+    parser.add_argument('--min-bots', type=int, default=1, help='how many bots to keep connected')
+    parser.add_argument('--mode', default='highlander', choices=['highlander', 'sixes'])
+    parser.add_argument('--messages-per-minute', type=int, default=20)
+    parser.add_argument('--connect-interval', type=float, default=0.2)
+    parser.add_argument('--throttle', type=float, default=0.2,
+                        help='server refuses connections closer together than this, in seconds')
+    parser.add_argument('--penalty', type=float, default=2.0, help='server flood penalty per line, in seconds')
+    parser.add_argument('--window', type=float, default=10.0, help='server flood window, in seconds')
+    parser.add_argument('--max-targets', type=int, default=4)
+    parser.add_argument('--game-servers', type=int, default=2)
+    parser.add_argument('--max-games', type=int, default=1, help='most games one !pick may start')
+    parser.add_argument('--hold-time', type=float, default=10.0,
+                        help='seconds before a game server can be picked again')
+    parser.add_argument('--sample-interval', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--capture', help='log what the bot sees here, for bench/replay.py')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    server = FakeIRCServer(penalty=args.penalty, window=args.window, max_targets=args.max_targets,
+                           throttle=args.throttle)
+    port = reactor.listenTCP(0, server, interface='127.0.0.1').getHost().port
+
+    tmpdir = tempfile.mkdtemp(prefix='mix-bot-load-')
+    try:
+        servers, rcon_servers = start_game_servers(args.game_servers)
+        factory = network.start_bot_with_settings(make_settings(args, port, os.path.join(tmpdir, 'bot.sqlite'), servers))
+        factory.bots[0].brain.random.seed(args.seed)
+        test = LoadTest(args, server, factory, rcon_servers)
+
+        def wait_for_bots():
+            if len(factory.transports) < min(args.min_bots, args.bots):
+                reactor.callLater(0.1, wait_for_bots)
+            else:
+                test.start()
+        wait_for_bots()
+        reactor.run()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    output = json.dumps(test.report(), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
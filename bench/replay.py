@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+"""Replays a capture log (see network -> capture file) against the bot offline.
+
+    ./bench/replay.py capture.log --settings settings.yml --transcript before.tsv
+    ./bench/replay.py capture.log --settings settings.yml --compare before.tsv
+
+Every event is fed to the bot at the time it was seen, on a virtual
+clock (task.Clock) instead of the reactor, so hours of traffic replay
+in seconds. Nothing touches the network: the bot's messengers are
+stand-ins that note what they send, every channel's database is in
+memory and RCON commands succeed without being sent. The brains'
+random numbers are seeded, and balanced picking gets a pretend timer
+that moves on by --sample-cost for every candidate it looks at, so the
+same log and the same code always give the same replies on any
+machine.
+
+The report (JSON) has, per command, how long dispatching it took (real
+time, so this is the bot's own processing) and how long until the first
+line of its reply was sent (virtual time, so it includes waiting in
+the outbound queue for flood control), and how much faster than real
+time the replay ran. --transcript saves every line the bot sent, one
+per target; --compare diffs what was sent against such a transcript,
+say from a run on another branch.
+"""
+
+import argparse
+import collections
+import difflib
+import itertools
+import json
+import os
+import random
+import sys
+import timeit
+
+import yaml
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from twisted.internet import defer, task
+
+import brain
+import capture
+import commands
+import network
+import outbound
+import settings
+from serverpool import ServerPool
+
+from bench_brain import percentile
+from replies import ReplyTimer
+
+class ReplayMessenger(object):
+    """Stands in for an IRCMessenger, handing what it sends to sent(channel, message)."""
+    def __init__(self, name, sent):
+        self.name = self.nickname = name
+        self.should_dispatch = False
+        self.sent = sent
+
+    def send_message(self, channel, message):
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        self.sent(channel, message)
+
+    def max_targets(self):
+        return None
+
+    def sendLine(self, line):
+        pass
+
+class ReplayRCON(object):
+    """Stands in for an RCONPool, saying yes to everything without
+    connecting, so servers get passwords just like they would for real."""
+    def __init__(self, servers):
+        self.servers = set(name for name, server in servers.items() if server.get('rcon password'))
+
+    def __contains__(self, name):
+        return name in self.servers
+
+    def run(self, name, commands):
+        return defer.succeed([''] * len(commands))
+
+    def close(self):
+        pass
+
+def load_settings(filename):
+    """The settings in filename, with every database in memory and capturing off."""
+    with open(filename) as f:
+        overrides = yaml.safe_load(f) or {}
+    overrides.setdefault('database', {})['name'] = ':memory:'
+    overrides.setdefault('network', {})['capture file'] = None
+    for channel in (overrides.get('channels') or {}).values():
+        if channel and 'database' in channel:
+            channel['database']['name'] = ':memory:'
+    return settings.validate_settings(settings._deep_merge(settings.DEFAULT_BASE_SETTINGS, overrides))
+
+class Replay(object):
+    def __init__(self, args, bot_settings):
+        self.args = args
+        self.clock = task.Clock()
+        rng = random.Random(args.seed)
+
+        # Servers are never probed, so each is free again hold time after
+        # a PUG is sent to it
+        server_pool = ServerPool(bot_settings['servers'], bot_settings['server pool'], clock=self.clock)
+        rcon = ReplayRCON(bot_settings['servers'])
+        main = bot_settings['network']['channel']
+        brains = []
+        for channel in [main] + sorted(set(bot_settings['channels']) - set([main])):
+            my_brain = brain.SqliteBotBrain(bot_settings['channels'][channel], clock=self.clock, threaded=False,
+                                            server_pool=server_pool, rcon=rcon)
+            my_brain.random.seed(rng.random())
+            my_brain.balance_timer = itertools.count(0, args.sample_cost).next
+            brains.append((channel, my_brain))
+        self.factory = network.IRCBotFactory(bot_settings, brains, clock=self.clock)
+
+        self.sent = []
+        self.timer = ReplyTimer(self.factory, self.clock)
+
+        network_settings = bot_settings['network']
+        count = args.bots or network_settings['min bots']
+        for i, name in enumerate(network_settings['bot names'][:count]):
+            messenger = ReplayMessenger(name, self.observe)
+            messenger.bucket = outbound.TokenBucket(
+                rate=network_settings['messages per minute']/60.0,
+                burst=network_settings['message burst'],
+                clock=self.clock,
+            )
+            messenger.should_dispatch = i == 0
+            self.factory.transports.append(messenger)
+
+    def observe(self, channel, message):
+        now = self.clock.seconds()
+        for target in channel.split(','):
+            self.sent.append((now, target, message))
+        self.timer.sent(channel, message, now)
+
+    def run(self, events):
+        started = timeit.default_timer()
+        first = events[0][0] if events else 0
+        for when, event, event_args in events:
+            self.clock.advance(max(0, when - first - self.clock.seconds()))
+            self.factory.received(event, *event_args)
+        self.replayed = self.clock.seconds()
+        # Let whatever is still queued go out
+        deadline = self.replayed + self.args.drain_timeout
+        while len(self.factory.outbound) and self.clock.seconds() < deadline:
+            self.clock.advance(0.1)
+        for bot in self.factory.bots:
+            bot.brain.flush()
+        self.real_seconds = timeit.default_timer() - started
+
+    def transcript(self):
+        """Returns a line per line sent: its target and text (escaped)."""
+        return ['%s\t%s' % (target, message.encode('string_escape')) for _, target, message in self.sent]
+
+    def report(self, events):
+        latencies = {}
+        for command, timings in sorted(self.timer.dispatch_times.items()):
+            dispatching = sorted(t*1000 for t in timings)
+            replying = sorted(t*1000 for t in self.timer.reply_times.get(command, ()))
+            latencies[command] = {
+                'count': len(timings),
+                'answered': len(replying),
+                'dispatch_p50_ms': percentile(dispatching, 0.50),
+                'dispatch_p99_ms': percentile(dispatching, 0.99),
+                'dispatch_max_ms': dispatching[-1],
+            }
+            if replying:
+                latencies[command].update({
+                    'reply_p50_ms': percentile(replying, 0.50),
+                    'reply_p90_ms': percentile(replying, 0.90),
+                    'reply_p99_ms': percentile(replying, 0.99),
+                    'reply_max_ms': replying[-1],
+                })
+        return {
+            'options': vars(self.args),
+            'events': collections.Counter(event for _, event, _ in events),
+            'commands': latencies,
+            'lines_sent': len(self.sent),
+            'virtual_seconds': self.replayed,
+            'real_seconds': self.real_seconds,
+            'speedup': self.replayed / self.real_seconds if self.real_seconds else None,
+        }
+
+def read_transcript(filename):
+    with open(filename) as f:
+        return [line.rstrip('\n').split('\t', 1)[1] for line in f if '\t' in line]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('log', help='a capture log')
+    parser.add_argument('--settings', default=os.path.join(os.path.dirname(__file__), '..', 'settings.yml'),
+                        help='the bot settings to replay with (the databases are always in memory)')
+    parser.add_argument('--bots', type=int, help='how many messengers send replies (default: network -> min bots)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sample-cost', type=float, default=0.001,
+                        help='pretend seconds each candidate takes to look at, in balanced picking')
+    parser.add_argument('--drain-timeout', type=float, default=600.0,
+                        help='most virtual seconds to keep sending after the last event')
+    parser.add_argument('--transcript', help='write the lines the bot sent here')
+    parser.add_argument('--compare', help='diff the lines the bot sent against this transcript')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    events = list(capture.read_log(args.log))
+    replay = Replay(args, load_settings(args.settings))
+    replay.run(events)
+    result = replay.report(events)
+
+    if args.transcript:
+        with open(args.transcript, 'w') as f:
+            for (when, _, _), line in zip(replay.sent, replay.transcript()):
+                f.write('%.3f\t%s\n' % (when, line))
+    if args.compare:
+        before, after = read_transcript(args.compare), replay.transcript()
+        result['diff'] = {
+            'identical': before == after,
+            'lines_before': len(before),
+            'lines_after': len(after),
+            'unified': list(difflib.unified_diff(before, after, args.compare, 'this run', lineterm='', n=1)),
+        }
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
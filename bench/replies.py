@@ -0,0 +1,66 @@
+"""Times how long a whole bot takes to answer commands, for the
+benchmarks that drive one (irc_load.py and replay.py).
+"""
+
+import collections
+import timeit
+
+class ReplyTimer(object):
+    """Wraps a factory's dispatch and queue_message to time every
+    command: how long dispatching it took (real time, the bot's own
+    processing) and how long until the first line of its reply was sent
+    (on clock, so including any wait in the outbound queue).
+
+    A command counts from when clock says it was dispatched, or if
+    said_at(nick, message) is given, from whatever time that returns
+    (like when the IRC server got it). Pass every line that goes out,
+    with the targets as sent, to sent().
+    """
+    def __init__(self, factory, clock, said_at=None):
+        self.factory = factory
+        self.clock = clock
+        self.said_at = said_at
+        self.dispatch_times = collections.defaultdict(list)
+        self.reply_times = collections.defaultdict(list)
+        self._awaiting = collections.defaultdict(list)
+        self._context = []
+        self._dispatch, self._queue_message = factory.dispatch, factory.queue_message
+        factory.dispatch = self._dispatch_timed
+        factory.queue_message = self._queue_message_timed
+
+    def current(self):
+        """The command being dispatched, as {'command', 'at', 'answered'},
+        or None outside of dispatch."""
+        return self._context[-1] if self._context else None
+
+    def sent(self, channel, message, when=None):
+        """Takes a line the bot sent to channel (targets joined by commas,
+        as they were queued) at when, by default now."""
+        when = self.clock.seconds() if when is None else when
+        # Latency is measured to the first line of each reply
+        for context in self._awaiting.pop((channel, message), ()):
+            if not context['answered']:
+                context['answered'] = True
+                self.reply_times[context['command']].append(when - context['at'])
+
+    def _dispatch_timed(self, user, channel, message):
+        if self.said_at is None:
+            at = self.clock.seconds()
+        else:
+            at = self.said_at(user.split('!', 1)[0], message)
+        context = {'command': message.split()[0][1:], 'at': at, 'answered': False}
+        self._context.append(context)
+        start = timeit.default_timer()
+        try:
+            return self._dispatch(user, channel, message)
+        finally:
+            self.dispatch_times[context['command']].append(timeit.default_timer() - start)
+            self._context.pop()
+
+    def _queue_message_timed(self, message, channel=None, **kwargs):
+        if self._context:
+            target = channel or self.factory.bots[0].channel
+            if isinstance(message, unicode):
+                message = message.encode('utf-8')
+            self._awaiting[(target, message)].append(self._context[-1])
+        return self._queue_message(message, channel, **kwargs)
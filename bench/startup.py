@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+"""Times how long the bot takes from starting to answering commands.
+
+    ./bench/startup.py --history 10000 --players 12 --target 2
+
+Runs bin/bot as a new process against a local stand-in IRC server, with
+a database holding --history past picks and --players added players,
+as if it had just been restarted mid-PUG. As soon as the bot is in the
+channel, a user says !list. The report (JSON) has the seconds from
+starting the process until the bot connected, joined and answered, the
+timings the bot printed itself, and how many added players it restored.
+It exits with status 1 if answering took longer than --target seconds.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+import yaml
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from twisted.internet import protocol, reactor, task
+
+import brain
+import settings
+
+from fakeircd import FakeIRCServer
+
+BOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'bin', 'bot'))
+CHANNEL = '#startup'
+NICK = 'StartupBot'
+
+def make_settings(port, database):
+    return {
+        'network': {
+            'server': '127.0.0.1',
+            'port': port,
+            'channel': CHANNEL,
+            'bot names': [NICK],
+        },
+        'database': {'name': database},
+    }
+
+def fill_database(bot_settings, args, rng):
+    """Writes args.history past picks and args.players added players."""
+    # Added just now, as far as the bot will be concerned
+    clock = task.Clock()
+    clock.advance(reactor.seconds())
+    my_brain = brain.SqliteBotBrain(
+        settings.validate_settings(settings._deep_merge(settings.DEFAULT_BASE_SETTINGS, bot_settings)),
+        clock=clock,
+        threaded=False,
+    )
+    classes = my_brain.rules.valid_classes
+    people = ['player%d' % i for i in xrange(max(args.players, 2*len(classes)))]
+    for _ in xrange(args.history):
+        picked = rng.sample(people, 2*len(classes))
+        my_brain.record_pick({
+            'red': dict(zip(picked[:len(classes)], classes)),
+            'blu': dict(zip(picked[len(classes):], classes)),
+        })
+    for name in people[:args.players]:
+        my_brain.player_set_added_classes(name, rng.sample(classes, rng.randint(1, 3)))
+    my_brain.flush()
+    my_brain._conn.close()
+    return people[:args.players]
+
+class BotProcess(protocol.ProcessProtocol):
+    def __init__(self, test):
+        self.test = test
+        self.buffer = ''
+
+    def outReceived(self, data):
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.test.bot_said(line)
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self.test.ended()
+
+class StartupTest(object):
+    def __init__(self, args, server, settings_file):
+        self.args = args
+        self.server = server
+        self.settings_file = settings_file
+        self.times = {}
+        self.output = []
+        self.answer = None
+        self.process = None
+        server.observers.append(self.observe)
+
+    def start(self):
+        self.started = reactor.seconds()
+        self.process = reactor.spawnProcess(BotProcess(self), sys.executable, [sys.executable, BOT, self.settings_file],
+                                            env=os.environ)
+        self._poll = task.LoopingCall(self.poll)
+        self._poll.start(0.005)
+        self._timeout = reactor.callLater(self.args.timeout, self.stop)
+
+    def mark(self, name):
+        if name not in self.times:
+            self.times[name] = reactor.seconds() - self.started
+
+    def poll(self):
+        if NICK in self.server.clients:
+            self.mark('connected')
+        if NICK in self.server.channels.get(CHANNEL, ()) and 'joined' not in self.times:
+            self.mark('joined')
+            self.server.say('tester', CHANNEL, '!list')
+
+    def observe(self, when, nick, targets, text):
+        if nick == NICK and self.answer is None:
+            self.mark('answered')
+            self.answer = text
+            self.stop()
+
+    def bot_said(self, line):
+        self.output.append(line)
+
+    def stop(self):
+        if self._poll.running:
+            self._poll.stop()
+        if self._timeout.active():
+            self._timeout.cancel()
+        if self.process is not None and self.process.pid is not None:
+            self.process.signalProcess('TERM')
+        else:
+            self.ended()
+
+    def ended(self):
+        if reactor.running:
+            reactor.stop()
+
+    def report(self):
+        restored = 0
+        if self.answer and self.answer.startswith('Players added:'):
+            restored = len([name for name in self.answer.split(':', 1)[1].split(',') if name.strip()])
+        return {
+            'options': vars(self.args),
+            'seconds': self.times,
+            'bot_output': [line for line in self.output if 'seconds after starting' in line],
+            'restored_players': restored,
+            'within_target': self.times.get('answered', float('inf')) <= self.args.target,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--history', type=int, default=10000, help='how many past picks are in the database')
+    parser.add_argument('--players', type=int, default=12, help='how many players were added when the bot stopped')
+    parser.add_argument('--users', type=int, default=100, help='how many other users are in the channel')
+    parser.add_argument('--target', type=float, default=2.0, help='most seconds the bot may take to answer')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    server = FakeIRCServer()
+    port = reactor.listenTCP(0, server, interface='127.0.0.1').getHost().port
+
+    tmpdir = tempfile.mkdtemp(prefix='mix-bot-startup-')
+    try:
+        bot_settings = make_settings(port, os.path.join(tmpdir, 'bot.sqlite'))
+        added = fill_database(bot_settings, args, random.Random(args.seed))
+        settings_file = os.path.join(tmpdir, 'settings.yml')
+        with open(settings_file, 'w') as f:
+            yaml.safe_dump(bot_settings, f)
+        for nick in added + ['user%d' % i for i in xrange(args.users)] + ['tester']:
+            server.add_user(nick, CHANNEL)
+
+        test = StartupTest(args, server, settings_file)
+        reactor.callWhenRunning(test.start)
+        reactor.run()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    result = test.report()
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+    sys.exit(0 if result['within_target'] else 1)
+
+if __name__ == '__main__':
+    main()
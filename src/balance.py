@@ -0,0 +1,121 @@
+import timeit
+
+import numpy
+
+class Experience(object):
+    """Games played by each player as each class.
+
+    Counts live in a NumPy array with one row per player and one column
+    per class, so scores for the whole history are computed in one go.
+    """
+    def __init__(self, classes):
+        self.classes = list(classes)
+        self._column = dict((cls, i) for i, cls in enumerate(self.classes))
+        self._rows = {}
+        self.games = numpy.zeros((0, len(self.classes)))
+        self._scores = None
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def _row(self, name):
+        row = self._rows.get(name)
+        if row is None:
+            row = self._rows[name] = len(self._rows)
+            if row >= len(self.games):
+                grown = numpy.zeros((max(2*len(self.games), 64), len(self.classes)))
+                grown[:len(self.games)] = self.games
+                self.games = grown
+        return row
+
+    def add(self, name, cls, count=1):
+        column = self._column.get(cls)
+        if column is None:
+            return
+        row = self._row(name)
+        self.games[row, column] += count
+        self._scores = None
+
+    def rename(self, old_name, new_name):
+        if old_name in self._rows and new_name not in self._rows:
+            self._rows[new_name] = self._rows.pop(old_name)
+
+    def players(self):
+        return self._rows.keys()
+
+    def counts(self, name):
+        """Returns {'class': games} for the classes name has played."""
+        row = self._rows.get(name)
+        if row is None:
+            return {}
+        return dict((cls, int(games)) for cls, games in zip(self.classes, self.games[row].tolist()) if games)
+
+    def games_played(self, names):
+        """Returns a list of how many games each name has played."""
+        totals = self.games.sum(axis=1)
+        return [int(totals[self._rows[name]]) if name in self._rows else 0 for name in names]
+
+    def scores(self, names):
+        """Returns an array of scores, one row per name and one column per class.
+
+        A player's score on a class grows with the games they played as
+        that class and, more slowly, with their games overall.
+        """
+        if self._scores is None:
+            totals = self.games.sum(axis=1)
+            self._scores = numpy.log1p(self.games) + 0.5*numpy.log1p(totals)[:, numpy.newaxis]
+        result = numpy.zeros((len(names), len(self.classes)))
+        known = [(i, self._rows[name]) for i, name in enumerate(names) if name in self._rows]
+        if known:
+            indexes, rows = zip(*known)
+            result[list(indexes)] = self._scores[list(rows)]
+        return result
+
+def _team_difference(teams, scores):
+    return (
+        sum(scores[name][cls] for name, cls in teams['red'].items()) -
+        sum(scores[name][cls] for name, cls in teams['blu'].items())
+    )
+
+def _improve(teams, scores):
+    """Swaps same-class players between teams while that evens them out.
+
+    Returns the remaining difference, red minus blu.
+    """
+    difference = _team_difference(teams, scores)
+    while True:
+        best = None
+        for red_name, cls in teams['red'].items():
+            for blu_name, blu_cls in teams['blu'].items():
+                if blu_cls != cls:
+                    continue
+                swapped = difference - 2*(scores[red_name][cls] - scores[blu_name][cls])
+                if abs(swapped) < abs(difference) and (best is None or abs(swapped) < abs(best[0])):
+                    best = (swapped, red_name, blu_name, cls)
+        if best is None:
+            return difference
+        difference, red_name, blu_name, cls = best
+        del teams['red'][red_name]
+        del teams['blu'][blu_name]
+        teams['red'][blu_name] = cls
+        teams['blu'][red_name] = cls
+
+def balanced_pick(sampler, scores, time_budget, timer=timeit.default_timer):
+    """Returns the most even picking found within time_budget seconds
+    (as timer tells them).
+
+    Candidates are drawn from sampler, so each one is valid, and then
+    improved by swapping players between teams.
+
+    scores: {'player name': {'class': score}}
+    """
+    deadline = timer() + time_budget
+    best, best_difference = None, None
+    while best is None or timer() < deadline:
+        teams = sampler.sample()
+        difference = abs(_improve(teams, scores))
+        if best is None or difference < best_difference:
+            best, best_difference = teams, difference
+            if difference == 0:
+                break
+    return best
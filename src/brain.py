@@ -1,5 +1,24 @@
+import collections
 import random
-import sqlite3
+import string
+import timeit
+
+from twisted.internet import defer, reactor
+
+import metrics
+import stats
+import storage
+from balance import Experience, balanced_pick
+from feasibility import SlotMatcher
+from outbound import NOTICE
+from rcon import RCONError, RCONPool, quote_argument
+from sampling import TeamSampler
+from serverpool import ServerPool
+
+PASSWORD_CHARACTERS = string.ascii_lowercase + string.digits
+# Server passwords come from the OS, never from the brain's (seedable)
+# random numbers
+_password_random = random.SystemRandom()
 
 class PickingError(ValueError):
     def __init__(self, needed_classes):
@@ -14,210 +33,736 @@ class PickingError(ValueError):
         else:
             return 'Need %s, and %s' % (', '.join(self.needed_classes[:-1]), self.needed_classes[-1])
 
+class Roster(object):
+    """In-memory record of which players are added as which classes.
+
+    Each player's classes are kept as a bitmask (see settings.Rules),
+    and the players of each class as a set, both up to date on every
+    change, so reads never need to rebuild them. `version` goes up with
+    every change.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.version = 0
+        self._by_player = {}
+        self._by_class = dict((cls, set()) for cls in rules.valid_classes)
+
+    def __contains__(self, name):
+        return name in self._by_player
+
+    def __len__(self):
+        return len(self._by_player)
+
+    def set_classes(self, name, classes):
+        self.set_mask(name, self.rules.mask(classes))
+
+    def set_mask(self, name, mask):
+        self.remove(name)
+        if not mask:
+            return
+        self.version += 1
+        self._by_player[name] = mask
+        for cls in self.rules.classes_in(mask):
+            self._by_class[cls].add(name)
+
+    def remove(self, name):
+        if name not in self._by_player:
+            return
+        self.version += 1
+        for cls in self.rules.classes_in(self._by_player.pop(name)):
+            self._by_class[cls].discard(name)
+
+    def mask_of(self, name):
+        return self._by_player.get(name, 0)
+
+    def classes_of(self, name):
+        """name's classes, in the order of valid classes."""
+        return self.rules.classes_in(self._by_player.get(name, 0))
+
+    def players_of(self, cls):
+        return self._by_class.get(cls, set())
+
+    def class_sort_key(self, cls):
+        return self.rules.class_sort_key(cls)
+
+    def players(self):
+        return sorted(self._by_player)
+
+    def masks(self):
+        """Returns {'player name': class bitmask}."""
+        return dict(self._by_player)
+
+    def players_by_class(self):
+        return {cls: sorted(players) for cls, players in self._by_class.items() if players}
+
+    def classes_by_player(self):
+        return {name: list(self.rules.classes_in(mask)) for name, mask in self._by_player.items()}
+
+TEAMS = ('red', 'blu')
+
+class DraftError(ValueError):
+    pass
+
+class Draft(object):
+    """A captain pick in progress.
+
+    The two captains take turns choosing a player and a class for their
+    team, and only choices that leave every remaining slot fillable are
+    allowed. The draft keeps a complete assignment of the players left
+    to the slots left (both teams' together, since the turn order can
+    always give a slot to whichever team still has it open) and works
+    out the legal choices from it after every pick.
+    """
+    def __init__(self, rules, masks_by_player):
+        self.rules = rules
+        self.roster = Roster(rules)
+        self.matcher = SlotMatcher(self.roster, rules)
+        for name, mask in masks_by_player.items():
+            self.roster.set_mask(name, mask)
+            self.matcher.player_changed(name)
+        if not self.matcher.is_complete():
+            raise PickingError(self.matcher.needed_classes())
+        self.captains = {}
+        self.teams = dict((team, {}) for team in TEAMS)
+        self.open = dict((team, dict(rules.class_limits)) for team in TEAMS)
+        self.turn = TEAMS[0]
+        self.server = None
+        self.timeout = None
+        self._moves = None
+
+    def is_done(self):
+        return not any(any(self.open[team].values()) for team in TEAMS)
+
+    def choices(self, team=None):
+        """Returns {'player name': class bitmask} of what team (by default,
+        whoever's turn it is) may pick."""
+        if self._moves is None:
+            self._moves = self.matcher.legal_moves()
+        team = self.turn if team is None else team
+        open_mask = self.rules.mask(cls for cls, left in self.open[team].items() if left > 0)
+        return dict((name, mask & open_mask) for name, mask in self._moves.items() if mask & open_mask)
+
+    def add_captain(self, team, name):
+        """Makes name team's captain, playing the first class they added
+        that keeps the draft possible. Returns False if there is none."""
+        mask = self.choices(team).get(name, 0)
+        if not mask:
+            return False
+        self.captains[team] = name
+        self._take(team, name, self.rules.classes_in(mask)[0])
+        return True
+
+    def pick(self, name, cls=None):
+        """Whoever's turn it is picks name as cls, which can be left out
+        if name can only be picked as one class. Throws a DraftError if
+        that isn't allowed."""
+        if name not in self.roster:
+            raise DraftError('%s is not up for picking' % name)
+        mask = self.choices().get(name, 0)
+        if cls is None:
+            classes = self.rules.classes_in(mask)
+            if len(classes) > 1:
+                raise DraftError('Pick a class for %s: %s' % (name, ', '.join(classes)))
+            cls = classes[0] if classes else None
+        if not mask & self.rules.class_bit.get(cls, 0):
+            raise DraftError("%s can't be picked as %s right now" % (name, cls or 'anything'))
+        self._take(self.turn, name, cls)
+        other = TEAMS[1 - TEAMS.index(self.turn)]
+        if any(self.open[other].values()):
+            self.turn = other
+
+    def auto_pick(self, rng):
+        """Makes a random legal pick for whoever's turn it is. Returns
+        (name, class)."""
+        choices = self.choices()
+        name = rng.choice(sorted(choices))
+        cls = rng.choice(self.rules.classes_in(choices[name]))
+        self.pick(name, cls)
+        return name, cls
+
+    def _take(self, team, name, cls):
+        self.teams[team][name] = cls
+        self.open[team][cls] -= 1
+        self.roster.remove(name)
+        self.matcher.player_changed(name)
+        self.matcher.remove_slot(cls)
+        self._moves = None
+
 class BaseBotBrain(object):
-    def __init__(self, settings):
+    def __init__(self, settings, clock=None, threaded=True, server_pool=None, rcon=None):
         self.settings = settings
+        self.threaded = threaded
         self.dispatcher = None
         self.can_pick_cache = False
+        self.clock = reactor if clock is None else clock
+        self.random = random.Random()
+        # Replays swap in a pretend timer, so that how many candidates a
+        # balanced pick tries doesn't depend on how fast the machine is
+        self.balance_timer = timeit.default_timer
+        self.rules = settings['rules']
+        self.roster = Roster(self.rules)
+        self.matcher = SlotMatcher(self.roster, self.rules)
+        # (roster version, TeamSampler) for everyone added
+        self._roster_sampler_cache = (None, None)
+        self.experience = Experience(self.rules.valid_classes)
+        # Brains for several channels share one of each
+        if server_pool is None:
+            server_pool = ServerPool(settings['servers'], settings['server pool'], clock=self.clock)
+        self.server_pool = server_pool
+        self.rcon = RCONPool(settings['servers'], settings['rcon'], clock=self.clock) if rcon is None else rcon
+        self.draft = None
+        self.captain_volunteers = set()
+        # When each player last played, as far as the history goes back
+        self.last_played = {}
+        # How many added players were put back from before a restart
+        self.restored = 0
         self._setup()
+        self.leaderboards = stats.Leaderboards(self.experience)
 
     def _setup(self):
         pass
 
-    def random_pick(self, deterministic=False):
+    def random_pick(self):
         """Returns a random picking or throw a PickingError if picking is impossible.
 
+        Every valid picking is equally likely.
+
+        Returns: {'team': {'player name': 'class'}}
+        """
+        return self._roster_sampler().sample()
+
+    def balanced_pick(self):
+        """Returns the most even picking found within rules -> balance time,
+        judged by the players' histories, or throws a PickingError if
+        picking is impossible.
+
         Returns: {'team': {'player name': 'class'}}
         """
-        by_player = self.classes_by_player()
+        return self._balanced_pick(self._roster_sampler(), self.rules.balance_time)
+
+    def _balanced_pick(self, sampler, balance_time):
+        return balanced_pick(
+            sampler,
+            self.experience_scores(sampler.players()),
+            balance_time,
+            timer=self.balance_timer,
+        )
+
+    def pick_games(self):
+        """Picks as many games at once as the added players, the free
+        servers and rules -> max games allow (at least one), each the
+        way rules -> picking says. Throws a PickingError if picking is
+        impossible.
+
+        Returns: [{'team': {'player name': 'class'}}], one per game
+        """
+        most = min(self.rules.max_games, self.server_pool.free(), len(self.roster) // self.rules.game_size)
+        if most <= 1:
+            samplers = [self._roster_sampler()]
+        else:
+            samplers = [self._sampler(masks) for masks in self._partition(most)]
+        if self.rules.picking == 'balanced':
+            # Splitting the time keeps the whole pick within it
+            return [self._balanced_pick(sampler, self.rules.balance_time / len(samplers)) for sampler in samplers]
+        return [sampler.sample() for sampler in samplers]
+
+    def _partition(self, most):
+        """Splits the added players into as many complete games as they
+        can fill, up to most, in one pass over them.
+
+        Returns: [{'player name': class bitmask}], one per game, with
+        the players in that game
+
+        Players are matched to the slots of every game at once, in a
+        random order, so whoever can't fit is left out at random (see
+        SlotMatcher). The matched players of each class are then dealt
+        out to the games, which makes every game fillable; who plays
+        which class is left to picking each game.
+        """
+        masks = self.roster.masks()
+        names = sorted(masks)
+        self.random.shuffle(names)
+        for games in xrange(most, 1, -1):
+            roster = Roster(self.rules)
+            matcher = SlotMatcher(roster, self.rules, games)
+            for name in names:
+                roster.set_mask(name, masks[name])
+                matcher.player_changed(name)
+                if matcher.is_complete():
+                    break
+            if matcher.is_complete():
+                break
+        else:
+            return [masks]
+
         by_class = {}
-        for cls in self.settings['rules']['valid classes']:
-            by_class[cls] = []
-            for p in by_player:
-                if cls in by_player[p]:
-                    by_class[cls].append(p)
-
-        classes = [
-            cls for cls, _ in sorted(
-                by_class.items(),
-                key=lambda pair: len(pair[1]),
-            )
-        ]
-
-        red, blu = {}, {}
-        needed = []
-        for cls in classes:
-            limit = 2*self.settings['rules']['class limits'][cls]
-            if len(by_class[cls]) < limit:
-                needed.append(cls)
-                continue
-            for i in range(limit):
-                # Remove player p from each class they signed up for
-                if deterministic:
-                    p = by_class[cls][0]
-                else:
-                    p = random.choice(by_class[cls])
-                by_class[cls].remove(p)
-                by_player[p].remove(cls)
-                (red, blu)[i%2][p] = cls
-                for player_class in by_player[p]:
-                    by_class[player_class].remove(p)
-
-        if needed:
-            needed.sort(key=lambda cls: self.settings['rules']['valid classes'].index(cls))
-            raise PickingError(needed)
-
-        return {'red': red, 'blu': blu}
+        for name, cls in sorted(matcher.assignment().items()):
+            by_class.setdefault(cls, []).append(name)
+        partition = [{} for _ in xrange(games)]
+        for cls in self.rules.classes_in(self.rules.pickable):
+            players = by_class[cls]
+            self.random.shuffle(players)
+            for i, name in enumerate(players):
+                partition[i % games][name] = masks[name]
+        return partition
+
+    def start_draft(self):
+        """Starts a captain pick with everyone added, or throws a
+        PickingError if picking is impossible.
+
+        Players who volunteered come first for captain, then everyone
+        else, most games played first in both cases.
+        """
+        draft = Draft(self.rules, self.roster.masks())
+        names = self.roster.players()
+        games = self.experience.games_played(names)
+        ranked = sorted(
+            (name not in self.captain_volunteers, -played, self.random.random(), name)
+            for name, played in zip(names, games)
+        )
+        candidates = iter(name for _, _, _, name in ranked)
+        for team in TEAMS:
+            for name in candidates:
+                if draft.add_captain(team, name):
+                    break
+        draft.turn = self.random.choice(TEAMS)
+        self.draft = draft
+        return draft
+
+    def end_draft(self):
+        """Stops the captain pick. Returns its teams."""
+        draft, self.draft = self.draft, None
+        if draft.timeout is not None and draft.timeout.active():
+            draft.timeout.cancel()
+        self.captain_volunteers.difference_update(draft.captains.values())
+        return draft.teams
+
+    def volunteer_captain(self, nickname):
+        """Toggles whether nickname wants to be a captain. Returns True if they now do."""
+        if nickname in self.captain_volunteers:
+            self.captain_volunteers.discard(nickname)
+            return False
+        self.captain_volunteers.add(nickname)
+        return True
+
+    def _sampler(self, masks_by_player):
+        sampler = TeamSampler(masks_by_player, self.rules, rng=self.random)
+        if not sampler:
+            raise PickingError(self.matcher.needed_classes())
+        return sampler
+
+    def _roster_sampler(self):
+        """The sampler for everyone added, built again only once the
+        roster has changed."""
+        version, sampler = self._roster_sampler_cache
+        if version != self.roster.version:
+            sampler = self._sampler(self.roster.masks())
+            self._roster_sampler_cache = (self.roster.version, sampler)
+        return sampler
+
+    def get_server(self):
+        """Returns the settings of the server to send the next PUG to, with
+        its name, or throws a NoServerAvailable if every server is in use.
+
+        Servers the bot can set up over RCON get a new random password
+        each time, unless one is configured.
+        """
+        name = self.server_pool.acquire()
+        server = dict(self.settings['servers'][name], name=name)
+        if not server.get('password'):
+            if name in self.rcon:
+                server['password'] = ''.join(_password_random.choice(PASSWORD_CHARACTERS) for _ in xrange(8))
+            else:
+                server['password'] = ''
+        return server
+
+    def prepare_server(self, server):
+        """Sets server (from get_server) up for a PUG over RCON: runs its
+        config, sets its password and changes its map. Returns a Deferred
+        that fires once it's ready, right away if it has no RCON password.
+        """
+        if server['name'] not in self.rcon:
+            return defer.succeed(None)
+        commands = []
+        try:
+            if server.get('config'):
+                commands.append('exec %s' % quote_argument(server['config']))
+            commands.append('sv_password %s' % quote_argument(server['password']))
+            if server.get('map'):
+                commands.append('changelevel %s' % quote_argument(server['map']))
+        except RCONError:
+            return defer.fail()
+        return self.rcon.run(server['name'], commands)
+
+    def experience_scores(self, nicknames):
+        """Returns {'player name': {'class': score}}, higher meaning more experienced."""
+        classes = self.experience.classes
+        scores = self.experience.scores(nicknames)
+        return {
+            name: dict(zip(classes, row))
+            for name, row in zip(nicknames, scores.tolist())
+        }
+
+    # Methods that store something return a Deferred that fires once it
+    # has been stored. Everything the bot reads is kept in memory, so
+    # callers never need to wait on them.
+    def record_pick(self, teams):
+        """Remember who played which class in a completed picking."""
+        self._count_pick(teams, self.clock.seconds())
+        return defer.succeed(None)
+
+    def _count_pick(self, teams, played_at):
+        for team in teams.values():
+            for nickname, cls in team.items():
+                self.experience.add(nickname, cls)
+                self.last_played[nickname] = played_at
+                self.leaderboards.played(nickname)
+
+    def player_changed_name(self, old_nick, new_nick):
+        """Moves old_nick's history over to new_nick.
+
+        Fires with False if new_nick already has a history of its own,
+        in which case both are left alone.
+        """
+        if new_nick in self.experience:
+            return defer.succeed(False)
+        self._history_renamed(old_nick, new_nick)
+        return defer.succeed(True)
+
+    def _history_renamed(self, old_nick, new_nick):
+        self.experience.rename(old_nick, new_nick)
+        if old_nick in self.last_played:
+            self.last_played[new_nick] = self.last_played.pop(old_nick)
+        self.leaderboards.renamed(old_nick, new_nick)
+
+    def player_stats(self, nickname):
+        """Returns {'games', 'classes': {'class': games}, 'last played'}
+        for nickname, or None if they've never played."""
+        counts = self.experience.counts(nickname)
+        if not counts:
+            return None
+        return {
+            'games': sum(counts.values()),
+            'classes': counts,
+            'last played': self.last_played.get(nickname),
+        }
+
+    def top_players(self, cls=None):
+        """Returns [('player name', games)] for the players with the most
+        games as cls, or overall if it's None, most first."""
+        return self.leaderboards.top(cls)
+
+    def rebuild_stats(self):
+        """Recounts the stored stats from the history. Fires once done."""
+        return defer.succeed(None)
 
     def can_pick(self):
         """Returns True/False whether picking can start"""
-        try:
-            result = self.random_pick(deterministic=True)
+        if self.matcher.is_complete():
             if not self.can_pick_cache:
                 self.notice_can_pick()
                 self.can_pick_cache = True
-        except PickingError:
-            if self.can_pick_cache:
-                self.notice_cannot_pick()
-                self.can_pick_cache = False
+        elif self.can_pick_cache:
+            self.notice_cannot_pick()
+            self.can_pick_cache = False
 
         return self.can_pick_cache
 
     def classes_needed(self):
-        try:
-            self.random_pick(deterministic=True)
+        needed = self.matcher.needed_classes()
+        if not needed:
             return 'No classes needed'
-        except PickingError as e:
-            return str(e)
+        return str(PickingError(needed))
 
     def notice_can_pick(self):
-        self.dispatcher.queue_message('Picking can start at any time (try !pick)')
+        self.dispatcher.queue_message('Picking can start at any time (try !pick)', priority=NOTICE)
 
     def notice_cannot_pick(self):
-        self.dispatcher.queue_message('Picking may no longer start')
+        self.dispatcher.queue_message('Picking may no longer start', priority=NOTICE)
+
+    def flush(self):
+        return defer.succeed(None)
+
+    # Any method that does any kind of state change should call
+    # self.can_pick() afterward to notify changes in the picking
+    # status.
+    def player_set_added_classes(self, nickname, classes):
+        self.roster.set_classes(nickname, classes)
+        self.matcher.player_changed(nickname)
+        self.can_pick()
+
+    def player_remove(self, nickname):
+        self.roster.remove(nickname)
+        self.matcher.player_changed(nickname)
+        self.captain_volunteers.discard(nickname)
+        self.can_pick()
+
+    def player_renamed(self, old_nick, new_nick):
+        """Moves old_nick's added classes, and their history if new_nick
+        has none, over to new_nick."""
+        mask = self.roster.mask_of(old_nick)
+        if mask:
+            mask |= self.roster.mask_of(new_nick)
+            self.roster.remove(old_nick)
+            self.roster.set_mask(new_nick, mask)
+            self.matcher.player_changed(old_nick)
+            self.matcher.player_changed(new_nick)
+            if old_nick in self.captain_volunteers:
+                self.captain_volunteers.discard(old_nick)
+                self.captain_volunteers.add(new_nick)
+            self.can_pick()
+        if old_nick in self.experience:
+            return self.player_changed_name(old_nick, new_nick)
+        return defer.succeed(False)
+
+    def roster_version(self):
+        """A number that goes up whenever anyone adds or removes."""
+        return self.roster.version
+
+    def players_added(self):
+        return self.roster.players()
+
+    def players_by_class(self):
+        return self.roster.players_by_class()
+
+    def classes_by_player(self):
+        return self.roster.classes_by_player()
 
 class SqliteBotBrain(BaseBotBrain):
     def _get_cursor(self):
+        if metrics.registry.enabled:
+            return metrics.TimedCursor(self._conn.cursor())
         return self._conn.cursor()
 
     def _setup(self):
-        self._conn = sqlite3.connect(self.settings['database']['name'])
-        self._conn.isolation_level = None # Autocommit level
+        self._player_ids = {}
+        # Picks recorded since each rebuild_stats in progress started
+        self._rebuilds = []
+        self._dirty = set()
+        self._flush_call = None
+        self._conn = storage.connect(self.settings['database']['name'])
+        storage.migrate(self._conn)
         c = self._get_cursor()
 
-        # Create the initial tables
-        c.execute("""\
-        CREATE TABLE IF NOT EXISTS player (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE ON CONFLICT IGNORE
-        )
-        """)
+        self.experience, self.last_played = self._read_stats(c)
+
+        self.restored = self._restore_added(c)
+
+        # From here on the database is only touched through self.db, off
+        # the reactor thread.
+        self.db = storage.DatabaseThread() if self.threaded else storage.InlineDatabase()
+
+    def _read_stats(self, c):
+        """Returns an Experience and last_played from the stored totals."""
+        # The totals, rather than the whole history, so this takes as
+        # long with years of PUGs as with a week's
+        experience = Experience(self.rules.valid_classes)
         c.execute("""
-        CREATE TABLE IF NOT EXISTS player_pug_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            player_id INTEGER,
-            class TEXT,
-            FOREIGN KEY(player_id) REFERENCES player(id)
-        )
+        SELECT player.name, player_class_stats.class, player_class_stats.games
+        FROM player_class_stats JOIN player ON player.id = player_class_stats.player_id
         """)
+        for name, cls, count in c.fetchall():
+            experience.add(name, cls, count)
         c.execute("""
-        CREATE TABLE IF NOT EXISTS players_added (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            player_id INTEGER,
-            class TEXT,
-            FOREIGN KEY(player_id) REFERENCES player(id)
-        )
+        SELECT player.name, player_stats.last_played
+        FROM player_stats JOIN player ON player.id = player_stats.player_id
+        WHERE player_stats.last_played IS NOT NULL
         """)
+        return experience, dict(c.fetchall())
 
-        # When the bot starts up, reset the picking process (because
-        # players may have left since they added)
-        c.execute("DELETE FROM players_added")
-        self.can_pick()
+    def _restore_added(self, c):
+        """Puts back the players who were added when the bot stopped, so a
+        restart doesn't lose a half-filled PUG.
+
+        Players added more than database -> restore max age seconds ago
+        are dropped, and so are classes the rules no longer have. The
+        rest are checked against the channel's NAMES once the bot is in
+        it (see Presence.names_end), like after any reconnect. Returns
+        how many players were put back.
+        """
+        oldest = self.clock.seconds() - self.settings['database']['restore max age']
+        c.execute("DELETE FROM players_added WHERE added_at IS NULL OR added_at < ?", (oldest,))
+        c.execute("""
+        SELECT player.id, player.name, players_added.class
+        FROM players_added JOIN player ON player.id = players_added.player_id
+        ORDER BY players_added.id
+        """)
+        classes_by_nickname = collections.OrderedDict()
+        for player_id, name, cls in c.fetchall():
+            self._player_ids[name] = player_id
+            classes = classes_by_nickname.setdefault(name, [])
+            if cls in self.rules.valid_classes:
+                classes.append(cls)
+            else:
+                self._mark_dirty(name)
+        for name, classes in classes_by_nickname.items():
+            self.roster.set_classes(name, classes)
+            self.matcher.player_changed(name)
+        # There's no one to tell yet
+        self.can_pick_cache = self.matcher.is_complete()
+        return len(self.roster)
+
+    def _player_id_from_name(self, nickname, create=True):
+        player_id = self._player_ids.get(nickname)
+        if player_id is not None:
+            return player_id
 
-    def _player_id_from_name(self, nickname):
         c = self._get_cursor()
         c.execute("SELECT id FROM player WHERE name = ?", (nickname,))
         row = c.fetchone()
         if row is None:
+            if not create:
+                return None
             c.execute("INSERT INTO player (name) VALUES (?)", (nickname,))
             player_id = c.lastrowid
         else:
             player_id = row[0]
 
+        self._player_ids[nickname] = player_id
         return player_id
 
-    def _player_names_from_ids(self, ids):
-        if not ids:
-            return {}
-        c = self._get_cursor()
-        query = "SELECT id, name FROM player WHERE %s" % ' OR '.join('id = ?' for _ in ids)
-        c.execute(query, ids)
-        return {id: name for id, name in c.fetchall()}
+    # The roster in memory is the source of truth; changes to it are
+    # written to the database in batches some time later. Only the
+    # latest state of each player matters, so repeated changes to the
+    # same player between flushes cost a single write.
+    def _mark_dirty(self, nickname):
+        self._dirty.add(nickname)
+        if self._flush_call is None or not self._flush_call.active():
+            self._flush_call = self.clock.callLater(
+                self.settings['database']['flush delay'],
+                self.flush,
+            )
+
+    def flush(self):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return defer.succeed(None)
+        classes_by_nickname = dict((nickname, list(self.roster.classes_of(nickname))) for nickname in dirty)
+        return self.db.run(self._write_added, classes_by_nickname, self.clock.seconds())
+
+    def _write_added(self, classes_by_nickname, added_at):
+        with storage.transaction(self._conn):
+            c = self._get_cursor()
+            player_ids = {}
+            for nickname, classes in classes_by_nickname.items():
+                # Players with nothing added have nothing to delete unless
+                # they're already known
+                player_id = self._player_id_from_name(nickname, create=bool(classes))
+                if player_id is not None:
+                    player_ids[nickname] = player_id
+            c.executemany("DELETE FROM players_added WHERE player_id = ?", [(pid,) for pid in player_ids.values()])
+            c.executemany("INSERT INTO players_added (player_id, class, added_at) VALUES (?, ?, ?)", [
+                (player_ids[nickname], class_name, added_at)
+                for nickname, classes in classes_by_nickname.items()
+                for class_name in classes
+            ])
 
-    # Any method that does any kind of state change should call
-    # self.can_check() afterward to notify changes in the picking
-    # status.
     def player_set_added_classes(self, nickname, classes):
-        c = self._get_cursor()
-        player_id = self._player_id_from_name(nickname)
-        c.execute("DELETE FROM players_added WHERE player_id = ?", (player_id,))
-        for class_name in classes:
-            c.execute("INSERT INTO players_added (player_id, class) VALUES (?, ?)", (player_id, class_name))
-        self.can_pick()
+        self._mark_dirty(nickname)
+        super(SqliteBotBrain, self).player_set_added_classes(nickname, classes)
 
     def player_remove(self, nickname):
-        player_id = self._player_id_from_name(nickname)
-        c = self._get_cursor()
-        c.execute("DELETE FROM players_added WHERE player_id = ?", (player_id,))
-        self.can_pick()
+        if nickname not in self.roster:
+            return
+        self._mark_dirty(nickname)
+        super(SqliteBotBrain, self).player_remove(nickname)
+
+    def player_renamed(self, old_nick, new_nick):
+        if old_nick in self.roster:
+            self._mark_dirty(old_nick)
+            self._mark_dirty(new_nick)
+        return super(SqliteBotBrain, self).player_renamed(old_nick, new_nick)
+
+    def record_pick(self, teams):
+        now = self.clock.seconds()
+        self._count_pick(teams, now)
+        for later in self._rebuilds:
+            later.append((teams, now))
+        rows = [(nickname, cls) for team in teams.values() for nickname, cls in team.items()]
+        return self.db.run(self._write_pick, rows, now)
+
+    def _write_pick(self, rows, played_at):
+        with storage.transaction(self._conn):
+            c = self._get_cursor()
+            rows = [(self._player_id_from_name(nickname), cls) for nickname, cls in rows]
+            c.executemany("INSERT INTO player_pug_history (player_id, class, played_at) VALUES (?, ?, ?)", [
+                (player_id, cls, played_at) for player_id, cls in rows
+            ])
+            # The totals change along with the history, or not at all
+            c.executemany("INSERT OR IGNORE INTO player_class_stats (player_id, class, games) VALUES (?, ?, 0)", rows)
+            c.executemany("""
+            UPDATE player_class_stats SET games = games + 1, last_played = ? WHERE player_id = ? AND class = ?
+            """, [(played_at, player_id, cls) for player_id, cls in rows])
+            c.executemany("INSERT OR IGNORE INTO player_stats (player_id, games) VALUES (?, 0)",
+                          [(player_id,) for player_id, _ in rows])
+            c.executemany("UPDATE player_stats SET games = games + 1, last_played = ? WHERE player_id = ?",
+                          [(played_at, player_id) for player_id, _ in rows])
+
+    def rebuild_stats(self):
+        def rebuild():
+            storage.rebuild_stats(self._conn)
+            return self._read_stats(self._get_cursor())
+
+        # Picks recorded from now on are written after the rebuild reads
+        # the totals, so they're counted again on top of what it read
+        later = []
+        self._rebuilds.append(later)
+
+        def rebuilt(result):
+            self.experience, self.last_played = result
+            self.leaderboards = stats.Leaderboards(self.experience)
+            for teams, played_at in later:
+                self._count_pick(teams, played_at)
+
+        def done(result):
+            self._rebuilds.remove(later)
+            return result
+        return self.db.run(rebuild).addCallback(rebuilt).addBoth(done)
 
     def player_changed_name(self, old_nick, new_nick):
-        c = self._get_cursor()
-        c.execute("UPDATE OR IGNORE SET name = ? WHERE name = ?", (new_nick, old_nick))
+        d = self.db.run(self._rename, old_nick, new_nick)
+
+        def renamed(success):
+            if success:
+                self._history_renamed(old_nick, new_nick)
+            return success
+        return d.addCallback(renamed)
+
+    def _rename(self, old_nick, new_nick):
+        self._player_ids.pop(old_nick, None)
+        self._player_ids.pop(new_nick, None)
+        with storage.transaction(self._conn):
+            c = self._get_cursor()
+            c.execute("SELECT id FROM player WHERE name = ?", (old_nick,))
+            old_row = c.fetchone()
+            if old_row is None:
+                return False
+            c.execute("SELECT id FROM player WHERE name = ?", (new_nick,))
+            new_row = c.fetchone()
+            if new_row is not None:
+                c.execute("SELECT 1 FROM player_pug_history WHERE player_id = ? LIMIT 1", new_row)
+                if c.fetchone() is not None:
+                    return False
+                # new_nick has only ever added, so old_nick's row takes
+                # over its name and added classes
+                c.execute("""
+                DELETE FROM players_added WHERE player_id = ? AND class IN (
+                    SELECT class FROM players_added WHERE player_id = ?
+                )
+                """, (new_row[0], old_row[0]))
+                c.execute("UPDATE players_added SET player_id = ? WHERE player_id = ?", (old_row[0], new_row[0]))
+                c.execute("DELETE FROM player WHERE id = ?", new_row)
+            c.execute("UPDATE player SET name = ? WHERE id = ?", (new_nick, old_row[0]))
         return True
 
-    def players_added(self):
-        c = self._get_cursor()
-        c.execute("SELECT player_id FROM players_added")
-        rows = c.fetchall()
-        player_ids = [pid for (pid,) in rows]
-        players_by_id = self._player_names_from_ids(player_ids)
-        return sorted(players_by_id.values())
-
-    def players_by_class(self):
-        c = self._get_cursor()
-        c.execute("SELECT player_id FROM players_added")
-        rows = c.fetchall()
-        player_ids = [pid for (pid,) in rows]
-        players_by_id = self._player_names_from_ids(player_ids)
-
-        by_class = {}
-        for player_id, cls in c.execute("SELECT player_id, class FROM players_added"):
-            by_class.setdefault(cls, [])
-            by_class[cls].append(players_by_id[player_id])
-            by_class[cls].sort()
-
-        return by_class
-
-    def classes_by_player(self):
-        c = self._get_cursor()
-        c.execute("SELECT player_id FROM players_added")
-        rows = c.fetchall()
-        player_ids = [pid for (pid,) in rows]
-        players_by_id = self._player_names_from_ids(player_ids)
-
-        by_player = {}
-        for player_id, cls in c.execute("SELECT player_id, class FROM players_added"):
-            name = players_by_id[player_id]
-            by_player.setdefault(name, [])
-            by_player[name].append(cls)
-            by_player[name].sort(key=lambda cls: self.settings['rules']['valid classes'].index(cls))
-        return by_player
-
 
-def make_brain(settings):
+def make_brain(settings, server_pool=None, rcon=None):
     db_type = settings['database']['type']
 
     return {
         'sqlite': SqliteBotBrain,
-    }[db_type](settings)
+    }[db_type](settings, server_pool=server_pool, rcon=rcon)
@@ -0,0 +1,59 @@
+"""Logs what the bot sees in its channels, so it can be replayed later
+(see bench/replay.py).
+
+A capture log is appended to, a line per event as it happens:
+
+    <seconds since the epoch>\t<event>\t<argument>\t...
+
+with tabs, newlines, backslashes and unprintable characters in the
+arguments escaped. The events and their arguments are in EVENTS.
+"""
+
+from twisted.internet import reactor
+
+EVENTS = {
+    'command': ('user (nick!user@host)', 'channel (the nick, for PMs)', 'message'),
+    'join': ('user', 'channel'),
+    'part': ('user', 'channel'), # kicks too
+    'quit': ('user',),
+    'nick': ('old nick', 'new nick'),
+    'names': ('channel', 'nicks, space-separated'), # one line of a NAMES reply
+    'endnames': ('channel',),
+}
+
+def _escape(arg):
+    if isinstance(arg, unicode):
+        arg = arg.encode('utf-8')
+    return arg.encode('string_escape')
+
+class CaptureLog(object):
+    def __init__(self, filename, clock=None):
+        self.clock = reactor if clock is None else clock
+        # Line buffered, so a crash loses at most the line being written
+        self.file = open(filename, 'ab', 1)
+
+    def write(self, event, args):
+        self.file.write('%.3f\t%s\n' % (self.clock.seconds(), '\t'.join([event] + [_escape(arg) for arg in args])))
+
+    def close(self):
+        self.file.close()
+
+def read_log(filename):
+    """Yields (time, event, args) for each event in a capture log.
+
+    Lines that can't be read, like one cut short when the bot died, are
+    skipped.
+    """
+    with open(filename, 'rb') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                continue
+            fields = line[:-1].split('\t')
+            if len(fields) < 2 or fields[1] not in EVENTS or len(fields) - 2 != len(EVENTS[fields[1]]):
+                continue
+            try:
+                when = float(fields[0])
+                args = tuple(field.decode('string_escape') for field in fields[2:])
+            except ValueError:
+                continue
+            yield when, fields[1], args
@@ -1,82 +1,234 @@
+import math
+
+from twisted.internet import defer
+
+import metrics
+import notify
+from brain import DraftError
 from network import bot_command
+from serverpool import NoServerAvailable
 
-@bot_command('list')
-def player_list(bot, message):
+def _player_list_line(bot):
     return 'Players added: %s' % ', '.join(bot.brain.players_added())
 
+@bot_command('list', cached=True)
+def player_list(bot, message):
+    return _player_list_line(bot)
+
 @bot_command('add')
 def add(bot, message):
-    classes = [c for c in message.args if c in bot.rules['valid classes']]
+    classes = [c for c in message.args if c in bot.rules.class_bit]
     if not classes:
         return
     bot.brain.player_set_added_classes(message.from_nick, classes)
-    return player_list(bot, message)
+    # Not the cached !list, which would keep a copy per set of arguments
+    return _player_list_line(bot)
 
 @bot_command('remove')
 def remove(bot, message):
     bot.brain.player_remove(message.from_nick)
-    return player_list(bot, message)
+    return _player_list_line(bot)
 
-@bot_command('list-classes')
+@bot_command('list-classes', cached=True)
 def list_classes(bot, message):
-    valid_classes = bot.rules['valid classes']
+    valid_classes = bot.rules.valid_classes
     template = '%%%is: %%s' % (max(len(c) for c in valid_classes) + 1)
     added = bot.brain.players_by_class()
     for cls in valid_classes:
         yield template % (cls, ', '.join(added.get(cls, [])))
 
-@bot_command('can-pick?', 'can-pick', reply=True)
+@bot_command('can-pick?', 'can-pick', reply=True, cached=True)
 def can_pick(bot, message):
     return 'Yes' if bot.brain.can_pick() else 'No'
 
 @bot_command('pick')
 def pick(bot, message):
-    teams = {}
-    if not bot.brain.can_pick():
+    if bot.brain.draft is not None:
+        return 'Captains are already picking'
+    elif not bot.brain.can_pick():
         return "Picking can't start right now"
-    elif bot.rules['picking'] == 'random':
-        teams = bot.brain.random_pick()
-    else:
-        return 'Captain picking not implemented yet, sorry :('
+    elif bot.rules.picking == 'captain':
+        try:
+            server = bot.brain.get_server()
+        except NoServerAvailable as e:
+            return str(e)
+        return start_draft(bot, server)
+
+    games = bot.brain.pick_games()
+    servers = []
+    try:
+        for _ in games:
+            servers.append(bot.brain.get_server())
+    except NoServerAvailable as e:
+        if not servers:
+            return str(e)
+    d = finish_pick(bot, zip(games, servers))
+    # A server counted as free may have been taken since; whoever would
+    # have played on it stays added
+    leftover = len(games) - len(servers)
+    if leftover == 1:
+        d.addCallback(lambda lines: lines + ['No server was free for another game, so its players are still added'])
+    elif leftover:
+        d.addCallback(lambda lines: lines + [
+            'No server was free for %i more games, so their players are still added' % leftover,
+        ])
+    return d
+
+def finish_pick(bot, games):
+    """Records completed picks and sends everyone their connect info.
 
-    server = brain.get_server()
+    games: [({'team': {'player name': 'class'}}, server)]
+
+    Returns a Deferred that fires with the lines for the channel, once
+    every server has been set up. Players of every game get their info
+    together.
+    """
+    class_sort_key = bot.brain.roster.class_sort_key
     messages = []
-    team_colors = {'red': '4', 'blu': '2'}
-
-    for team_name, player_mapping in teams.items():
-        players = []
-        color = team_colors[team_name]
-        for player, cls in sorted(player_mapping.items(), key=lambda pair: (bot.rules['valid classes'].index(pair[1]), pair[0])):
-            bot.brain.player_remove(player)
-            players.append('%s as %s' % (player, cls))
-            bot.send_message_to_player(
-                player_name=player,
-                message="You have been picked for \x03%s%s\x03 as %s" % (color, team, cls),
-            )
-            bot.send_message_to_player(
-                player_name=player,
-                message="Connect info:  connect %s:%s; password %s" % (server['server'], server['port'], server['password']),
-            )
-            if 'mumble' in server:
-                channel = ''
-                channel_key = '%s channel' % team_name
-                if channel_key in mumble:
-                    channel = mumble[channel_key]
-                mumble_password = ''
-                if 'password' in server['mumble']:
-                    mumble_password = ':' + server['mumble']['password']
-                bot.send_message_to_player(
-                    player_name=player,
-                    message="Mumble info:   mumble://%s%s@%s:%s/%s" % (
-                        player, mumble_password,
-                        mumble['server'], mumble['port'],
-                        channel_key
-                    ),
-                )
-        messages.append('\x03%s%s Team\x03: %s' % (color, team_name.title(), ', '.join(players)))
-
-    return messages
-
-@bot_command('need')
+    player_messages = {}
+
+    def setup_failed(failure, teams, server):
+        configured = bot.brain.settings['servers'][server['name']].get('password', '')
+        player_messages.update(notify.player_messages(teams, dict(server, password=configured), class_sort_key))
+        messages.append("Couldn't set up %s (%s), so its password may be out of date" % (
+            server['name'], failure.getErrorMessage(),
+        ))
+
+    preparing = []
+    for teams, server in games:
+        bot.brain.record_pick(teams)
+        for team_name in ('red', 'blu'):
+            for player in teams[team_name]:
+                bot.brain.player_remove(player)
+            line = notify.team_line(team_name, teams[team_name], class_sort_key)
+            messages.append(line if len(games) == 1 else '%s: %s' % (server['name'], line))
+
+        # The connect info is only sent once the server has been set up
+        player_messages.update(notify.player_messages(teams, server, class_sort_key))
+        d = bot.brain.prepare_server(server)
+        d.addCallbacks(lambda responses: None, setup_failed, errbackArgs=(teams, server))
+        preparing.append(d)
+
+    def send(_):
+        delay = bot.notify_players(player_messages)
+        if delay is not None:
+            messages.append('Connect info is on its way to everyone by PM (about %i seconds)' % math.ceil(delay))
+        return messages
+
+    return defer.gatherResults(preparing).addCallback(send)
+
+def start_draft(bot, server):
+    draft = bot.brain.start_draft()
+    draft.server = server
+    lines = ['Captains: %s' % ' and '.join(
+        '%s for %s (as %s)' % (draft.captains[team], team.title(), draft.teams[team][draft.captains[team]])
+        for team in ('red', 'blu')
+    )]
+    return lines + next_turn(bot, draft)
+
+def next_turn(bot, draft):
+    """Lines telling the next captain what they can pick, after restarting the pick timer."""
+    if draft.timeout is not None and draft.timeout.active():
+        draft.timeout.cancel()
+    draft.timeout = bot.brain.clock.callLater(bot.rules.captain_time, draft_timed_out, bot, draft)
+    return notify.draft_lines(
+        draft.turn, draft.captains[draft.turn], draft.choices(),
+        bot.rules.classes_in, bot.channel,
+    )
+
+def after_draft_pick(bot, draft, lines):
+    if not draft.is_done():
+        return lines + next_turn(bot, draft)
+    teams = bot.brain.end_draft()
+    return finish_pick(bot, [(teams, draft.server)]).addCallback(lambda more: lines + more)
+
+def draft_timed_out(bot, draft):
+    draft.timeout = None
+    team = draft.turn
+    name, cls = draft.auto_pick(bot.brain.random)
+    lines = ['%s took too long, so %s goes to %s as %s' % (draft.captains[team], name, team.title(), cls)]
+    defer.maybeDeferred(after_draft_pick, bot, draft, lines).addCallback(bot.say)
+
+@bot_command('pick-player')
+def pick_player(bot, message):
+    draft = bot.brain.draft
+    if draft is None:
+        return 'Captains are not picking right now'
+    captain = draft.captains[draft.turn]
+    if message.from_nick != captain:
+        return "It's %s's turn to pick" % captain
+    if not message.args:
+        return 'Usage: !pick-player <name> <class>'
+
+    team = draft.turn
+    try:
+        draft.pick(message.args[0], message.args[1] if len(message.args) > 1 else None)
+    except DraftError as e:
+        return str(e)
+    name = message.args[0]
+    return after_draft_pick(bot, draft, ['%s picked %s as %s' % (captain, name, draft.teams[team][name])])
+
+@bot_command('captain')
+def captain(bot, message):
+    draft = bot.brain.draft
+    if draft is not None:
+        return notify.draft_lines(
+            draft.turn, draft.captains[draft.turn], draft.choices(),
+            bot.rules.classes_in, bot.channel,
+        )
+    if message.from_nick not in bot.brain.roster:
+        return '%s: add yourself first' % message.from_nick
+    if bot.brain.volunteer_captain(message.from_nick):
+        return '%s wants to be a captain' % message.from_nick
+    return '%s no longer wants to be a captain' % message.from_nick
+
+@bot_command('need', cached=True)
 def need(bot, message):
     return bot.brain.classes_needed()
+
+def time_ago(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        count, unit = minutes, 'minute'
+    elif minutes < 48*60:
+        count, unit = minutes // 60, 'hour'
+    else:
+        count, unit = minutes // (24*60), 'day'
+    return '%i %s%s ago' % (count, unit, '' if count == 1 else 's')
+
+@bot_command('stats')
+def stats(bot, message):
+    # With a nick, their PUGs; on its own, the bot's metrics for admins
+    # and your own PUGs for everyone else
+    if not message.args and bot.is_admin(message.from_mask):
+        if not metrics.registry.enabled:
+            return 'Metrics are disabled (see metrics -> enabled)'
+        return metrics.registry.summary()
+
+    nick = message.args[0] if message.args else message.from_nick
+    played = bot.brain.player_stats(nick)
+    if played is None:
+        return "%s hasn't played any PUGs" % nick
+    line = '%s has played %i PUG%s' % (nick, played['games'], '' if played['games'] == 1 else 's')
+    if played['last played'] is not None:
+        line += ', the last %s' % time_ago(bot.brain.clock.seconds() - played['last played'])
+    classes = sorted(played['classes'].items(), key=lambda item: (-item[1], bot.rules.class_sort_key(item[0])))
+    return '%s: %s' % (line, ', '.join('%s %i' % (cls, games) for cls, games in classes))
+
+@bot_command('top')
+def top(bot, message):
+    cls = message.args[0].lower() if message.args else None
+    if cls is not None and cls not in bot.rules.class_bit:
+        return 'Not a class: %s' % message.args[0]
+    players = bot.brain.top_players(cls)
+    if not players:
+        return 'Nobody has played yet'
+    title = 'Most PUGs' if cls is None else 'Most PUGs as %s' % cls
+    return '%s: %s' % (title, ', '.join('%s %i' % player for player in players))
+
+@bot_command('rebuild-stats')
+def rebuild_stats(bot, message):
+    if not bot.is_admin(message.from_mask):
+        return
+    d = bot.brain.rebuild_stats()
+    return d.addCallback(lambda _: 'Stats recounted from the PUG history')
@@ -0,0 +1,156 @@
+class SlotMatcher(object):
+    """Keeps a maximum assignment of added players to class slots.
+
+    Every class has two slots per point of its class limit (one set for
+    each team) in each of `games` games. The assignment is kept between
+    calls and repaired with augmenting paths whenever a single player
+    changes, so a pick is possible exactly when every slot is filled.
+
+    An augmenting path never leaves an assigned player without a slot,
+    so when players are added one at a time, whoever was added earlier
+    keeps their place over later players whenever both can't fit.
+    """
+    def __init__(self, roster, rules, games=1):
+        self.roster = roster
+        self.rules = rules
+        self.slots = dict((cls, 2*limit*games) for cls, limit in rules.class_limits.items())
+        self.total_slots = sum(self.slots.values())
+        self._assigned = {}
+        self._filled = dict((cls, set()) for cls in self.slots)
+
+    def __len__(self):
+        return len(self._assigned)
+
+    def is_complete(self):
+        return len(self._assigned) == self.total_slots
+
+    def needed_classes(self):
+        """Classes with open slots, sorted like the valid classes.
+
+        Since the assignment is maximal, one more player for each of
+        these classes is the fewest that would make picking possible.
+        """
+        return [
+            cls for cls in self.rules.classes_in(self.rules.pickable)
+            if len(self._filled[cls]) < self.slots[cls]
+        ]
+
+    def legal_moves(self):
+        """Returns {'player name': class bitmask} of every class each
+        player could be given with all the other slots still fillable.
+
+        Only meaningful when the assignment is complete. An unassigned
+        player can take any open class they play, bumping whoever had
+        it. An assigned player can move to another class if the slot
+        they leave can be refilled through a chain of players moving
+        along, ending with either an unassigned player or the one they
+        bumped.
+        """
+        bit = self.rules.class_bit
+        masks = self.roster.masks()
+        open_mask = self.rules.mask(cls for cls, slots in self.slots.items() if slots > 0)
+        # Classes some unassigned player could fill
+        free_mask = 0
+        moves = {}
+        for name, mask in masks.items():
+            if name not in self._assigned:
+                free_mask |= mask
+                moves[name] = mask & open_mask
+
+        for name, current in self._assigned.items():
+            # Every class the slot name leaves could be refilled from
+            reach = bit[current]
+            frontier = [current]
+            while frontier:
+                cls = frontier.pop()
+                for other in self.roster.players_of(cls):
+                    other_class = self._assigned.get(other)
+                    if other != name and other_class is not None and not reach & bit[other_class]:
+                        reach |= bit[other_class]
+                        frontier.append(other_class)
+
+            if free_mask & reach:
+                allowed = open_mask
+            else:
+                allowed = bit[current]
+                for cls, players in self._filled.items():
+                    if cls != current and any(other != name and masks[other] & reach for other in players):
+                        allowed |= bit[cls]
+            moves[name] = masks[name] & allowed
+        return moves
+
+    def remove_slot(self, cls):
+        """Takes away one of cls's slots, repairing the assignment."""
+        self.slots[cls] -= 1
+        self.total_slots -= 1
+        if len(self._filled[cls]) > self.slots[cls]:
+            name = min(self._filled[cls])
+            self._unassign(name)
+            self._place(name, set())
+
+    def assignment(self):
+        """Returns {'player name': 'class'} for every filled slot."""
+        return dict(self._assigned)
+
+    def player_changed(self, name):
+        """Repair the assignment after name's classes changed.
+
+        Call this after every change to the roster, with one player
+        changed at a time.
+        """
+        old_class = self._unassign(name)
+        if old_class is not None:
+            self._fill(old_class, set(), skip=name)
+        if self.roster.mask_of(name) & self.rules.pickable:
+            self._place(name, set())
+
+    def _assign(self, name, cls):
+        self._unassign(name)
+        self._assigned[name] = cls
+        self._filled[cls].add(name)
+
+    def _unassign(self, name):
+        cls = self._assigned.pop(name, None)
+        if cls is not None:
+            self._filled[cls].discard(name)
+        return cls
+
+    def _has_room(self, cls):
+        return len(self._filled[cls]) < self.slots[cls]
+
+    def _place(self, name, visited):
+        """Find a slot for name, moving other players along if needed."""
+        current = self._assigned.get(name)
+        mask = self.roster.mask_of(name) & self.rules.pickable & ~self.rules.class_bit.get(current, 0)
+        classes = self.rules.classes_in(mask)
+        for cls in classes:
+            if self._has_room(cls):
+                self._assign(name, cls)
+                return True
+        for cls in classes:
+            if cls in visited:
+                continue
+            visited.add(cls)
+            for other in list(self._filled[cls]):
+                if self._place(other, visited):
+                    self._assign(name, cls)
+                    return True
+        return False
+
+    def _fill(self, cls, visited, skip=None):
+        """Find a player for an open slot of cls, moving players along if needed."""
+        visited.add(cls)
+        candidates = self.roster.players_of(cls)
+        for name in candidates:
+            if name not in self._assigned and name != skip:
+                self._assign(name, cls)
+                return True
+        for name in list(candidates):
+            current = self._assigned.get(name)
+            if current is None or current == cls or current in visited:
+                continue
+            if self._fill(current, visited, skip):
+                # Someone else took name's old slot; name moves over
+                self._assign(name, cls)
+                return True
+        return False
@@ -0,0 +1,102 @@
+"""The front of the command path: splitting command lines into words,
+and deciding which commands to ignore so that a few people sending
+lots of them can't use up the bot's outbound capacity.
+"""
+
+import re
+
+import metrics
+from outbound import TokenBucket
+
+# A quoted word, or anything else up to the next space. A quote without
+# a partner is just part of a word.
+_WORD = re.compile(r'"([^"]*)"(?=\s|$)|\'([^\']*)\'(?=\s|$)|(\S+)')
+
+def tokenize(line):
+    """Splits line into words, like the shell would for simple input:
+    words are separated by whitespace, and quotes group words together.
+    Never fails, whatever line is."""
+    return [double or single or bare for double, single, bare in _WORD.findall(line)]
+
+# What FloodControl.check says to do with a command
+ALLOW, DROP, WARN = range(3)
+
+class Sender(object):
+    def __init__(self, limits, clock):
+        self.limits = limits
+        self.clock = clock
+        self.bucket = TokenBucket(limits['commands per minute']/60.0, limits['command burst'], clock)
+        self.buckets = {}
+        self.last_lines = {}
+        self.warned = False
+        self.seen = clock.seconds()
+
+    def command_bucket(self, command):
+        bucket = self.buckets.get(command)
+        if bucket is None:
+            limits = self.limits
+            bucket = self.buckets[command] = TokenBucket(
+                limits['same command per minute']/60.0, limits['same command burst'], self.clock)
+        return bucket
+
+class FloodControl(object):
+    """Rate limits commands per nick, and per nick and command, with
+    token buckets (see settings -> flood control).
+
+    A command repeated word for word by the same nick to the same place
+    within `duplicate window` seconds is dropped without using up any
+    tokens. Commands over the limit are dropped too, and the first one
+    each time a nick goes over gets them a warning if `warn` is set.
+    Nicks that have gone quiet are forgotten now and then.
+    """
+    def __init__(self, limits, clock):
+        self.limits = limits
+        self.clock = clock
+        self.senders = {}
+        # Long enough for every bucket to fill up again
+        self.forget_after = max(
+            limits['command burst']*60.0/limits['commands per minute'],
+            limits['same command burst']*60.0/limits['same command per minute'],
+            limits['duplicate window'],
+        )
+        self._next_cleanup = clock.seconds() + self.forget_after
+
+    def check(self, nick, channel, command, words):
+        """Returns ALLOW, DROP or WARN (drop, after warning nick) for
+        command from nick to channel, with arguments words."""
+        now = self.clock.seconds()
+        if now >= self._next_cleanup:
+            self._forget(now)
+
+        sender = self.senders.get(nick)
+        if sender is None:
+            sender = self.senders[nick] = Sender(self.limits, self.clock)
+        sender.seen = now
+
+        line = (channel.lower(), command, tuple(words))
+        if now - sender.last_lines.get(line, float('-inf')) < self.limits['duplicate window']:
+            metrics.registry.increment('commands_dropped_total', reason='duplicate')
+            return DROP
+        sender.last_lines[line] = now
+
+        command_bucket = sender.command_bucket(command)
+        if sender.bucket.available() < 1 or command_bucket.available() < 1:
+            metrics.registry.increment('commands_dropped_total', reason='flood')
+            if self.limits['warn'] and not sender.warned:
+                sender.warned = True
+                return WARN
+            return DROP
+        sender.bucket.take()
+        command_bucket.take()
+        sender.warned = False
+        return ALLOW
+
+    def _forget(self, now):
+        self._next_cleanup = now + self.forget_after
+        for nick, sender in self.senders.items():
+            if now - sender.seen >= self.forget_after:
+                del self.senders[nick]
+            else:
+                for line, when in sender.last_lines.items():
+                    if now - when >= self.limits['duplicate window']:
+                        del sender.last_lines[line]
@@ -0,0 +1,255 @@
+"""Keeps the bot's IRC connections (messengers) up, as many as the load needs.
+
+Every name in network -> bot names is a slot, which is idle, waiting to
+connect, connecting or connected. Connection attempts are spaced at
+least `reconnect time` apart, however many slots want one, so that the
+server's connect throttle never kicks in.
+
+A connected messenger is pinged every `ping interval` seconds, and one
+that doesn't answer within `ping timeout` (or never finishes signing
+on) is disconnected, and so is one that fails to send `max send errors`
+messages without answering a ping in between. A slot whose connection
+fails or is lost connects again after a delay that doubles with every
+failure in a row, up to `max reconnect delay`, and a messenger that had
+to sign on under another nick takes its own back as soon as it's free.
+
+Slots beyond `min bots` connect when the outbound queue would take more
+than `scale up backlog` seconds to send, one at a time, and disconnect
+again after `scale down after` seconds with nothing queued.
+"""
+
+import collections
+import itertools
+
+from twisted.internet import reactor, task
+
+import metrics
+import outbound
+
+# What a slot is doing
+IDLE, WAITING, CONNECTING, CONNECTED = range(4)
+
+# Seconds between checks on the messengers and the outbound queue
+CHECK_INTERVAL = 1.0
+
+class Slot(object):
+    def __init__(self, name):
+        self.name = name
+        self.state = IDLE
+        self.messenger = None
+        self.failures = 0
+        self.attempt = None
+        self.since = None
+        self.retry = None
+        self.ping_sent = None
+        self.last_pong = None
+        # Messages that failed to send since the last pong
+        self.send_errors = 0
+
+class MessengerPool(object):
+    """The factory's messengers, connected through factory.connect(name),
+    which returns a Deferred that fires with an IRCMessenger once it's
+    connected (before it signs on)."""
+    def __init__(self, factory, network_settings, clock=None):
+        self.factory = factory
+        self.clock = reactor if clock is None else clock
+        self.slots = collections.OrderedDict((name, Slot(name)) for name in network_settings['bot names'])
+        self.min_bots = max(1, min(network_settings['min bots'], len(self.slots)))
+        self.spacing = network_settings['reconnect time']
+        self.max_delay = network_settings['max reconnect delay']
+        self.ping_interval = network_settings['ping interval']
+        self.ping_timeout = network_settings['ping timeout']
+        self.max_send_errors = network_settings['max send errors']
+        self.scale_up_backlog = network_settings['scale up backlog']
+        self.scale_down_after = network_settings['scale down after']
+        self._ping_ids = itertools.count(1)
+        self._attempts = itertools.count(1)
+        self._queue = collections.deque()
+        self._last_attempt = None
+        self._connect_call = None
+        self._idle_since = None
+        self._loop = None
+        metrics.registry.gauge('messengers_connected', lambda: self.count(CONNECTED))
+
+    def count(self, *states):
+        return sum(1 for slot in self.slots.itervalues() if slot.state in states)
+
+    def start(self):
+        for slot in self.slots.values()[:self.min_bots]:
+            self._wait(slot, 0)
+        self._loop = task.LoopingCall(self.check)
+        self._loop.clock = self.clock
+        self._loop.start(CHECK_INTERVAL, now=False)
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        for slot in self.slots.values():
+            self._retire(slot, 'Shutting down')
+
+    # Connecting
+    def _wait(self, slot, delay):
+        """Queues slot to connect after delay seconds."""
+        slot.state = WAITING
+        slot.retry = self.clock.callLater(delay, self._enqueue, slot)
+
+    def _enqueue(self, slot):
+        slot.retry = None
+        if slot.state == WAITING:
+            self._queue.append(slot)
+            self._schedule()
+
+    def _schedule(self):
+        if not self._queue or (self._connect_call is not None and self._connect_call.active()):
+            return
+        delay = 0
+        if self._last_attempt is not None:
+            delay = max(0, self._last_attempt + self.spacing - self.clock.seconds())
+        self._connect_call = self.clock.callLater(delay, self._connect_next)
+
+    def _connect_next(self):
+        self._connect_call = None
+        slot = self._queue.popleft()
+        if slot.state != WAITING:
+            return self._schedule()
+        self._last_attempt = self.clock.seconds()
+        slot.state = CONNECTING
+        slot.since = self._last_attempt
+        slot.attempt = attempt = next(self._attempts)
+        d = self.factory.connect(slot.name)
+        d.addCallbacks(self._connected, self._failed, callbackArgs=(slot, attempt), errbackArgs=(slot, attempt))
+        self._schedule()
+
+    def _connected(self, messenger, slot, attempt):
+        if slot.state != CONNECTING or slot.attempt != attempt:
+            # Given up on or retired while connecting
+            messenger.transport.loseConnection()
+            return
+        slot.messenger = messenger
+
+    def _failed(self, failure, slot, attempt):
+        if slot.state == CONNECTING and slot.attempt == attempt:
+            print 'Bot %s failed to connect: %s' % (slot.name, failure.getErrorMessage())
+            self._backoff(slot)
+
+    def _backoff(self, slot):
+        slot.messenger = None
+        slot.failures += 1
+        metrics.registry.increment('messenger_failures_total', messenger=slot.name)
+        delay = min(self.max_delay, self.spacing*2**(slot.failures - 1))
+        print 'Reconnecting %s in %g seconds...' % (slot.name, delay)
+        self._wait(slot, delay)
+
+    # Called by the factory as messengers come and go
+    def signed_on(self, messenger):
+        """Returns False if messenger isn't wanted any more."""
+        slot = self.slots.get(messenger.name)
+        if slot is None or slot.state != CONNECTING or slot.messenger is not messenger:
+            return False
+        slot.state = CONNECTED
+        slot.since = self.clock.seconds()
+        slot.ping_sent = None
+        slot.last_pong = slot.since
+        slot.send_errors = 0
+        return True
+
+    def lost(self, messenger):
+        slot = self.slots.get(messenger.name)
+        if slot is None or slot.messenger is not messenger:
+            return
+        if slot.state in (CONNECTING, CONNECTED):
+            self._backoff(slot)
+        else:
+            slot.messenger = None
+
+    def ponged(self, messenger):
+        slot = self.slots[messenger.name]
+        if slot.messenger is not messenger or slot.ping_sent is None:
+            return
+        now = self.clock.seconds()
+        metrics.registry.observe('messenger_ping_seconds', now - slot.ping_sent, messenger=slot.name)
+        slot.ping_sent = None
+        slot.last_pong = now
+        # The connection has proven itself
+        slot.failures = 0
+        slot.send_errors = 0
+
+    def send_failed(self, messenger, failure):
+        """Takes a message that messenger failed to send. Past max send
+        errors, it stops being sent through and is reconnected."""
+        slot = self.slots.get(messenger.name)
+        if slot is None or slot.messenger is not messenger or slot.state != CONNECTED:
+            self.factory.transport_lost(messenger)
+            return
+        slot.send_errors += 1
+        metrics.registry.increment('messenger_send_errors_total', messenger=slot.name)
+        if slot.send_errors >= self.max_send_errors:
+            print 'Bot %s failed to send %i messages: %s' % (slot.name, slot.send_errors, failure.getErrorMessage())
+            self.factory.transport_lost(messenger)
+            self._drop(slot)
+
+    # Health and scaling
+    def check(self):
+        now = self.clock.seconds()
+        for slot in self.slots.values():
+            if slot.state == CONNECTING and now - slot.since > self.ping_timeout:
+                print 'Bot %s took too long to sign on' % slot.name
+                self._drop(slot)
+            elif slot.state == CONNECTED:
+                messenger = slot.messenger
+                if slot.ping_sent is not None:
+                    if now - slot.ping_sent > self.ping_timeout:
+                        print 'Bot %s stopped answering pings' % slot.name
+                        self._drop(slot)
+                elif now - slot.last_pong >= self.ping_interval:
+                    slot.ping_sent = now
+                    messenger.sendLine('PING :mixbot%d' % next(self._ping_ids))
+                    messenger.reclaim_nick()
+        self._scale(now)
+
+    def _drop(self, slot):
+        """Gives up on slot's connection; losing it sets off a reconnect."""
+        messenger = slot.messenger
+        if messenger is None or not messenger.connected:
+            self._backoff(slot)
+        else:
+            messenger.transport.abortConnection()
+
+    def _scale(self, now):
+        backlog = self.factory.outbound.estimate_delay(outbound.NOTICE)
+        if backlog is not None and backlog > self.scale_up_backlog:
+            self._idle_since = None
+            # One at a time, so each gets to help before the next is needed
+            if not self.count(WAITING, CONNECTING):
+                for slot in self.slots.itervalues():
+                    if slot.state == IDLE:
+                        print 'Connecting %s to keep up with the outbound queue' % slot.name
+                        self._wait(slot, 0)
+                        break
+        elif len(self.factory.outbound):
+            self._idle_since = None
+        elif self._idle_since is None:
+            self._idle_since = now
+        elif now - self._idle_since >= self.scale_down_after and self.count(CONNECTED) > self.min_bots:
+            self._idle_since = now
+            # The most recently connected one that isn't dispatching
+            spare = [
+                slot for slot in self.slots.itervalues()
+                if slot.state == CONNECTED and not slot.messenger.should_dispatch
+            ]
+            if spare:
+                slot = max(spare, key=lambda slot: slot.since)
+                print 'Disconnecting %s, since the outbound queue is quiet' % slot.name
+                self._retire(slot, 'Not needed right now')
+
+    def _retire(self, slot, reason):
+        """Disconnects slot for good (until it's needed again)."""
+        if slot.retry is not None and slot.retry.active():
+            slot.retry.cancel()
+        slot.retry = None
+        state, slot.state = slot.state, IDLE
+        messenger = slot.messenger
+        if messenger is not None and state in (CONNECTING, CONNECTED):
+            self.factory.transport_lost(messenger)
+            if messenger.connected:
+                messenger.quit(reason)
@@ -0,0 +1,150 @@
+import bisect
+import collections
+import timeit
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+timer = timeit.default_timer
+
+class Histogram(object):
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    BUCKET_NAMES = [repr(b) for b in BUCKETS] + ['+Inf']
+
+    def __init__(self):
+        self.counts = [0]*(len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        wanted = q*self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return float('inf')
+
+class Registry(object):
+    """Counters, histograms and gauges, keyed by name and labels.
+
+    Nothing is recorded unless `enabled` is set, and callers that need to
+    do work to produce a value (like timing something) should check it
+    first, so the instrumentation costs next to nothing when disabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.started = timer()
+        self.counters = collections.defaultdict(float)
+        self.histograms = collections.defaultdict(Histogram)
+        self.gauges = {}
+
+    def increment(self, name, amount=1, **labels):
+        if self.enabled:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            self.histograms[(name, tuple(sorted(labels.items())))].observe(value)
+
+    def gauge(self, name, function):
+        """Registers function to be called for name's current value when read."""
+        self.gauges[name] = function
+
+    def prometheus_text(self):
+        lines = []
+
+        def render_labels(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append('mixbot_%s%s %s' % (name, render_labels(labels), value))
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(Histogram.BUCKET_NAMES, histogram.counts):
+                cumulative += count
+                lines.append('mixbot_%s_bucket%s %i' % (name, render_labels(labels, [('le', bound)]), cumulative))
+            lines.append('mixbot_%s_sum%s %s' % (name, render_labels(labels), histogram.sum))
+            lines.append('mixbot_%s_count%s %i' % (name, render_labels(labels), histogram.count))
+        for name, function in sorted(self.gauges.items()):
+            lines.append('mixbot_%s %s' % (name, function()))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """A few short lines for the !stats command."""
+        lines = []
+        commands = [(dict(labels)['command'], h) for (name, labels), h in sorted(self.histograms.items())
+                    if name == 'command_seconds']
+        if commands:
+            lines.append('Commands: ' + ', '.join(
+                '!%s %i (avg %.1fms, p99 <%gms)' % (command, h.count, 1000*h.sum/h.count, 1000*h.quantile(0.99))
+                for command, h in commands
+            ))
+        queries = [h for (name, _), h in self.histograms.items() if name == 'sqlite_query_seconds']
+        if queries:
+            count = sum(h.count for h in queries)
+            lines.append('SQLite: %i queries, avg %.2fms' % (count, 1000*sum(h.sum for h in queries)/count))
+        if self.gauges:
+            lines.append('Outbound: ' + ', '.join(
+                '%s %s' % (name.replace('outbound_', '').replace('_', ' '), function())
+                for name, function in sorted(self.gauges.items())
+            ))
+        minutes = max(timer() - self.started, 1)/60.0
+        sent = [(dict(labels)['transport'], count) for (name, labels), count in sorted(self.counters.items())
+                if name == 'messages_sent_total']
+        if sent:
+            lines.append('Sent: ' + ', '.join(
+                '%s %i (%.1f/min)' % (transport, count, count/minutes) for transport, count in sent
+            ))
+        return lines or ['No stats collected yet']
+
+registry = Registry()
+
+class TimedCursor(object):
+    """Wraps a sqlite3 cursor to time every statement it runs."""
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _timed(self, method, sql, *args):
+        start = timer()
+        try:
+            method(sql, *args)
+        finally:
+            registry.observe('sqlite_query_seconds', timer() - start, statement=sql.split(None, 1)[0].upper())
+        return self
+
+    def execute(self, sql, *args):
+        return self._timed(self._cursor.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._timed(self._cursor.executemany, sql, *args)
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.metrics.prometheus_text()
+
+def serve(port, metrics=registry):
+    """Serves metrics in Prometheus text format on localhost:port."""
+    return reactor.listenTCP(port, server.Site(MetricsResource(metrics)), interface='127.0.0.1')
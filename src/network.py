@@ -1,59 +1,155 @@
 import functools
-import shlex
+import re
 from twisted.words.protocols import irc
-from twisted.internet import reactor, protocol
+from twisted.internet import defer, error, reactor, protocol
 
 import brain
-
-__all__ = ['bot_command', 'run_bot_with_settings']
+import capture
+import inbound
+import metrics
+import notify
+import outbound
+import presence
+from messengerpool import MessengerPool
+from rcon import RCONPool
+from serverpool import ServerPool
+
+__all__ = ['bot_command', 'run_bot_with_settings', 'start_bot_with_settings']
 
 COMMANDS = {}
 
 def bot_command(*names, **options):
+    """Registers a command handler under each of names.
+
+    Handlers return a line, a list (or generator) of lines, or a
+    Deferred that fires with either.
+
+    Options:
+      reply: prefix each line of output with the sender's nick
+      cached: the output depends only on the arguments and the roster,
+        so reuse it until the roster changes
+    """
     def decorator(cmd):
+        # Every channel has a roster, and so a cache, of its own
+        caches = {}
+
+        def run(bot, message):
+            if not options.get('cached', False):
+                return cmd(bot, message)
+            cache = caches.setdefault(bot, {'version': None, 'results': {}})
+            version = bot.brain.roster_version()
+            if cache['version'] != version:
+                cache['version'] = version
+                cache['results'] = {}
+            key = tuple(message.args)
+            if key not in cache['results']:
+                cache['results'][key] = list(_as_lines(cmd(bot, message)))
+            return cache['results'][key]
+
         @functools.wraps(cmd)
         def inner(bot, message):
-            result = cmd(bot, message)
+            start = metrics.timer() if metrics.registry.enabled else None
+
+            def finish(result):
+                result = _as_lines(result)
+                if start is not None:
+                    result = list(result)
+                    metrics.registry.observe('command_seconds', metrics.timer() - start, command=names[0])
 
-            if isinstance(result, basestring):
-                result = [result]
-            elif result is None:
-                result = []
-            elif not hasattr(result, '__iter__'):
-                result = [result]
+                if options.get('reply', False):
+                    result = ('%s: %s' % (message.from_nick, r) for r in result)
 
-            if options.get('reply', False):
-                result = ('%s: %s' % (message.from_nick, r) for r in result)
+                return result
 
-            return result
+            result = run(bot, message)
+            if isinstance(result, defer.Deferred):
+                return result.addCallback(finish)
+            return finish(result)
 
         for name in names:
-            COMMANDS[name] = {'handler': inner, 'options': options}
+            # Commands are matched case-insensitively
+            COMMANDS[name.lower()] = {'name': names[0], 'handler': inner, 'options': options}
         return inner
     return decorator
 
+def _mask_pattern(masks):
+    """Compiles IRC-style nick!user@host masks, where * matches any run
+    of characters and ? any one, into one case-insensitive regex."""
+    patterns = [''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in mask) for mask in masks]
+    return re.compile('(?:%s)\\Z' % ('|'.join(patterns) or '(?!)'), re.IGNORECASE)
+
+def _as_lines(result):
+    if isinstance(result, basestring):
+        return [result]
+    elif result is None:
+        return []
+    elif not hasattr(result, '__iter__'):
+        return [result]
+    return result
+
 class Bot(object):
-    def __init__(self, my_brain, rules, dispatcher):
+    """One channel the bot serves, with its own brain, rules and members.
+
+    It is also what the brain and the channel's presence tracking send
+    messages through, so that they go to (and are counted against) the
+    right channel.
+    """
+    def __init__(self, channel, my_brain, settings, dispatcher):
+        self.channel = channel
         self.brain = my_brain
-        self.rules = rules
+        self.settings = settings
+        self.rules = settings['rules']
         self._dispatcher = dispatcher
+        self.presence = presence.Presence(my_brain, settings['network']['departure grace'], dispatcher.clock)
+        self._admins = _mask_pattern(settings['network']['admins'])
+
+    def is_admin(self, mask):
+        """Whether mask (nick!user@host) matches one of network -> admins."""
+        return self._admins.match(mask) is not None
+
+    def queue_message(self, message, channel=None, priority=outbound.REPLY):
+        """Queues message to channel (by default this one) on this channel's behalf."""
+        self._dispatcher.queue_message(message, channel or self.channel, priority=priority, tenant=self.channel)
+
+    def say(self, lines):
+        """Sends lines to the channel, for output that isn't a reply to a command."""
+        for line in _as_lines(lines):
+            self.queue_message(line)
 
     def send_message_to_player(self, player_name, message):
-        self._dispatcher.queue_message(message, player_name)
+        self.queue_message(message, player_name, priority=outbound.NOTIFY)
+
+    def notify_players(self, messages):
+        """Sends {'player name': [lines]}, to several players at once where possible.
+
+        Returns the expected number of seconds until they are all sent,
+        or None if that can't be known yet.
+        """
+        for targets, line in notify.group_messages(messages, self._dispatcher.max_targets()):
+            self.queue_message(line, ','.join(targets), priority=outbound.NOTIFY)
+        return self._dispatcher.outbound.estimate_delay(outbound.NOTIFY, tenant=self.channel)
 
 class Message(object):
-    def __init__(self, args, from_nick, is_pm):
+    def __init__(self, args, from_nick, is_pm, from_mask=None):
         # args[0] is the command name (without prefix), and args[1:] is the rest
         self.args = args
         self.from_nick = from_nick
+        # nick!user@host, for checking who's an admin
+        self.from_mask = from_nick if from_mask is None else from_mask
         self.is_pm = bool(is_pm)
 
 class IRCMessenger(irc.IRCClient, object):
-    def __init__(self, factory, *args, **kwargs):
+    # The messenger pool does the pinging
+    heartbeatInterval = None
+
+    def __init__(self, factory, name, *args, **kwargs):
         super(IRCMessenger, self).__init__(*args, **kwargs)
         self.factory = factory
         self.should_dispatch = False
-        self.nickname = 'TF2Bot'
+        # The bot name this messenger connects as, which it goes back to
+        # if it had to sign on as something else
+        self.name = name
+        self.nickname = name
 
     def __repr__(self):
         return 'IRCMessenger(nickname=%r)' % self.nickname
@@ -66,126 +162,287 @@ class IRCMessenger(irc.IRCClient, object):
         if isinstance(message, unicode):
             message = message.encode('utf-8')
 
-        if channel == self.nickname:
-            # No need to queue these
-            self.msg(channel, message)
-
-        # self.queue.append(message)
+        if self.transport is None or self.transport.disconnecting:
+            # Writes would vanish without a trace
+            raise error.ConnectionLost('%s is no longer connected' % self.nickname)
         self.msg(channel, message)
 
+    def max_targets(self):
+        """How many targets the server accepts in one PRIVMSG, if it says."""
+        targmax = self.supported.getFeature('TARGMAX') or {}
+        if 'PRIVMSG' in targmax:
+            return targmax['PRIVMSG']
+        maxtargets = self.supported.getFeature('MAXTARGETS')
+        if maxtargets:
+            return int(maxtargets[0])
+        return None
+
     def signedOn(self):
-        self.factory.transport_connected(self)
-        self.join(self.factory.settings['network']['channel'])
+        if not self.factory.transport_connected(self):
+            return
+        for bot in self.factory.bots:
+            self.join(bot.channel)
+
+    def connectionLost(self, reason):
+        super(IRCMessenger, self).connectionLost(reason)
+        self.factory.transport_lost(self)
+        self.factory.pool.lost(self)
+
+    def irc_PONG(self, prefix, params):
+        self.factory.pool.ponged(self)
+
+    def reclaim_nick(self):
+        """Asks for the bot name back, if this messenger doesn't have it."""
+        if self._registered and self.nickname != self.name:
+            self.setNick(self.name)
+
+    def irc_ERR_NICKNAMEINUSE(self, prefix, params):
+        # Once signed on, keep the nick we have until ours is free
+        if not self._registered:
+            super(IRCMessenger, self).irc_ERR_NICKNAMEINUSE(prefix, params)
 
     def joined(self, channel):
         print '%s Joined %s' % (self.nickname, channel)
 
+    # Only the messenger that dispatches commands passes on what happens
+    # in the channels, so each change is only seen once.
+    def irc_RPL_NAMREPLY(self, prefix, params):
+        if self.should_dispatch:
+            self.factory.received('names', params[2], params[3])
+
+    def irc_RPL_ENDOFNAMES(self, prefix, params):
+        if self.should_dispatch:
+            self.factory.received('endnames', params[1])
+
+    def userJoined(self, user, channel):
+        if self.should_dispatch:
+            self.factory.received('join', user, channel)
+
+    def userLeft(self, user, channel):
+        if self.should_dispatch:
+            self.factory.received('part', user, channel)
+
+    def userKicked(self, kickee, channel, kicker, message):
+        if self.should_dispatch:
+            self.factory.received('part', kickee, channel)
+
+    def userQuit(self, user, quitMessage):
+        if user == self.name:
+            self.reclaim_nick()
+        if self.should_dispatch:
+            self.factory.received('quit', user)
+
+    def userRenamed(self, oldname, newname):
+        if oldname == self.name:
+            self.reclaim_nick()
+        if self.should_dispatch:
+            self.factory.received('nick', oldname, newname)
+
     def privmsg(self, user, channel, msg):
         if not self.should_dispatch:
             return
 
-        user = user.split('!', 1)[0]
+        # The whole nick!user@host goes along, for admin commands
+        nick = user.split('!', 1)[0]
         is_pm = channel == self.nickname
 
         if is_pm:
-            channel = user
+            channel = nick
 
         if not msg or not msg.startswith('!'):
             return
 
-        self.factory.dispatch(user, channel, msg)
+        self.factory.received('command', user, channel, msg)
+
+class IRCBotFactory(object):
+    """Every channel the bot serves, over one shared set of messengers
+    (see MessengerPool).
 
-class IRCBotFactory(protocol.ClientFactory):
-    def __init__(self, settings, my_brain):
+    brains: [('#channel', brain)], the first being where PMs go unless
+    they name another channel first (like "!add #channel scout").
+    """
+    def __init__(self, settings, brains, clock=None, started=None):
         self.settings = settings
-        self.brain = my_brain
-        self.bot = Bot(my_brain, rules=settings['rules'])
-        self.message_queue = []
-        self.transports = []
-        self.schedule_send_messages()
+        self.clock = reactor if clock is None else clock
+        # When the bot started, to time how long until it takes commands
+        self.started = self.clock.seconds() if started is None else started
+        self.dispatching_since = None
+        self.outbound = outbound.MessageScheduler(self.clock)
+        self.bots = []
+        self.channels = {}
+        for channel, my_brain in brains:
+            bot = Bot(channel, my_brain, settings['channels'][channel], dispatcher=self)
+            my_brain.dispatcher = bot
+            self.bots.append(bot)
+            self.channels[channel.lower()] = bot
+        self.transports = self.outbound.transports
+        self.pool = MessengerPool(self, settings['network'], self.clock)
+        self.outbound.send_failed = self.pool.send_failed
+        self.flood = inbound.FloodControl(settings['flood control'], self.clock)
+        capture_file = settings['network']['capture file']
+        self.capture = capture.CaptureLog(capture_file, self.clock) if capture_file else None
+        metrics.registry.gauge('outbound_queue_depth', lambda: len(self.outbound))
+        metrics.registry.gauge('outbound_oldest_message_seconds', self.outbound.oldest_age)
+
+    def received(self, event, *args):
+        """Passes on something that happened in the channels (an event
+        from capture.EVENTS), logging it first if capturing."""
+        if self.capture is not None:
+            self.capture.write(event, args)
+        if event == 'command':
+            self.dispatch(*args)
+        elif event == 'quit':
+            for bot in self.bots:
+                bot.presence.left(args[0])
+        elif event == 'nick':
+            for bot in self.bots:
+                bot.presence.renamed(*args)
+        elif event in ('names', 'endnames'):
+            bot = self.channels.get(args[0].lower())
+            if bot is not None and event == 'names':
+                bot.presence.names(args[1].split())
+            elif bot is not None:
+                bot.presence.names_end()
+        else:
+            user, channel = args
+            bot = self.channels.get(channel.lower())
+            if bot is not None and event == 'join':
+                bot.presence.joined(user)
+            elif bot is not None:
+                bot.presence.left(user)
 
     def dispatch(self, user, channel, message):
         assert message.startswith('!'), \
           'Dispatch called with non-command message'
 
-        split = shlex.split(message)
-        command = split.pop(0)[1:]
+        # Most lines starting with ! aren't for the bot, so look the
+        # command up before doing anything else with them
+        parts = message[1:].split(None, 1)
+        command = COMMANDS.get(parts[0].lower()) if parts else None
+        if command is None:
+            metrics.registry.increment('commands_dropped_total', reason='unknown')
+            return
+        split = inbound.tokenize(parts[1]) if len(parts) > 1 else []
 
-        message = Message(split, user, channel != self.settings['network']['channel'])
+        bot = self.channels.get(channel.lower())
+        is_pm = bot is None
+        if is_pm:
+            if split and split[0].lower() in self.channels:
+                bot = self.channels[split.pop(0).lower()]
+            else:
+                bot = self.bots[0]
+
+        nick = user.split('!', 1)[0]
+        if not bot.is_admin(user):
+            verdict = self.flood.check(nick, bot.channel, command['name'], split)
+            if verdict == inbound.WARN:
+                bot.queue_message('You are sending commands too quickly, so some are being ignored', nick)
+            if verdict != inbound.ALLOW:
+                return
+
+        message = Message(split, nick, is_pm, from_mask=user)
+
+        d = defer.maybeDeferred(command['handler'], bot, message)
+        d.addCallback(self._queue_replies, channel, bot.channel)
+        d.addErrback(self._command_failed, command['name'])
+
+    def _queue_replies(self, replies, channel, tenant):
+        for reply in replies:
+            self.queue_message(message=reply, channel=channel, tenant=tenant)
+
+    def _command_failed(self, failure, command):
+        print 'Command %r failed:' % command
+        failure.printTraceback()
+
+    def queue_message(self, message, channel=None, priority=outbound.REPLY, tenant=None):
+        if channel is None:
+            channel = self.bots[0].channel
+        self.outbound.push(message, channel, priority, tenant)
 
-        if command not in COMMANDS:
-            print 'Saw invalid command %r, not in %r' % (
-                command, sorted(COMMANDS.keys()),
-            )
-            return
+    def max_targets(self):
+        limits = [self.settings['network']['max targets']]
+        limits.extend(t.max_targets() for t in self.transports)
+        return max(1, min(limit for limit in limits if limit is not None))
 
-        for outbound in COMMANDS[command]['handler'](self.bot, message):
-            self.queue_message(message=outbound, channel=channel)
+    def connect(self, name):
+        """Connects a messenger as name. Fires with it once connected, before it signs on."""
+        network = self.settings['network']
+        creator = protocol.ClientCreator(reactor, IRCMessenger, self, name)
+        return creator.connectTCP(network['server'], network['port'], timeout=network['ping timeout'])
 
-    def queue_message(self, message, channel=None):
-        if channel is None:
-            channel = self.settings['network']['channel']
-        self.message_queue.append({'message': message, 'channel': channel})
-
-    def send_messages(self, index):
-        if self.message_queue and self.transports:
-            index = (index+1) % len(self.transports)
-            try:
-                transport = self.transports[index]
-                msg = self.message_queue.pop(0)
-                transport.send_message(message=msg['message'], channel=msg['channel'])
-            except IndexError:
-                if index > 0:
-                    return send_messages(index=0)
-                else:
-                    pass
-        self.schedule_send_messages(index)
-
-    def schedule_send_messages(self, index=-1):
-        transports = len(self.transports) or 1
-        reactor.callLater(
-            60.0/self.settings['network']['messages per minute']/transports,
-            self.send_messages,
-            index=index
-        )
     def transport_connected(self, transport):
-        bot_name = self.bot_names.pop(0)
-        if not self.transports:
+        if not self.pool.signed_on(transport):
+            transport.quit('Not needed right now')
+            return False
+        transport.bucket = outbound.TokenBucket(
+            rate=self.settings['network']['messages per minute']/60.0,
+            burst=self.settings['network']['message burst'],
+            clock=self.clock,
+        )
+        if not any(t.should_dispatch for t in self.transports):
             transport.should_dispatch = True
+            if self.dispatching_since is None:
+                self.dispatching_since = self.clock.seconds()
+                startup = self.dispatching_since - self.started
+                metrics.registry.gauge('startup_seconds', lambda: startup)
+                print 'Taking commands %.2f seconds after starting' % startup
         self.transports.append(transport)
-        transport.setNick(bot_name)
-
-    def buildProtocol(self, addr):
-        p = IRCMessenger(factory=self)
-        return p
-
-    def clientConnectionLost(self, connector, reason):
-        reconnect_time = self.settings['network']['reconnect time']
-        print 'Reconnecting in %i seconds...' % reconnect_time
-        reactor.callLater(
-            reconnect_time,
-            connector.connect,
-        )
-
-    def clientConnectionFailed(self, connector, reason):
-        reactor.stop()
-
-def run_bot_with_settings(settings):
-    factory = IRCBotFactory(settings, brain.make_brain(settings))
-    factory.brain.dispatcher = factory
-    factory.bot_names = settings['network']['bot names'][:]
-
-    server = settings['network']['server']
-    port = settings['network']['port']
-
-    print 'Connecting to %s:%i...' % (server, port)
-    for i in xrange(len(factory.bot_names)):
-        reactor.callLater(
-            i*settings['network']['reconnect time'],
-            reactor.connectTCP,
-            server,
-            port,
-            factory,
-        )
+        self.outbound.pump()
+        return True
 
+    def transport_lost(self, transport):
+        """Stops sending through transport. If it was dispatching
+        commands, another messenger takes over."""
+        if transport not in self.transports:
+            return
+        self.transports.remove(transport)
+        if transport.should_dispatch:
+            transport.should_dispatch = False
+            if self.transports:
+                successor = self.transports[0]
+                successor.should_dispatch = True
+                # It hasn't been keeping track of who is in the channels
+                for bot in self.bots:
+                    successor.sendLine('NAMES %s' % bot.channel)
+
+def start_bot_with_settings(settings, started=None):
+    """Sets up the bot and schedules its connections, without running the reactor.
+
+    started: when the process started (reactor.seconds() time), if
+      earlier than now, to count towards startup_seconds
+    """
+    if started is None:
+        started = reactor.seconds()
+    # Every channel sends PUGs to the same servers
+    server_pool = ServerPool(settings['servers'], settings['server pool'])
+    rcon = RCONPool(settings['servers'], settings['rcon'])
+    main = settings['network']['channel']
+    brains = [
+        (channel, brain.make_brain(settings['channels'][channel], server_pool=server_pool, rcon=rcon))
+        for channel in [main] + sorted(set(settings['channels']) - set([main]))
+    ]
+    factory = IRCBotFactory(settings, brains, started=started)
+    print 'Set up %i channels with %i restored players %.2f seconds after starting' % (
+        len(brains), sum(my_brain.restored for _, my_brain in brains), reactor.seconds() - started,
+    )
+    for _, my_brain in brains:
+        reactor.addSystemEventTrigger('before', 'shutdown', my_brain.flush)
+    server_pool.start()
+    reactor.addSystemEventTrigger('before', 'shutdown', rcon.close)
+
+    metrics.registry.enabled = settings['metrics']['enabled']
+    if settings['metrics']['enabled'] and settings['metrics'].get('http port'):
+        metrics.serve(settings['metrics']['http port'])
+
+    print 'Connecting to %s:%i...' % (settings['network']['server'], settings['network']['port'])
+    factory.pool.start()
+    reactor.addSystemEventTrigger('before', 'shutdown', factory.pool.stop)
+    if factory.capture is not None:
+        print 'Capturing channel events to %s' % settings['network']['capture file']
+        reactor.addSystemEventTrigger('before', 'shutdown', factory.capture.close)
+
+    return factory
+
+def run_bot_with_settings(settings, started=None):
+    start_bot_with_settings(settings, started)
     reactor.run()
@@ -0,0 +1,95 @@
+import urllib
+
+TEAM_COLORS = {'red': '4', 'blu': '2'}
+
+# IRC lines are at most 512 bytes including the trailing CRLF, and the
+# server prefixes lines it relays with the sender's nick!user@host.
+LINE_LENGTH = 510
+PREFIX_ROOM = 100
+
+def text_limit(targets):
+    """The longest message that fits in a PRIVMSG to targets."""
+    return LINE_LENGTH - PREFIX_ROOM - len('PRIVMSG %s :' % ','.join(targets))
+
+def _join(parts, limit):
+    """Joins parts with ' | ' into as few lines as fit within limit."""
+    lines = []
+    for part in parts:
+        if lines and len(lines[-1]) + len(' | ') + len(part) <= limit:
+            lines[-1] += ' | ' + part
+        else:
+            lines.append(part)
+    return lines
+
+def team_line(team_name, player_mapping, class_sort_key):
+    color = TEAM_COLORS[team_name]
+    players = sorted(player_mapping.items(), key=lambda pair: (class_sort_key(pair[1]), pair[0]))
+    return '\x03%s%s Team\x03: %s' % (color, team_name.title(), ', '.join('%s as %s' % pair for pair in players))
+
+def draft_lines(team_name, captain, choices, classes_in, target):
+    """Tells a captain who they can pick, in as few lines to target as fit.
+
+    choices: {'player name': class bitmask}
+    """
+    color = TEAM_COLORS[team_name]
+    parts = ['\x03%s%s\x03, your pick (!pick-player <name> <class>):' % (color, captain)]
+    parts.extend('%s (%s)' % (name, '/'.join(classes_in(mask))) for name, mask in sorted(choices.items()))
+    return _join(parts, text_limit([target]))
+
+def mumble_link(mumble, team_name, player=None):
+    """A link to team_name's channel, logging in as player if given."""
+    userinfo = ''
+    if player is not None:
+        userinfo = urllib.quote(player, safe='')
+        if 'password' in mumble:
+            userinfo += ':' + urllib.quote(mumble['password'], safe='')
+        userinfo += '@'
+    return 'mumble://%s%s:%s/%s' % (
+        userinfo,
+        mumble['server'], mumble['port'],
+        mumble.get('%s channel' % team_name, ''),
+    )
+
+def player_messages(teams, server, class_sort_key):
+    """Returns {'player name': [lines]} telling each picked player where to go.
+
+    The team and connect info go in a single line when it fits, the
+    same for everyone on a team, so group_messages can send it to
+    several players at once. Mumble links carry each player's nick as
+    their username, so they follow on a line of their own.
+    """
+    connect = 'connect %s:%s; password %s' % (server['server'], server['port'], server.get('password', ''))
+    messages = {}
+    for team_name, player_mapping in teams.items():
+        picked = 'You have been picked: %s' % team_line(team_name, player_mapping, class_sort_key)
+        for player in player_mapping:
+            messages[player] = _join([picked, connect], text_limit([player]))
+            if 'mumble' in server:
+                messages[player].append(mumble_link(server['mumble'], team_name, player))
+    return messages
+
+def group_messages(messages, max_targets):
+    """Turns {'player name': [lines]} into [([targets], line)].
+
+    Players who get the same line share messages of up to max_targets
+    targets each, as long as the line still fits.
+    """
+    lines = []
+    targets_by_line = {}
+    for player in sorted(messages):
+        for line in messages[player]:
+            if line not in targets_by_line:
+                lines.append(line)
+                targets_by_line[line] = []
+            targets_by_line[line].append(player)
+
+    grouped = []
+    for line in lines:
+        targets = []
+        for player in targets_by_line[line]:
+            if targets and (len(targets) >= max_targets or len(line) > text_limit(targets + [player])):
+                grouped.append((targets, line))
+                targets = []
+            targets.append(player)
+        grouped.append((targets, line))
+    return grouped
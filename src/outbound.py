@@ -0,0 +1,162 @@
+import collections
+
+from twisted.python import failure
+
+import metrics
+
+# Message priorities, most urgent first: replies to commands, messages
+# to individual players (like pick notifications), then informational
+# notices to the channel.
+REPLY, NOTIFY, NOTICE = PRIORITIES = range(3)
+
+class TokenBucket(object):
+    """Allows rate sends per second on average and up to burst at once."""
+    def __init__(self, rate, burst, clock):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock.seconds()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated)*self.rate)
+        self.updated = now
+
+    def available(self):
+        self._refill()
+        return self.tokens
+
+    def take(self):
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self):
+        """Seconds until the next token is available."""
+        return max(0.0, (1 - self.available())/self.rate)
+
+class MessageScheduler(object):
+    """Sends queued messages through whichever transport can send next.
+
+    Each transport needs a `bucket` attribute (a TokenBucket) and a
+    `send_message(channel, message)` method. Messages go out as soon as
+    some bucket has a token, most urgent priority first.
+
+    Every message is queued for a tenant (the channel it is sent on
+    behalf of, by default the one it's sent to), and within a priority
+    the tenants with messages waiting take turns, one message each, in
+    the order their messages were queued. One channel's burst (like a
+    pick's notifications) can't hold up another channel's replies.
+
+    A message identical to one already waiting to be sent to the same
+    channel, at the same or a more urgent priority, is dropped instead
+    of queued twice.
+
+    A message whose send_message raises goes back to the front of its
+    queue, and send_failed(transport, failure), if set, is told.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.transports = []
+        self.send_failed = None
+        # Per priority, {tenant: deque of messages} in turn order
+        self.queues = [collections.OrderedDict() for _ in PRIORITIES]
+        self._length = 0
+        # {(channel, message): the queued message waiting to be sent}
+        self._queued = {}
+        self._wakeup = None
+
+    def __len__(self):
+        return self._length
+
+    def push(self, message, channel, priority=REPLY, tenant=None):
+        waiting = self._queued.get((channel, message))
+        if waiting is not None and waiting['priority'] <= priority:
+            return
+        if tenant is None:
+            tenant = channel
+        msg = {'message': message, 'channel': channel, 'priority': priority, 'tenant': tenant,
+               'queued': self.clock.seconds()}
+        self._queued[(channel, message)] = msg
+        queues = self.queues[priority]
+        if tenant not in queues:
+            queues[tenant] = collections.deque()
+        queues[tenant].append(msg)
+        self._length += 1
+        self.pump()
+
+    def oldest_age(self):
+        """Seconds the longest-waiting message has been queued."""
+        heads = [queue[0]['queued'] for queues in self.queues for queue in queues.itervalues()]
+        if not heads:
+            return 0.0
+        return self.clock.seconds() - min(heads)
+
+    def estimate_delay(self, priority, tenant=None):
+        """Seconds until everything queued at priority or above is sent,
+        or with a tenant, everything of theirs at priority.
+
+        Returns None if there is no transport to send through yet.
+        """
+        if not self.transports:
+            return None
+        waiting = sum(len(queue) for queues in self.queues[:priority] for queue in queues.itervalues())
+        own = self.queues[priority].get(tenant)
+        if own is None:
+            waiting += sum(len(queue) for queue in self.queues[priority].itervalues())
+        else:
+            # Other tenants get a turn for each of the tenant's messages
+            waiting += sum(min(len(queue), len(own)) for queue in self.queues[priority].itervalues())
+        tokens = sum(int(t.bucket.available()) for t in self.transports)
+        rate = sum(t.bucket.rate for t in self.transports)
+        return max(0.0, (waiting - tokens)/rate)
+
+    def _pop(self):
+        for queues in self.queues:
+            if queues:
+                tenant, queue = next(queues.iteritems())
+                msg = queue.popleft()
+                # The tenant's turn is over; back of the line if it has more
+                del queues[tenant]
+                if queue:
+                    queues[tenant] = queue
+                self._length -= 1
+                key = (msg['channel'], msg['message'])
+                if self._queued.get(key) is msg:
+                    del self._queued[key]
+                return msg
+
+    def _requeue(self, msg):
+        """Puts msg back first in its tenant's queue."""
+        queues = self.queues[msg['priority']]
+        if msg['tenant'] not in queues:
+            queues[msg['tenant']] = collections.deque()
+        queues[msg['tenant']].appendleft(msg)
+        self._length += 1
+        self._queued.setdefault((msg['channel'], msg['message']), msg)
+
+    def pump(self):
+        """Send everything current capacity allows, then wait for more."""
+        if self._wakeup is not None and self._wakeup.active():
+            self._wakeup.cancel()
+        self._wakeup = None
+
+        while len(self) and self.transports:
+            transport = max(self.transports, key=lambda t: t.bucket.available())
+            if not transport.bucket.take():
+                delay = min(t.bucket.delay() for t in self.transports)
+                self._wakeup = self.clock.callLater(delay, self.pump)
+                return
+            msg = self._pop()
+            try:
+                transport.send_message(message=msg['message'], channel=msg['channel'])
+            except Exception:
+                self._requeue(msg)
+                metrics.registry.increment('messages_failed_total', transport=transport.nickname)
+                if self.send_failed is not None:
+                    self.send_failed(transport, failure.Failure())
+                continue
+            metrics.registry.increment('messages_sent_total', transport=transport.nickname)
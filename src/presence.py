@@ -0,0 +1,107 @@
+import string
+
+from outbound import NOTICE
+
+# Channel status prefixes servers put in front of nicks in NAMES replies
+NICK_PREFIXES = '~&@%+'
+
+# RFC 1459 case mapping: []\~ are the upper case of {}|^
+_IRC_LOWER = string.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^')
+
+def irc_lower(nick):
+    """Folds nick the way IRC servers compare nicks, so Foo and FOO are
+    the same person."""
+    return nick.translate(_IRC_LOWER)
+
+class Presence(object):
+    """Who is in the channel, and what happens to added players who leave.
+
+    The member list is loaded in bulk from NAMES replies and then kept up
+    to date from joins, parts, quits, kicks and nick changes, all in
+    memory. Added players who leave are removed after `grace` seconds
+    unless they come back first, and added players who change nick keep
+    their classes and history. Nicks are compared the way IRC servers
+    compare them, ignoring case (see irc_lower).
+    """
+    def __init__(self, my_brain, grace, clock):
+        self.brain = my_brain
+        self.grace = grace
+        self.clock = clock
+        self.members = set()
+        self._names = None
+        self._leaving = {}
+
+    def __contains__(self, nick):
+        return irc_lower(nick) in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def names(self, nicks):
+        """Takes one line of a NAMES reply; a reply can span many."""
+        if self._names is None:
+            self._names = set()
+        self._names.update(irc_lower(nick.lstrip(NICK_PREFIXES)) for nick in nicks)
+
+    def names_end(self):
+        """Replaces the member list with the NAMES reply just finished."""
+        self.members, self._names = self._names or set(), None
+        for key in [key for key in self._leaving if key in self.members]:
+            self._stay(key)
+        # Anyone who left while we weren't watching
+        for nick in self.brain.players_added():
+            if irc_lower(nick) not in self.members:
+                self._leave(nick)
+
+    def joined(self, nick):
+        self.members.add(irc_lower(nick))
+        self._stay(nick)
+
+    def left(self, nick):
+        self.members.discard(irc_lower(nick))
+        self._leave(nick)
+
+    def renamed(self, old_nick, new_nick):
+        # Nick changes are seen for every channel the bot is in, so this
+        # may be someone who isn't in this one
+        old_key = irc_lower(old_nick)
+        member = old_key in self.members
+        added = self._added(old_nick)
+        if not member and added is None:
+            return
+        if member:
+            self.members.discard(old_key)
+            self.members.add(irc_lower(new_nick))
+        self._stay(old_nick)
+        self._stay(new_nick)
+        self.brain.player_renamed(added or old_nick, new_nick)
+        if not member:
+            self._leave(new_nick)
+
+    def _added(self, nick):
+        """The name nick is added under, in whatever case, or None."""
+        if nick in self.brain.roster:
+            return nick
+        key = irc_lower(nick)
+        for name in self.brain.players_added():
+            if irc_lower(name) == key:
+                return name
+        return None
+
+    def _leave(self, nick):
+        key = irc_lower(nick)
+        if key not in self._leaving and self._added(nick) is not None:
+            self._leaving[key] = self.clock.callLater(self.grace, self._gone, key)
+
+    def _stay(self, nick):
+        call = self._leaving.pop(irc_lower(nick), None)
+        if call is not None and call.active():
+            call.cancel()
+
+    def _gone(self, key):
+        del self._leaving[key]
+        nick = self._added(key)
+        if key in self.members or nick is None:
+            return
+        self.brain.dispatcher.queue_message('Removed %s (left the channel)' % nick, priority=NOTICE)
+        self.brain.player_remove(nick)
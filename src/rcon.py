@@ -0,0 +1,269 @@
+"""An asynchronous client for the Source RCON protocol.
+
+Each server gets one connection, authenticated once and kept open
+between PUGs. Commands are pipelined: they are all written at once and
+their responses matched up by request id, so setting up a server takes
+about one round trip however many commands it needs.
+
+A command's response may span several packets, so every command is
+followed by an empty SERVERDATA_RESPONSE_VALUE packet with the next id;
+the server mirrors it back after the response, which marks its end.
+
+Each batch of commands has a timeout of its own. One that runs out
+fails only that batch; other batches on the same connection carry on.
+"""
+
+import itertools
+import struct
+
+from twisted.internet import defer, error, protocol, reactor
+from twisted.protocols import basic
+from twisted.python import failure
+
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+class RCONError(Exception):
+    pass
+
+class AuthenticationError(RCONError):
+    def __str__(self):
+        return 'Wrong RCON password'
+
+# The console ends a command at ; or a line break even inside quotes,
+# and has no way to escape a quote, so arguments can't contain these
+UNSAFE_CHARACTERS = '";\r\n'
+
+def quote_argument(argument):
+    """Returns argument quoted for the server console, or raises an
+    RCONError if it has characters quoting can't protect."""
+    argument = '%s' % (argument,)
+    if any(c in UNSAFE_CHARACTERS for c in argument):
+        raise RCONError('%r has characters that would end the command (%s)' % (
+            argument, ' '.join(repr(c) for c in UNSAFE_CHARACTERS),
+        ))
+    return '"%s"' % argument
+
+def pack(request_id, packet_type, body):
+    return struct.pack('<ii', request_id, packet_type) + body + '\x00\x00'
+
+def unpack(packet):
+    if len(packet) < 10:
+        raise RCONError('Short RCON packet')
+    request_id, packet_type = struct.unpack_from('<ii', packet)
+    return request_id, packet_type, packet[8:-2]
+
+class RCONProtocol(basic.IntNStringReceiver):
+    structFormat = '<i'
+    prefixLength = struct.calcsize(structFormat)
+    MAX_LENGTH = 64*1024
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._ends = {}
+        self._authenticating = None
+        self._closing = False
+
+    def authenticate(self, password):
+        """Fires once the server accepts password, or fails with AuthenticationError."""
+        request_id = next(self._ids)
+        self._authenticating = (request_id, defer.Deferred(self._stop_authenticating))
+        self.sendString(pack(request_id, SERVERDATA_AUTH, password))
+        return self._authenticating[1]
+
+    def _stop_authenticating(self, d):
+        self._authenticating = None
+
+    def command(self, command):
+        """Runs command. Fires with the server's response text.
+
+        Cancelling the Deferred forgets the command; its response is
+        ignored if it ever comes.
+        """
+        request_id, end_id = next(self._ids), next(self._ids)
+        d = defer.Deferred(lambda d: self._forget(request_id))
+        self._pending[request_id] = {'deferred': d, 'parts': [], 'end': end_id}
+        self._ends[end_id] = request_id
+        self.sendString(pack(request_id, SERVERDATA_EXECCOMMAND, command))
+        self.sendString(pack(end_id, SERVERDATA_RESPONSE_VALUE, ''))
+        return d
+
+    def _forget(self, request_id):
+        pending = self._pending.pop(request_id, None)
+        if pending is not None:
+            del self._ends[pending['end']]
+        self._close_if_idle()
+
+    def close_when_idle(self):
+        """Closes the connection once no commands are waiting on it."""
+        self._closing = True
+        self._close_if_idle()
+
+    def _close_if_idle(self):
+        if self._closing and not self._pending and self.connected:
+            self.transport.loseConnection()
+
+    def stringReceived(self, packet):
+        try:
+            request_id, packet_type, body = unpack(packet)
+        except RCONError:
+            self.transport.loseConnection()
+            return
+
+        if packet_type == SERVERDATA_AUTH_RESPONSE and self._authenticating is not None:
+            expected, d = self._authenticating
+            self._authenticating = None
+            if request_id == expected:
+                d.callback(self)
+            else:
+                d.errback(AuthenticationError())
+        elif request_id in self._pending:
+            self._pending[request_id]['parts'].append(body)
+        elif request_id in self._ends:
+            pending = self._pending.pop(self._ends.pop(request_id))
+            pending['deferred'].callback(''.join(pending['parts']))
+            self._close_if_idle()
+        # Anything else (like the junk packet some servers send after a
+        # mirrored one) is ignored
+
+    def connectionLost(self, reason):
+        self.connected = 0
+        waiting = [pending['deferred'] for pending in self._pending.values()]
+        if self._authenticating is not None:
+            waiting.append(self._authenticating[1])
+        self._pending, self._ends, self._authenticating = {}, {}, None
+        for d in waiting:
+            d.errback(reason)
+
+class RCONClient(object):
+    """A persistent, authenticated connection to one server.
+
+    Connects on first use and again whenever the connection has been
+    lost. A batch of commands that times out or loses its connection is
+    retried on a fresh connection, up to `retries` times.
+
+    Whatever held up a batch that timed out may hold up the next one
+    too, so the batches after it get a new connection. The old one is
+    closed once the batches still running on it are done.
+    """
+    def __init__(self, host, port, password, timeout, retries, clock=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.retries = retries
+        self.clock = reactor if clock is None else clock
+        self._protocol = None
+        self._ready = False
+        self._waiting = []
+
+    def _connect(self):
+        """Fires with an authenticated RCONProtocol."""
+        d = defer.Deferred(self._stop_waiting)
+        if self._ready and self._protocol.connected:
+            d.callback(self._protocol)
+            return d
+        self._waiting.append(d)
+        if len(self._waiting) == 1:
+            self._ready = False
+            creator = protocol.ClientCreator(reactor, RCONProtocol)
+            connecting = creator.connectTCP(self.host, self.port, timeout=self.timeout)
+            connecting.addCallback(self._connected)
+            connecting.addBoth(self._connect_done)
+        return d
+
+    def _stop_waiting(self, d):
+        if d in self._waiting:
+            self._waiting.remove(d)
+
+    def _connected(self, rcon):
+        self._protocol = rcon
+        return rcon.authenticate(self.password).addTimeout(self.timeout, self.clock, onTimeoutCancel=self._timed_out)
+
+    def _connect_done(self, result):
+        waiting, self._waiting = self._waiting, []
+        if isinstance(result, failure.Failure):
+            self.close()
+        else:
+            self._ready = True
+        for d in waiting:
+            # Unless that batch has given up meanwhile
+            if not d.called:
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+    def run(self, commands):
+        """Runs commands, in order, all at once. Fires with a list of
+        their responses."""
+        return self._run(commands, self.retries)
+
+    def _run(self, commands, retries):
+        sent_on = []
+        d = self._connect()
+        d.addCallback(self._send, commands, sent_on)
+        d.addTimeout(self.timeout, self.clock, onTimeoutCancel=self._timed_out)
+
+        def failed(f):
+            if f.check(error.TimeoutError) and sent_on and sent_on[0] is self._protocol:
+                self._retire()
+            if retries > 0 and not f.check(AuthenticationError):
+                return self._run(commands, retries - 1)
+            return f
+        return d.addErrback(failed)
+
+    def _send(self, rcon, commands, sent_on):
+        sent_on.append(rcon)
+        d = defer.gatherResults([rcon.command(command) for command in commands], consumeErrors=True)
+
+        def unwrap(f):
+            f.trap(defer.FirstError)
+            return f.value.subFailure
+        return d.addErrback(unwrap)
+
+    def _timed_out(self, result, timeout):
+        if isinstance(result, failure.Failure):
+            result.trap(defer.CancelledError)
+            raise error.TimeoutError('No answer from %s:%i' % (self.host, self.port))
+        return result
+
+    def _retire(self):
+        """Stops handing out the current connection, closing it once
+        the commands still running on it are done."""
+        rcon, self._protocol, self._ready = self._protocol, None, False
+        rcon.close_when_idle()
+
+    def close(self):
+        if self._protocol is not None and self._protocol.connected:
+            self._protocol.transport.loseConnection()
+        self._protocol = None
+        self._ready = False
+
+class RCONPool(object):
+    """One RCONClient per configured server that has an RCON password."""
+    def __init__(self, servers, rcon_settings, clock=None):
+        self.clients = {}
+        for name, server in servers.items():
+            if server.get('rcon password'):
+                self.clients[name] = RCONClient(
+                    server['server'],
+                    server.get('rcon port', server['port']),
+                    server['rcon password'],
+                    timeout=rcon_settings['timeout'],
+                    retries=rcon_settings['retries'],
+                    clock=clock,
+                )
+
+    def __contains__(self, name):
+        return name in self.clients
+
+    def run(self, name, commands):
+        return self.clients[name].run(commands)
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
@@ -0,0 +1,152 @@
+import random
+
+import numpy
+
+def _choose(rng, weights):
+    """Index into weights, picked with probability proportional to its weight."""
+    r = rng.random() * sum(weights)
+    for i, weight in enumerate(weights):
+        r -= weight
+        if r < 0 and weight > 0:
+            return i
+    # Floating point leftovers; fall back to the last possible choice
+    return max(i for i, weight in enumerate(weights) if weight > 0)
+
+def _binomial(n, k):
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+class TeamSampler(object):
+    """Draws red/blu teams uniformly from every valid assignment of a roster.
+
+    Players who added the same set of classes are interchangeable, so
+    they are grouped together by class bitmask. For each group (last to first), an array
+    indexed by the open slots of every class counts the ways the rest of
+    the groups can fill those slots. Drawing a pick then walks the
+    groups in order and chooses each group's share of players with
+    probability proportional to those counts, which makes every valid
+    assignment exactly equally likely. Building the arrays is done once;
+    every draw after that only touches a handful of entries.
+
+    A sampler is falsy if the roster has no valid assignment.
+    """
+    def __init__(self, masks_by_player, rules, rng=None):
+        self.rng = random.Random() if rng is None else rng
+        self.classes = rules.classes_in(rules.pickable)
+        self.slots = tuple(2*rules.limits[rules.class_index[cls]] for cls in self.classes)
+        axis = dict((cls, i) for i, cls in enumerate(self.classes))
+
+        by_mask = {}
+        for name, mask in masks_by_player.items():
+            mask &= rules.pickable
+            if mask:
+                by_mask.setdefault(mask, []).append(name)
+        self.groups = sorted(
+            (tuple(axis[cls] for cls in rules.classes_in(mask)), sorted(names))
+            for mask, names in by_mask.items()
+        )
+        self._binomials = [
+            [float(_binomial(len(names), n)) for n in range(min(len(names), sum(self.slots[i] for i in axes)) + 1)]
+            for axes, names in self.groups
+        ]
+
+        # self.layers[k] counts the ways groups k and later can fill any
+        # given number of open slots per class.
+        counts = numpy.zeros([n + 1 for n in self.slots])
+        counts[(0,)*len(self.slots)] = 1
+        self.layers = [counts]
+        for axes, names in reversed(self.groups):
+            counts = self._add_group(counts, axes, len(names))
+            self.layers.append(counts)
+        self.layers.reverse()
+
+    def players(self):
+        """Everyone who could be picked, sorted."""
+        return sorted(name for _, names in self.groups for name in names)
+
+    def __nonzero__(self):
+        return bool(self.layers[0][self.slots] > 0)
+    __bool__ = __nonzero__
+
+    def _shift(self, counts, axes):
+        """Ways to fill one more slot, in any of axes, than counts allows."""
+        result = numpy.zeros_like(counts)
+        for i in axes:
+            to = [slice(None)]*counts.ndim
+            to[i] = slice(1, None)
+            fro = [slice(None)]*counts.ndim
+            fro[i] = slice(None, -1)
+            result[tuple(to)] += counts[tuple(fro)]
+        return result
+
+    def _add_group(self, counts, axes, size):
+        # Choose j of the group's players, then give them classes in order
+        total = counts.copy()
+        term = counts
+        most = min(size, sum(self.slots[i] for i in axes))
+        for j in range(1, most + 1):
+            term = self._shift(term, axes)
+            total += float(_binomial(size, j)) * term
+        return total
+
+    def sample(self):
+        """Returns {'team': {'player name': 'class'}} for one random pick."""
+        if not self:
+            raise ValueError('No valid assignment exists for this roster')
+
+        open_slots = list(self.slots)
+        assigned = {}
+        for k, (axes, names) in enumerate(self.groups):
+            if not any(open_slots[i] for i in axes):
+                continue
+            after = self.layers[k+1]
+            memo = {}
+
+            def ways(j, state):
+                # Ways to give j ordered players classes from axes, with
+                # the later groups filling whatever is left over.
+                key = (j, state)
+                if key not in memo:
+                    if j == 0:
+                        memo[key] = float(after[state])
+                    else:
+                        total = 0
+                        for i in axes:
+                            if state[i]:
+                                total += ways(j - 1, state[:i] + (state[i] - 1,) + state[i+1:])
+                        memo[key] = total
+                return memo[key]
+
+            state = tuple(open_slots)
+            most = min(len(names), sum(state[i] for i in axes))
+            binomials = self._binomials[k]
+            count = _choose(self.rng, [binomials[n] * ways(n, state) for n in range(most + 1)])
+            for t, name in enumerate(self.rng.sample(names, count)):
+                options = [i for i in axes if state[i]]
+                weights = [
+                    ways(count - t - 1, state[:i] + (state[i] - 1,) + state[i+1:])
+                    for i in options
+                ]
+                i = options[_choose(self.rng, weights)]
+                state = state[:i] + (state[i] - 1,) + state[i+1:]
+                assigned[name] = self.classes[i]
+            open_slots = list(state)
+
+        # Every class assignment splits into teams the same number of
+        # ways, so a uniform split keeps the whole pick uniform.
+        by_class = {}
+        for name in sorted(assigned):
+            by_class.setdefault(assigned[name], []).append(name)
+        red, blu = {}, {}
+        for cls in self.classes:
+            names = by_class[cls]
+            self.rng.shuffle(names)
+            half = len(names) // 2
+            for name in names[:half]:
+                red[name] = cls
+            for name in names[half:]:
+                blu[name] = cls
+
+        return {'red': red, 'blu': blu}
@@ -0,0 +1,292 @@
+"""Keeps track of the game servers PUGs are sent to.
+
+Every server in settings -> servers is probed with the Source engine's
+A2S_INFO query over UDP every so often, all of them at once, and the
+answers (how many people are playing and how long the reply took) are
+kept for a while. Choosing a server for a PUG never waits on the
+network: it takes the least-recently used server that was empty when it
+was last probed, and holds it for that PUG until people show up on it.
+"""
+
+import heapq
+import itertools
+import struct
+
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.internet.abstract import isIPAddress
+
+A2S_HEADER = '\xff\xff\xff\xff'
+A2S_INFO = A2S_HEADER + 'TSource Engine Query\x00'
+A2S_INFO_REPLY = 'I'
+A2S_CHALLENGE = 'A'
+
+# What a server is thought to be doing. A RESERVED server has been
+# handed out for a PUG that nobody has joined yet.
+EMPTY, UNKNOWN, BUSY, RESERVED = STATES = range(4)
+
+class A2SError(Exception):
+    pass
+
+class NoServerAvailable(Exception):
+    def __str__(self):
+        return 'No server is free right now'
+
+def parse_info(data):
+    """Returns {'name', 'map', 'players', 'max players', 'bots'} from an
+    A2S_INFO reply, or raises A2SError."""
+    if not data.startswith(A2S_HEADER + A2S_INFO_REPLY):
+        raise A2SError('Not an A2S_INFO reply')
+    position = len(A2S_HEADER) + 2 # reply type and protocol version
+    strings = []
+    for _ in xrange(4): # name, map, game folder, game
+        end = data.find('\x00', position)
+        if end == -1:
+            raise A2SError('Truncated A2S_INFO reply')
+        strings.append(data[position:end])
+        position = end + 1
+    try:
+        _, players, max_players, bots = struct.unpack_from('<HBBB', data, position)
+    except struct.error:
+        raise A2SError('Truncated A2S_INFO reply')
+    return {
+        'name': strings[0],
+        'map': strings[1],
+        'players': players,
+        'max players': max_players,
+        'bots': bots,
+    }
+
+class A2SClient(protocol.DatagramProtocol):
+    """Sends A2S_INFO queries from a single UDP port and matches replies
+    to them by address, so any number can be waiting at once."""
+    def __init__(self, clock=None):
+        self.clock = reactor if clock is None else clock
+        self._pending = {}
+
+    def query(self, address, timeout):
+        """Asks the server at address, an (IP, port) pair, for its info.
+
+        Fires with parse_info's dict plus 'latency' in seconds, or fails
+        with A2SError or error.TimeoutError. Asking again while waiting
+        shares the answer to the first query.
+        """
+        d = defer.Deferred()
+        if address in self._pending:
+            self._pending[address]['waiting'].append(d)
+            return d
+        self._pending[address] = {
+            'waiting': [d],
+            'sent': self.clock.seconds(),
+            'timeout': self.clock.callLater(timeout, self._timed_out, address),
+        }
+        self.transport.write(A2S_INFO, address)
+        return d
+
+    def _finish(self, address):
+        pending = self._pending.pop(address)
+        if pending['timeout'].active():
+            pending['timeout'].cancel()
+        return pending
+
+    def _fail(self, address, failure):
+        for d in self._finish(address)['waiting']:
+            d.errback(failure)
+
+    def _timed_out(self, address):
+        self._fail(address, error.TimeoutError('No reply from %s:%i' % address))
+
+    def datagramReceived(self, data, address):
+        if address not in self._pending:
+            return
+        # Servers may ask for the query again with a challenge number
+        # attached, to make spoofed queries useless for reflection.
+        if data.startswith(A2S_HEADER + A2S_CHALLENGE) and len(data) >= 9:
+            self.transport.write(A2S_INFO + data[5:9], address)
+            return
+        try:
+            info = parse_info(data)
+        except A2SError as e:
+            self._fail(address, e)
+            return
+        pending = self._finish(address)
+        info['latency'] = self.clock.seconds() - pending['sent']
+        for d in pending['waiting']:
+            d.callback(dict(info))
+
+    def stopProtocol(self):
+        for address in list(self._pending):
+            self._fail(address, error.ConnectionLost())
+
+class ServerPool(object):
+    """The configured servers, ordered by when each was last used.
+
+    The servers acquire() can hand out are kept in a heap per state
+    (EMPTY and UNKNOWN) keyed on when each was last handed out; BUSY and
+    RESERVED ones are only counted. Changing a server's state pushes a
+    new entry and blanks out the old one, which is thrown away when it
+    comes to the top, or all at once when a heap holds more blank
+    entries than live ones. Updates and acquire() take O(log n)
+    (amortized), and free() O(1).
+
+    A probe result is trusted for `max age` seconds; after that the
+    server goes back to UNKNOWN until it answers again.
+
+    A server stays RESERVED from being handed out until a probe finds
+    people playing on it, or for `hold time` seconds if none ever does,
+    so no other PUG gets it in the meantime.
+    """
+    def __init__(self, servers, pool_settings, clock=None):
+        self.servers = servers
+        self.interval = pool_settings['probe interval']
+        self.timeout = pool_settings['probe timeout']
+        self.max_age = pool_settings['max age']
+        self.hold_time = pool_settings['hold time']
+        self.clock = reactor if clock is None else clock
+        self.client = A2SClient(self.clock)
+        self.status = {}
+        self._heaps = {EMPTY: [], UNKNOWN: []}
+        # Blanked-out entries left in each heap
+        self._stale = {EMPTY: 0, UNKNOWN: 0}
+        # {name: (state, heap entry)} for the servers in a heap
+        self._entries = {}
+        self._counts = dict((state, 0) for state in STATES)
+        self._counter = itertools.count()
+        self._expiry = {}
+        self._holds = {}
+        self._probing = set()
+        self._port = None
+        self._loop = None
+        for name in sorted(servers):
+            self.status[name] = {'state': None, 'last used': 0, 'players': None, 'latency': None}
+            self._set(name, UNKNOWN)
+
+    def __len__(self):
+        return len(self.servers)
+
+    def _set(self, name, state, last_used=None):
+        status = self.status[name]
+        if last_used is not None:
+            status['last used'] = last_used
+        elif status['state'] == state:
+            return
+        if status['state'] is not None:
+            self._counts[status['state']] -= 1
+        self._counts[state] += 1
+        status['state'] = state
+
+        old = self._entries.pop(name, None)
+        if old is not None:
+            old_state, old_entry = old
+            old_entry[-1] = None
+            self._stale[old_state] += 1
+            heap = self._heaps[old_state]
+            if 2*self._stale[old_state] > len(heap):
+                heap[:] = [entry for entry in heap if entry[-1] is not None]
+                heapq.heapify(heap)
+                self._stale[old_state] = 0
+        if state in self._heaps:
+            entry = [status['last used'], next(self._counter), name]
+            self._entries[name] = (state, entry)
+            heapq.heappush(self._heaps[state], entry)
+
+    def free(self):
+        """How many servers acquire() could hand out right now."""
+        return self._counts[EMPTY] + self._counts[UNKNOWN]
+
+    def acquire(self):
+        """Returns the name of the least-recently used empty server, or
+        failing that the least-recently used one whose state isn't known,
+        and reserves it. Raises NoServerAvailable if all are busy or
+        reserved.
+        """
+        for state in (EMPTY, UNKNOWN):
+            heap = self._heaps[state]
+            while heap and heap[0][-1] is None:
+                heapq.heappop(heap)
+                self._stale[state] -= 1
+            if heap:
+                name = heap[0][-1]
+                self._set(name, RESERVED, last_used=self.clock.seconds())
+                self._holds[name] = self.clock.callLater(self.hold_time, self._release, name)
+                return name
+        raise NoServerAvailable()
+
+    def _release(self, name):
+        """Ends name's reservation, after nobody showed up on it for
+        hold time. Until it's probed again, nothing is known about it."""
+        del self._holds[name]
+        if self.status[name]['state'] == RESERVED:
+            self._set(name, UNKNOWN)
+
+    def start(self):
+        """Starts listening for probe replies and probing every interval."""
+        self._port = reactor.listenUDP(0, self.client)
+        self._loop = task.LoopingCall(self.probe_all)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        for call in self._expiry.values() + self._holds.values():
+            if call.active():
+                call.cancel()
+        if self._port is not None:
+            port, self._port = self._port, None
+            return port.stopListening()
+
+    def probe_all(self):
+        """Probes every server at once. Fires when all have answered or
+        timed out."""
+        return defer.DeferredList([
+            self.probe(name) for name in sorted(self.servers) if name not in self._probing
+        ])
+
+    def probe(self, name):
+        self._probing.add(name)
+        server = self.servers[name]
+        d = self._resolve(server['server'])
+        d.addCallback(lambda host: self.client.query((host, server.get('query port', server['port'])), self.timeout))
+        d.addCallbacks(self._probed, self._probe_failed, callbackArgs=(name,), errbackArgs=(name,))
+        d.addBoth(self._probe_done, name)
+        return d
+
+    def _resolve(self, host):
+        if isIPAddress(host):
+            return defer.succeed(host)
+        return reactor.resolve(host)
+
+    def _probed(self, info, name):
+        players = max(0, info['players'] - info['bots'])
+        self.status[name].update(players=players, latency=info['latency'])
+        if players > 0:
+            # Whoever it was reserved for has turned up
+            call = self._holds.pop(name, None)
+            if call is not None and call.active():
+                call.cancel()
+            self._set(name, BUSY)
+        elif self.status[name]['state'] != RESERVED:
+            self._set(name, EMPTY)
+
+        call = self._expiry.get(name)
+        if call is not None and call.active():
+            call.reset(self.max_age)
+        else:
+            self._expiry[name] = self.clock.callLater(self.max_age, self._expire, name)
+
+    def _probe_failed(self, failure, name):
+        failure.trap(A2SError, error.TimeoutError, error.DNSLookupError, error.ConnectionLost)
+        self._expire(name)
+
+    def _expire(self, name):
+        call = self._expiry.pop(name, None)
+        if call is not None and call.active():
+            call.cancel()
+        self.status[name].update(players=None, latency=None)
+        if self.status[name]['state'] != RESERVED:
+            self._set(name, UNKNOWN)
+
+    def _probe_done(self, result, name):
+        self._probing.discard(name)
+        return result
@@ -1,6 +1,9 @@
+import copy
 from os import path
 import yaml
 
+from rcon import UNSAFE_CHARACTERS
+
 def _deep_merge(original, update_with):
     result = {}
     all_keys = set(original.keys()) | set(update_with.keys())
@@ -22,15 +25,55 @@ DEFAULT_BASE_SETTINGS = {
     'rules': {
         'picking': 'random',
         'mode': 'highlander',
+        'balance time': 0.02,
+        'captain pick time': 60,
+        'max games': 1,
     },
     'network': {
         'port': 6667,
         'reconnect time': 15,
         'messages per minute': 20,
+        'message burst': 4,
+        'max targets': 4,
+        'admins': [],
+        'departure grace': 120,
+        'min bots': 1,
+        'max reconnect delay': 300,
+        'ping interval': 60,
+        'ping timeout': 30,
+        'max send errors': 3,
+        'scale up backlog': 10,
+        'scale down after': 300,
+        'capture file': None,
+    },
+    'channels': {},
+    'flood control': {
+        'commands per minute': 12,
+        'command burst': 5,
+        'same command per minute': 6,
+        'same command burst': 3,
+        'duplicate window': 3.0,
+        'warn': True,
+    },
+    'servers': {},
+    'server pool': {
+        'probe interval': 30,
+        'probe timeout': 2.0,
+        'max age': 90,
+        'hold time': 300,
+    },
+    'rcon': {
+        'timeout': 5.0,
+        'retries': 2,
+    },
+    'metrics': {
+        'enabled': False,
     },
     'database': {
         'type': 'sqlite',
         'name': 'bot.sqlite',
+        'flush delay': 1.0,
+        'restore max age': 1800,
     },
 }
 
@@ -80,7 +123,138 @@ SIXES_SETTINGS = {
     },
 }
 
+class Rules(object):
+    """The rules settings, checked and compiled for the brain.
+
+    Classes are numbered in the order of `valid_classes`, and a set of
+    classes is an int with bit (1 << number) set for each class in it,
+    so set operations on classes are integer operations. Rules can't be
+    changed once made.
+    """
+    __slots__ = (
+        'mode', 'picking', 'balance_time', 'captain_time', 'max_games',
+        'valid_classes', 'class_index', 'class_bit', 'limits', 'pickable', 'game_size',
+        '_classes_in',
+    )
+
+    def __init__(self, mode, picking, balance_time, captain_time, max_games, valid_classes, class_limits):
+        unknown = set(class_limits) - set(valid_classes)
+        if unknown:
+            raise SettingsError('rules -> class limits has classes missing from valid classes: %s' % ', '.join(sorted(unknown)))
+        valid_classes = tuple(valid_classes)
+        init = lambda name, value: object.__setattr__(self, name, value)
+        init('mode', mode)
+        init('picking', picking)
+        init('balance_time', balance_time)
+        init('captain_time', captain_time)
+        init('max_games', max_games)
+        init('valid_classes', valid_classes)
+        init('class_index', dict((cls, i) for i, cls in enumerate(valid_classes)))
+        init('class_bit', dict((cls, 1 << i) for i, cls in enumerate(valid_classes)))
+        # Players per team, by class number
+        init('limits', tuple(class_limits.get(cls, 0) for cls in valid_classes))
+        init('pickable', sum(1 << i for i, limit in enumerate(self.limits) if limit > 0))
+        init('game_size', 2*sum(self.limits))
+        init('_classes_in', {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Rules can't be changed")
+
+    @property
+    def class_limits(self):
+        return dict((cls, limit) for cls, limit in zip(self.valid_classes, self.limits) if limit > 0)
+
+    def mask(self, classes):
+        """The set of classes (valid ones only) as an int."""
+        mask = 0
+        for cls in classes:
+            mask |= self.class_bit.get(cls, 0)
+        return mask
+
+    def classes_in(self, mask):
+        """The classes in mask, as a tuple in the order of valid classes."""
+        classes = self._classes_in.get(mask)
+        if classes is None:
+            classes = self._classes_in[mask] = tuple(
+                cls for i, cls in enumerate(self.valid_classes) if mask & (1 << i)
+            )
+        return classes
+
+    def class_sort_key(self, cls):
+        return self.class_index.get(cls, len(self.valid_classes))
+
+# What a channel under settings -> channels may set for itself. The rest
+# (like the game servers and the IRC connections) is shared.
+CHANNEL_SETTINGS = {
+    'rules': None,
+    'database': None,
+    'network': ('admins', 'departure grace'),
+}
+
 def validate_settings(settings):
+    """Checks settings and compiles the rules, for network -> channel
+    and for every channel under settings -> channels.
+
+    Each channel's complete settings end up in settings -> channels,
+    the main channel's included; the top-level rules are the main
+    channel's.
+    """
+    if isinstance(settings['rules'], Rules):
+        return settings
+
+    _validate_servers(settings['servers'])
+    _validate_admins(settings['network']['admins'])
+
+    main = settings['network'].get('channel')
+    extra = settings.get('channels') or {}
+    base = dict((key, value) for key, value in settings.items() if key != 'channels')
+    channels = {}
+    for name, overrides in extra.items():
+        overrides = overrides or {}
+        for key, value in overrides.items():
+            if key not in CHANNEL_SETTINGS:
+                raise SettingsError('channels -> %s -> %s is shared by every channel, so it can only be set at the top level' % (name, key))
+            for subkey in value if CHANNEL_SETTINGS[key] is not None else ():
+                if subkey not in CHANNEL_SETTINGS[key]:
+                    raise SettingsError('channels -> %s -> %s -> %s is shared by every channel, so it can only be set at the top level' % (name, key, subkey))
+        channels[name] = _deep_merge(copy.deepcopy(base), overrides)
+    if main is not None and main not in channels:
+        channels[main] = copy.deepcopy(base)
+
+    databases = {}
+    for name in sorted(channels):
+        channel = channels[name]
+        channel['network']['channel'] = name
+        _validate_admins(channel['network']['admins'])
+        _validate_rules(channel)
+        database = channel['database']['name']
+        if database != ':memory:' and database in databases:
+            raise SettingsError('channels -> %s and %s both use the database %s; give each its own database -> name' % (
+                databases[database], name, database,
+            ))
+        databases[database] = name
+
+    if main is not None:
+        settings['rules'] = channels[main]['rules']
+    else:
+        settings['rules'] = _validate_rules(copy.deepcopy(base))['rules']
+    settings['channels'] = channels
+    return settings
+
+def _validate_servers(servers):
+    # These end up in commands sent over RCON (see brain.prepare_server)
+    for name, server in sorted(servers.items()):
+        for key in ('password', 'config', 'map'):
+            value = server.get(key)
+            if value and any(c in UNSAFE_CHARACTERS for c in '%s' % (value,)):
+                raise SettingsError('servers -> %s -> %s can\'t contain quotes, semicolons or line breaks' % (name, key))
+
+def _validate_admins(admins):
+    for mask in admins:
+        if '!' not in mask or '@' not in mask:
+            raise SettingsError('network -> admins has "%s", which should be a nick!user@host mask' % mask)
+
+def _validate_rules(settings):
     mode = settings['rules']['mode']
     if mode == 'highlander':
         settings['rules']['class limits'] = HIGHLANDER_SETTINGS['rules']['class limits']
@@ -97,12 +271,23 @@ def validate_settings(settings):
         raise SettingsError('Invalid setting rules -> mode, must be one of "highlander", "sixes", or "custom", not "%s"' % mode)
 
     picking = settings['rules']['picking']
-    if picking == 'random':
-        pass
-    elif picking == 'captain':
-        raise SettingsError("Captain picking isn't supported yet")
-    else:
-        raise SettingsError('Invalid setting rules -> picking, must be one of "random" or "captain", not "%s"' % picking)
+    if picking not in ('random', 'balanced', 'captain'):
+        raise SettingsError('Invalid setting rules -> picking, must be one of "random", "balanced" or "captain", not "%s"' % picking)
+
+    max_games = settings['rules']['max games']
+    if not isinstance(max_games, int) or max_games < 1:
+        raise SettingsError('Invalid setting rules -> max games, must be a whole number of at least 1, not "%s"' % max_games)
+
+    rules = settings['rules']
+    settings['rules'] = Rules(
+        mode=mode,
+        picking=picking,
+        balance_time=rules['balance time'],
+        captain_time=rules['captain pick time'],
+        max_games=max_games,
+        valid_classes=rules['valid classes'],
+        class_limits=rules['class limits'],
+    )
 
     return settings
 
@@ -111,7 +296,9 @@ def load_settings(filename=None):
         filename = path.abspath(path.join(path.dirname(__file__), '..', 'settings.yml'))
 
     with open(filename) as f:
-        settings = yaml.load(f)
+        # libyaml's parser, where PyYAML was built with it, is many times
+        # faster than the pure Python one
+        settings = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
     settings = _deep_merge(DEFAULT_BASE_SETTINGS, settings)
     settings = validate_settings(settings)
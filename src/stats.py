@@ -0,0 +1,72 @@
+"""Leaderboards: who has played the most PUGs, overall and as each class.
+
+Game counts only ever go up, so a player can only get onto a board by
+passing whoever is last on it. Each board just keeps its top few, and
+recording a game costs a handful of comparisons however many players
+there are.
+"""
+
+import heapq
+
+# How many players each board keeps
+TOP_SIZE = 10
+
+def _order(entry):
+    games, name = entry
+    return (-games, name)
+
+class Leaderboard(object):
+    def __init__(self, size=TOP_SIZE):
+        self.size = size
+        self._top = [] # [(games, name)], most games first
+
+    def fill(self, games_by_name):
+        """Replaces the board with the best of games_by_name, {'name': games}."""
+        entries = ((games, name) for name, games in games_by_name.iteritems() if games)
+        self._top = heapq.nsmallest(self.size, entries, key=_order)
+
+    def update(self, name, games):
+        """Takes name's new (higher) game count."""
+        top = [entry for entry in self._top if entry[1] != name]
+        if len(top) < self.size or _order((games, name)) < _order(top[-1]):
+            top.append((games, name))
+            top.sort(key=_order)
+            del top[self.size:]
+        self._top = top
+
+    def remove(self, name):
+        self._top = [entry for entry in self._top if entry[1] != name]
+
+    def top(self):
+        """Returns [('name', games)], most games first."""
+        return [(name, games) for games, name in self._top]
+
+class Leaderboards(object):
+    """A board overall and one per class, fed from an Experience."""
+    def __init__(self, experience, size=TOP_SIZE):
+        self.experience = experience
+        self.overall = Leaderboard(size)
+        self.by_class = dict((cls, Leaderboard(size)) for cls in experience.classes)
+        self.rebuild()
+
+    def rebuild(self):
+        counts = dict((name, self.experience.counts(name)) for name in self.experience.players())
+        self.overall.fill(dict((name, sum(classes.values())) for name, classes in counts.items()))
+        for cls, board in self.by_class.items():
+            board.fill(dict((name, classes.get(cls, 0)) for name, classes in counts.items()))
+
+    def played(self, name):
+        """Takes name's game counts after a pick."""
+        counts = self.experience.counts(name)
+        self.overall.update(name, sum(counts.values()))
+        for cls, games in counts.items():
+            self.by_class[cls].update(name, games)
+
+    def renamed(self, old_name, new_name):
+        for board in [self.overall] + self.by_class.values():
+            board.remove(old_name)
+        self.played(new_name)
+
+    def top(self, cls=None):
+        """Returns [('name', games)] for cls, or overall if it's None."""
+        return (self.overall if cls is None else self.by_class[cls]).top()
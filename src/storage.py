@@ -0,0 +1,148 @@
+import contextlib
+import sqlite3
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+
+# Recounts the per-player totals from the whole PUG history
+REBUILD_STATS = [
+    "DELETE FROM player_class_stats",
+    """
+    INSERT INTO player_class_stats (player_id, class, games, last_played)
+    SELECT player_id, class, COUNT(*), MAX(played_at) FROM player_pug_history GROUP BY player_id, class
+    """,
+    "DELETE FROM player_stats",
+    """
+    INSERT INTO player_stats (player_id, games, last_played)
+    SELECT player_id, SUM(games), MAX(last_played) FROM player_class_stats GROUP BY player_id
+    """,
+]
+
+# Each migration is a list of statements that takes the database from
+# one schema version (kept in PRAGMA user_version) to the next. Only
+# ever append to this list; existing databases are upgraded in place by
+# running whatever they haven't seen yet.
+MIGRATIONS = [
+    # 1: the original tables
+    [
+        """
+        CREATE TABLE IF NOT EXISTS player (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE ON CONFLICT IGNORE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS player_pug_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER,
+            class TEXT,
+            FOREIGN KEY(player_id) REFERENCES player(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS players_added (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER,
+            class TEXT,
+            FOREIGN KEY(player_id) REFERENCES player(id)
+        )
+        """,
+    ],
+    # 2: indexes for per-player lookups
+    [
+        "CREATE INDEX IF NOT EXISTS players_added_player_id ON players_added (player_id)",
+        "CREATE INDEX IF NOT EXISTS player_pug_history_player_class ON player_pug_history (player_id, class)",
+    ],
+    # 3: when each added player was written, so stale ones aren't
+    # restored (rows from before this have none, and aren't either)
+    [
+        "ALTER TABLE players_added ADD COLUMN added_at REAL",
+    ],
+    # 4: per-player totals, kept up to date with every pick so stats
+    # never need to go through the whole history
+    [
+        "ALTER TABLE player_pug_history ADD COLUMN played_at REAL",
+        """
+        CREATE TABLE IF NOT EXISTS player_class_stats (
+            player_id INTEGER,
+            class TEXT,
+            games INTEGER NOT NULL,
+            last_played REAL,
+            PRIMARY KEY (player_id, class),
+            FOREIGN KEY(player_id) REFERENCES player(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS player_stats (
+            player_id INTEGER PRIMARY KEY,
+            games INTEGER NOT NULL,
+            last_played REAL,
+            FOREIGN KEY(player_id) REFERENCES player(id)
+        )
+        """,
+    ] + REBUILD_STATS,
+]
+
+def connect(filename):
+    # The connection is handed over to a DatabaseThread after setup
+    conn = sqlite3.connect(filename, cached_statements=256, check_same_thread=False)
+    conn.isolation_level = None # Transactions are started explicitly
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+@contextlib.contextmanager
+def transaction(conn):
+    conn.execute("BEGIN")
+    try:
+        yield
+    except:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn, migrations=MIGRATIONS):
+    """Brings the database up to the latest schema version.
+
+    Each migration runs in its own transaction along with the version
+    bump, so an interrupted upgrade resumes where it stopped.
+    """
+    for version in range(schema_version(conn), len(migrations)):
+        with transaction(conn):
+            for statement in migrations[version]:
+                conn.execute(statement)
+            conn.execute("PRAGMA user_version = %i" % (version + 1))
+
+def rebuild_stats(conn):
+    """Recounts player_stats and player_class_stats from the history,
+    in case they ever disagree with it."""
+    with transaction(conn):
+        for statement in REBUILD_STATS:
+            conn.execute(statement)
+
+class DatabaseThread(object):
+    """Runs database work on a thread of its own, one call at a time.
+
+    Calls run in the order they were made, so a write made before a read
+    is always visible to it. Each returns a Deferred that fires on the
+    reactor thread with the result.
+    """
+    def __init__(self):
+        self._pool = threadpool.ThreadPool(minthreads=1, maxthreads=1, name='database')
+        self._pool.start()
+        reactor.addSystemEventTrigger('after', 'shutdown', self._pool.stop)
+
+    def run(self, f, *args, **kwargs):
+        return threads.deferToThreadPool(reactor, self._pool, f, *args, **kwargs)
+
+class InlineDatabase(object):
+    """Runs database work right away on the calling thread.
+
+    For scripts and tools that don't run the reactor.
+    """
+    def run(self, f, *args, **kwargs):
+        return defer.maybeDeferred(f, *args, **kwargs)
@@ -0,0 +1,11 @@
+"""The bot's tests, run with `make test` (or `trial tests`).
+
+The bot's modules are imported by plain name, like bin/bot does, and
+the stand-in servers from bench/ are used as the other end.
+"""
+
+import os
+import sys
+
+_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path[:0] = [os.path.join(_root, 'src'), os.path.join(_root, 'bench')]
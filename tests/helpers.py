@@ -0,0 +1,44 @@
+"""What several of the tests need: settings, a database that waits to
+be told to run, and ways to wait for Deferreds that fire on the reactor.
+"""
+
+from twisted.internet import defer, reactor, task
+
+import settings
+
+def make_settings(**overrides):
+    """The default settings with overrides, every database in memory."""
+    return settings.validate_settings(settings._deep_merge(settings.DEFAULT_BASE_SETTINGS, settings._deep_merge(
+        {'database': {'name': ':memory:'}}, overrides)))
+
+class QueuedDatabase(object):
+    """Holds on to database work until run_all, in the order it came,
+    like a DatabaseThread that's busy."""
+    def __init__(self):
+        self.queue = []
+
+    def run(self, f, *args, **kwargs):
+        d = defer.Deferred()
+        self.queue.append((d, f, args, kwargs))
+        return d
+
+    def run_all(self):
+        while self.queue:
+            d, f, args, kwargs = self.queue.pop(0)
+            defer.maybeDeferred(f, *args, **kwargs).chainDeferred(d)
+
+def finished(d):
+    """Returns a list that gets d's result once it has one, passing it on."""
+    result = []
+
+    def got(r):
+        result.append(r)
+        return r
+    d.addBoth(got)
+    return result
+
+@defer.inlineCallbacks
+def wait_until(condition):
+    """Lets the reactor run until condition() is true."""
+    while not condition():
+        yield task.deferLater(reactor, 0.005, lambda: None)
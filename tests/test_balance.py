@@ -0,0 +1,77 @@
+import random
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+import brain
+from balance import _team_difference, balanced_pick
+from tests.helpers import make_settings
+
+class FakeTimer(object):
+    """A timer that moves on by step every time it's read."""
+    def __init__(self, step):
+        self.step = step
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+class CountingSampler(object):
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.samples = 0
+
+    def sample(self):
+        self.samples += 1
+        return self.sampler.sample()
+
+    def players(self):
+        return self.sampler.players()
+
+class BalancedPickTest(unittest.TestCase):
+    def setUp(self):
+        self.brain = brain.BaseBotBrain(make_settings(rules={'mode': 'sixes', 'picking': 'balanced'}),
+                                        clock=task.Clock(), threaded=False)
+        self.addCleanup(self.brain.server_pool.stop)
+        self.brain.random.seed(4)
+        self.brain.balance_timer = FakeTimer(0.001)
+        history = random.Random(7)
+        classes = self.brain.rules.valid_classes
+        for i in range(self.brain.rules.game_size):
+            name = 'player%02i' % i
+            self.brain.roster.set_classes(name, classes)
+            # A few veterans among newcomers, so random teams come out uneven
+            veteran = history.random() < 0.3
+            for cls in classes:
+                self.brain.experience.add(name, cls, history.randint(0, 200 if veteran else 5))
+        self.scores = self.brain.experience_scores(self.brain.players_added())
+
+    def spread(self, pick, times=30):
+        return sum(abs(_team_difference(pick(), self.scores)) for _ in range(times)) / times
+
+    def test_evens_out_experience(self):
+        random_spread = self.spread(self.brain.random_pick)
+        balanced_spread = self.spread(self.brain.balanced_pick)
+        self.assertTrue(balanced_spread < random_spread / 4, (balanced_spread, random_spread))
+
+    def test_stays_within_budget(self):
+        timer = self.brain.balance_timer
+        sampler = CountingSampler(self.brain._roster_sampler())
+        start = timer.now
+        balanced_pick(sampler, self.scores, 0.02, timer=timer)
+        # Every candidate costs one read of the timer, plus one for the deadline
+        self.assertTrue(timer.now - start <= 0.02 + 2*timer.step, timer.now - start)
+        self.assertTrue(1 < sampler.samples <= 20, sampler.samples)
+
+    def test_brain_uses_balance_time(self):
+        timer = self.brain.balance_timer
+        start = timer.now
+        self.brain.balanced_pick()
+        self.assertTrue(timer.now - start <= self.brain.rules.balance_time + 2*timer.step, timer.now - start)
+
+    def test_no_budget_still_picks(self):
+        sampler = CountingSampler(self.brain._roster_sampler())
+        teams = balanced_pick(sampler, self.scores, 0, timer=self.brain.balance_timer)
+        self.assertEqual(sampler.samples, 1)
+        self.assertEqual(sum(len(players) for players in teams.values()), self.brain.rules.game_size)
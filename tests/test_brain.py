@@ -0,0 +1,198 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+import brain
+from tests.helpers import QueuedDatabase, make_settings
+
+def teams(*names):
+    """A pick with names playing scout, soldier, ... in turn on red."""
+    return {'red': dict(zip(names, ['scout', 'soldier', 'demo', 'medic'])), 'blu': {}}
+
+class SqliteBrainTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.brain = brain.SqliteBotBrain(make_settings(), clock=self.clock, threaded=False)
+        self.db = self.brain.db = QueuedDatabase()
+
+    def tearDown(self):
+        self.brain.server_pool.stop()
+        self.brain._conn.close()
+
+    def games(self, name):
+        stats = self.brain.player_stats(name)
+        return stats and stats['games']
+
+    def test_rebuild_counts_picks_recorded_meanwhile(self):
+        self.brain.record_pick(teams('alice', 'bob'))
+        rebuilt = self.brain.rebuild_stats()
+        self.clock.advance(60)
+        self.brain.record_pick(teams('alice', 'carol'))
+        self.assertEqual(self.games('alice'), 2)
+        self.db.run_all()
+        self.assertTrue(rebuilt.called)
+        self.assertEqual((self.games('alice'), self.games('bob'), self.games('carol')), (2, 1, 1))
+        self.assertEqual(self.brain.player_stats('carol')['last played'], self.clock.seconds())
+        self.assertEqual(self.brain.top_players(), [('alice', 2), ('bob', 1), ('carol', 1)])
+        self.assertEqual(self.brain._rebuilds, [])
+
+        # And it all agrees with the database
+        self.brain.rebuild_stats()
+        self.db.run_all()
+        self.assertEqual((self.games('alice'), self.games('bob'), self.games('carol')), (2, 1, 1))
+
+    def renamed(self, old_nick, new_nick):
+        d = self.brain.player_changed_name(old_nick, new_nick)
+        self.db.run_all()
+        return self.successResultOf(d)
+
+    def stored_names(self):
+        return sorted(name for name, in self.brain._conn.execute("SELECT name FROM player"))
+
+    def test_rename_moves_history(self):
+        self.brain.record_pick(teams('alice', 'bob'))
+        self.assertTrue(self.renamed('alice', 'alicia'))
+        self.assertEqual((self.games('alice'), self.games('alicia')), (None, 1))
+        self.assertEqual(self.stored_names(), ['alicia', 'bob'])
+
+    def test_rename_over_a_nick_that_only_added(self):
+        self.brain.record_pick(teams('alice', 'bob'))
+        self.brain.player_set_added_classes('alicia', ['medic'])
+        self.brain.flush()
+        self.db.run_all()
+        self.assertTrue(self.renamed('alice', 'alicia'))
+        self.assertEqual(self.games('alicia'), 1)
+        self.assertEqual(self.stored_names(), ['alicia', 'bob'])
+        self.assertEqual(list(self.brain._conn.execute("""
+        SELECT player.name, players_added.class FROM players_added JOIN player ON player.id = players_added.player_id
+        """)), [('alicia', 'medic')])
+
+    def test_rename_over_a_nick_with_history(self):
+        self.brain.record_pick(teams('alice', 'alicia'))
+        self.assertFalse(self.renamed('alice', 'alicia'))
+        self.assertEqual((self.games('alice'), self.games('alicia')), (1, 1))
+        self.assertEqual(self.stored_names(), ['alice', 'alicia'])
+
+    def added_rows(self):
+        return sorted(self.brain._conn.execute("""
+        SELECT player.name, players_added.class FROM players_added JOIN player ON player.id = players_added.player_id
+        """))
+
+    def test_changes_written_once_in_final_state(self):
+        writes = []
+        write_added = self.brain._write_added
+
+        def counted(classes_by_nickname, added_at):
+            writes.append(classes_by_nickname)
+            return write_added(classes_by_nickname, added_at)
+        self.brain._write_added = counted
+
+        delay = self.brain.settings['database']['flush delay']
+        self.brain.player_set_added_classes('alice', ['scout'])
+        self.brain.player_set_added_classes('bob', ['medic'])
+        self.brain.player_set_added_classes('alice', ['scout', 'demo'])
+        self.brain.player_set_added_classes('carol', ['soldier'])
+        self.brain.player_remove('carol')
+        self.brain.player_renamed('bob', 'robert')
+        self.clock.advance(delay / 2)
+        self.assertEqual((self.db.queue, self.added_rows()), ([], []))
+
+        self.clock.advance(delay / 2)
+        self.assertEqual(len(self.db.queue), 1)
+        self.db.run_all()
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(sorted(writes[0]), ['alice', 'bob', 'carol', 'robert'])
+        self.assertEqual(self.added_rows(), [('alice', 'demo'), ('alice', 'scout'), ('robert', 'medic')])
+
+        # Nothing more to write until something changes
+        self.clock.advance(delay * 10)
+        self.assertEqual(self.db.queue, [])
+        self.brain.player_remove('alice')
+        self.brain.flush()
+        self.db.run_all()
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(self.added_rows(), [('robert', 'medic')])
+
+class RestoreTest(unittest.TestCase):
+    def test_restored_count(self):
+        clock = task.Clock()
+        clock.advance(1000)
+        bot_settings = make_settings(database={'name': self.mktemp()})
+        before = brain.SqliteBotBrain(bot_settings, clock=clock, threaded=False)
+        before.server_pool.stop()
+        self.assertEqual(before.restored, 0)
+        before.roster.set_classes('alice', ['scout'])
+        before.roster.set_classes('bob', ['medic'])
+        before._mark_dirty('alice')
+        before._mark_dirty('bob')
+        before.flush()
+        before._conn.close()
+
+        after = brain.SqliteBotBrain(bot_settings, clock=clock, threaded=False)
+        after.server_pool.stop()
+        self.addCleanup(after._conn.close)
+        self.assertEqual(after.restored, 2)
+        self.assertEqual(after.roster.players(), ['alice', 'bob'])
+
+class PickGamesTest(unittest.TestCase):
+    LIMITS = {'scout': 2, 'medic': 1}
+
+    def setUp(self):
+        self.brain = self.make_brain(max_games=2)
+
+    def make_brain(self, max_games, servers=2):
+        my_brain = brain.BaseBotBrain(make_settings(
+            rules={'mode': 'custom', 'class limits': self.LIMITS, 'max games': max_games},
+            servers=dict(('server%i' % i, {'server': '10.0.0.%i' % i, 'port': 27015, 'password': 'pw'})
+                         for i in range(servers)),
+        ), clock=task.Clock(), threaded=False)
+        self.addCleanup(my_brain.server_pool.stop)
+        my_brain.random.seed(2)
+        return my_brain
+
+    def add(self, my_brain, count):
+        # Everyone can play medic, but only some scout, so the split matters
+        for i in range(count):
+            classes = ['medic', 'scout'] if i % 3 else ['medic']
+            my_brain.roster.set_classes('player%02i' % i, classes)
+
+    def assertLegal(self, teams, players):
+        for team in brain.TEAMS:
+            classes = sorted(teams[team].values())
+            self.assertEqual(classes, ['medic', 'scout', 'scout'])
+            for name, cls in teams[team].items():
+                self.assertIn(cls, players[name])
+
+    def classes(self, my_brain):
+        return dict((name, my_brain.roster.classes_of(name)) for name in my_brain.players_added())
+
+    def test_partition_is_disjoint(self):
+        self.add(self.brain, 2*self.brain.rules.game_size)
+        partition = self.brain._partition(2)
+        self.assertEqual(len(partition), 2)
+        self.assertEqual([len(masks) for masks in partition], [self.brain.rules.game_size]*2)
+        self.assertFalse(set(partition[0]) & set(partition[1]))
+
+    def test_two_games(self):
+        self.add(self.brain, 2*self.brain.rules.game_size)
+        players = self.classes(self.brain)
+        for _ in range(20):
+            games = self.brain.pick_games()
+            self.assertEqual(len(games), 2)
+            names = [set(name for team in teams.values() for name in team) for teams in games]
+            self.assertFalse(names[0] & names[1])
+            self.assertEqual(names[0] | names[1], set(players))
+            for teams in games:
+                self.assertLegal(teams, players)
+
+    def test_max_games(self):
+        one = self.make_brain(max_games=1)
+        self.add(one, 3*one.rules.game_size)
+        self.assertEqual(len(one.pick_games()), 1)
+        self.add(self.brain, 3*self.brain.rules.game_size)
+        self.assertEqual(len(self.brain.pick_games()), 2)
+
+    def test_servers_limit_games(self):
+        one_server = self.make_brain(max_games=2, servers=1)
+        self.add(one_server, 2*one_server.rules.game_size)
+        self.assertEqual(len(one_server.pick_games()), 1)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from twisted.internet import task
+from twisted.trial import unittest
+
+from capture import CaptureLog, read_log
+
+class CaptureLogTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = self.mktemp()
+        self.clock = task.Clock()
+        self.clock.advance(1000.25)
+
+    def test_round_trip(self):
+        events = [
+            ('join', ('alice', '#pugs')),
+            ('command', ('alice!a@host', '#pugs', '!add scout\tmedic')),
+            ('names', ('#pugs', '@alice bob\\ carol')),
+            ('command', ('bob!b@host', 'MixBot', '!add "line\nbreak"')),
+            ('nick', ('bob', 'b\xc3\xb6b')),
+            ('command', (u'z\xf6e!z@host', '#pugs', u'!add m\xe9dic ☃')),
+            ('quit', ('alice',)),
+        ]
+        log = CaptureLog(self.filename, self.clock)
+        for event, args in events:
+            log.write(event, args)
+            self.clock.advance(1)
+        log.close()
+
+        read = list(read_log(self.filename))
+        self.assertEqual([event for _, event, _ in read], [event for event, _ in events])
+        self.assertEqual([when for when, _, _ in read], [1000.25 + i for i in range(len(events))])
+        for (_, _, args), (_, written) in zip(read, events):
+            # Unicode comes back as the UTF-8 the bot received it in
+            self.assertEqual(args, tuple(arg.encode('utf-8') if isinstance(arg, unicode) else arg for arg in written))
+
+    def test_appends_and_skips_broken_lines(self):
+        log = CaptureLog(self.filename, self.clock)
+        log.write('quit', ('alice',))
+        log.close()
+        with open(self.filename, 'ab') as f:
+            f.write('1000.5\tquit\n')               # missing its user
+            f.write('1000.5\tsmile\talice\n')       # not an event
+            f.write('soon\tquit\tbob\n')            # no time
+        log = CaptureLog(self.filename, self.clock)
+        log.write('quit', ('carol',))
+        log.file.write('1001\tquit\tda')            # cut short
+        log.close()
+        self.assertEqual([args for _, _, args in read_log(self.filename)], [('alice',), ('carol',)])
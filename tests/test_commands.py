@@ -0,0 +1,78 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+import brain
+import commands
+from commands import time_ago
+from network import IRCBotFactory, Message
+from serverpool import NoServerAvailable
+from tests.helpers import make_settings
+
+class TimeAgoTest(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(time_ago(30), '0 minutes ago')
+        self.assertEqual(time_ago(60), '1 minute ago')
+        self.assertEqual(time_ago(59*60), '59 minutes ago')
+        self.assertEqual(time_ago(60*60), '1 hour ago')
+        self.assertEqual(time_ago(47*60*60), '47 hours ago')
+        self.assertEqual(time_ago(48*60*60), '2 days ago')
+
+class PickTest(unittest.TestCase):
+    def setUp(self):
+        clock = task.Clock()
+        bot_settings = make_settings(
+            network={'channel': '#pugs', 'bot names': ['MixBot']},
+            rules={'mode': 'custom', 'class limits': {'scout': 1, 'medic': 1}, 'max games': 2},
+            servers={
+                'one': {'server': '10.0.0.1', 'port': 27015, 'password': 'pw'},
+                'two': {'server': '10.0.0.2', 'port': 27015, 'password': 'pw'},
+            },
+        )
+        self.brain = brain.BaseBotBrain(bot_settings, clock=clock, threaded=False)
+        self.addCleanup(self.brain.server_pool.stop)
+        self.factory = IRCBotFactory(bot_settings, [('#pugs', self.brain)], clock=clock)
+        self.bot = self.factory.bots[0]
+        for i in range(2*self.brain.rules.game_size):
+            self.brain.roster.set_classes('player%i' % i, ['scout', 'medic'])
+            self.brain.matcher.player_changed('player%i' % i)
+
+    def pick(self):
+        return list(self.successResultOf(defer.maybeDeferred(commands.pick, self.bot, Message([], 'alice', False))))
+
+    def test_two_games(self):
+        lines = self.pick()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(self.brain.players_added(), [])
+
+    def test_fewer_servers_than_games(self):
+        # The other server is taken between counting and acquiring
+        get_server = self.brain.get_server
+        servers = []
+
+        def one_server():
+            if servers:
+                raise NoServerAvailable()
+            servers.append(get_server())
+            return servers[-1]
+        self.brain.get_server = one_server
+
+        lines = self.pick()
+        self.assertEqual(lines[-1], 'No server was free for another game, so its players are still added')
+        # One team line each for red and blu of the game that got a server
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(len(self.brain.players_added()), self.brain.rules.game_size)
+
+class StatsTest(unittest.TestCase):
+    def setUp(self):
+        bot_settings = make_settings(network={'channel': '#pugs', 'bot names': ['MixBot']}, rules={'mode': 'sixes'})
+        self.brain = brain.BaseBotBrain(bot_settings, clock=task.Clock(), threaded=False)
+        self.addCleanup(self.brain.server_pool.stop)
+        self.bot = IRCBotFactory(bot_settings, [('#pugs', self.brain)], clock=self.brain.clock).bots[0]
+
+    def test_classes_outside_the_rules(self):
+        # History from before the channel's rules changed
+        self.brain.player_stats = lambda nick: {
+            'games': 5, 'last played': None, 'classes': {'pyro': 2, 'medic': 2, 'scout': 1},
+        }
+        self.assertEqual(list(commands.stats(self.bot, Message(['alice'], 'bob', False))),
+                         ['alice has played 5 PUGs: medic 2, pyro 2, scout 1'])
@@ -0,0 +1,95 @@
+import random
+
+from twisted.trial import unittest
+
+from brain import TEAMS, Draft, PickingError
+from settings import Rules
+
+RULES = Rules('custom', 'captain', 0, 60, 1, ['scout', 'soldier', 'demo', 'medic'],
+              {'scout': 2, 'soldier': 1, 'medic': 1})
+
+class Exhaustive(object):
+    """Whether a draft can still be finished, found by trying every way
+    the captains could go on picking from here."""
+    def __init__(self, rules):
+        self.rules = rules
+        self._known = {}
+
+    def can_finish(self, masks, open_slots, turn):
+        """masks is {'player name': class bitmask} of who's left,
+        open_slots {'team': (slots left per class number)}."""
+        if not any(any(slots) for slots in open_slots.values()):
+            return True
+        key = (frozenset(masks.items()), tuple(open_slots[team] for team in TEAMS), turn)
+        if key not in self._known:
+            self._known[key] = any(
+                self.can_finish(*self.after(masks, open_slots, turn, name, cls))
+                for name, cls in self.moves(masks, open_slots[turn])
+            )
+        return self._known[key]
+
+    def moves(self, masks, slots):
+        for name, mask in masks.items():
+            for i, left in enumerate(slots):
+                if left and mask & (1 << i):
+                    yield name, i
+
+    def after(self, masks, open_slots, turn, name, cls, switch=True):
+        masks = dict(masks)
+        del masks[name]
+        open_slots = dict(open_slots)
+        slots = list(open_slots[turn])
+        slots[cls] -= 1
+        open_slots[turn] = tuple(slots)
+        other = TEAMS[1 - TEAMS.index(turn)]
+        if switch and any(open_slots[other]):
+            turn = other
+        return masks, open_slots, turn
+
+    def choices(self, masks, open_slots, team, turn, captain=False):
+        """What team may pick, as {'player name': class bitmask}. A
+        captain joining doesn't use up a turn."""
+        choices = {}
+        for name, cls in self.moves(masks, open_slots[team]):
+            masks_after, open_after, turn_after = self.after(masks, open_slots, team, name, cls, switch=not captain)
+            if self.can_finish(masks_after, open_after, turn if captain else turn_after):
+                choices[name] = choices.get(name, 0) | (1 << cls)
+        return choices
+
+def random_masks(rng, rules, players):
+    return dict(('player%d' % i, rng.randint(1, (1 << len(rules.valid_classes)) - 1)) for i in range(players))
+
+class DraftTest(unittest.TestCase):
+    def test_choices_match_exhaustive_search(self):
+        rng = random.Random(17)
+        exhaustive = Exhaustive(RULES)
+        drafts = 0
+        for _ in range(100):
+            masks = random_masks(rng, RULES, rng.randint(7, 10))
+            open_slots = dict((team, RULES.limits) for team in TEAMS)
+            try:
+                draft = Draft(RULES, masks)
+            except PickingError:
+                self.assertFalse(exhaustive.can_finish(masks, open_slots, TEAMS[0]))
+                continue
+            self.assertTrue(exhaustive.can_finish(masks, open_slots, TEAMS[0]))
+            drafts += 1
+
+            if rng.random() < 0.5:
+                for team in TEAMS:
+                    choices = draft.choices(team)
+                    self.assertEqual(choices, exhaustive.choices(masks, open_slots, team, draft.turn, captain=True))
+                    name = rng.choice(sorted(choices))
+                    self.assertTrue(draft.add_captain(team, name))
+                    cls = RULES.class_index[draft.teams[team][name]]
+                    masks, open_slots, _ = exhaustive.after(masks, open_slots, team, name, cls, switch=False)
+
+            while not draft.is_done():
+                turn = draft.turn
+                self.assertEqual(draft.choices(), exhaustive.choices(masks, open_slots, turn, turn))
+                name, cls = draft.auto_pick(rng)
+                masks, open_slots, turn = exhaustive.after(masks, open_slots, turn, name, RULES.class_index[cls])
+                self.assertEqual(draft.turn, turn)
+            self.assertEqual(sorted(len(team) for team in draft.teams.values()), [4, 4])
+        # Enough of them were possible to mean something
+        self.assertTrue(drafts > 30, drafts)
@@ -0,0 +1,58 @@
+import random
+
+from twisted.trial import unittest
+
+from brain import Roster
+from feasibility import SlotMatcher
+from settings import Rules
+
+RULES = Rules('custom', 'random', 0, 60, 2, ['scout', 'soldier', 'demo', 'medic'],
+              {'scout': 2, 'soldier': 1, 'medic': 1})
+
+def max_matching(masks, slots, rules):
+    """The size of a maximum assignment of players to slots, {'class':
+    count}, from scratch with Kuhn's algorithm."""
+    seats = [cls for cls, count in sorted(slots.items()) for _ in range(count)]
+    taken = {} # seat number: player name
+
+    def place(name, visited):
+        for seat, cls in enumerate(seats):
+            if masks[name] & rules.class_bit[cls] and seat not in visited:
+                visited.add(seat)
+                if seat not in taken or place(taken[seat], visited):
+                    taken[seat] = name
+                    return True
+        return False
+    return sum(place(name, set()) for name in sorted(masks))
+
+class SlotMatcherTest(unittest.TestCase):
+    def check(self, roster, matcher):
+        masks = roster.masks()
+        assignment = matcher.assignment()
+        for name, cls in assignment.items():
+            self.assertTrue(masks[name] & RULES.class_bit[cls], (name, cls))
+        for cls, count in matcher.slots.items():
+            self.assertTrue(assignment.values().count(cls) <= count, cls)
+        size = max_matching(masks, matcher.slots, RULES)
+        self.assertEqual(len(matcher), size)
+        self.assertEqual(matcher.is_complete(), size == matcher.total_slots)
+        self.assertEqual(bool(matcher.needed_classes()), not matcher.is_complete())
+
+    def test_matches_from_scratch(self):
+        rng = random.Random(2)
+        names = ['player%d' % i for i in range(24)]
+        for games in (1, 2):
+            for _ in range(20):
+                roster = Roster(RULES)
+                matcher = SlotMatcher(roster, RULES, games)
+                for _ in range(120):
+                    name = rng.choice(names)
+                    if rng.random() < 0.25:
+                        roster.remove(name)
+                    else:
+                        roster.set_mask(name, rng.randint(1, 15))
+                    matcher.player_changed(name)
+                    self.check(roster, matcher)
+                while matcher.total_slots:
+                    matcher.remove_slot(rng.choice([cls for cls, count in matcher.slots.items() if count]))
+                    self.check(roster, matcher)
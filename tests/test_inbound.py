@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import shlex
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from inbound import ALLOW, DROP, WARN, FloodControl, tokenize
+
+LIMITS = {
+    'commands per minute': 12,
+    'command burst': 5,
+    'same command per minute': 6,
+    'same command burst': 3,
+    'duplicate window': 3.0,
+    'warn': True,
+}
+
+class TokenizeTest(unittest.TestCase):
+    def test_like_shlex(self):
+        # What dispatch used to split with, wherever it didn't fail
+        for line in [
+            'scout soldier',
+            '  scout   soldier  ',
+            'scout\tsoldier',
+            '"Big Bob" medic',
+            "'Big Bob' medic",
+            '#channel.sixes scout',
+            '"" scout',
+            'caf\xc3\xa9 \xe2\x98\x83 "na\xc3\xafve one"',
+        ]:
+            self.assertEqual(tokenize(line), shlex.split(line), line)
+
+    def test_empty(self):
+        self.assertEqual(tokenize(''), [])
+        self.assertEqual(tokenize('   '), [])
+
+    def test_unbalanced_quotes(self):
+        # shlex.split raises on all of these
+        self.assertEqual(tokenize('"Big Bob'), ['"Big', 'Bob'])
+        self.assertEqual(tokenize("Bob's medic"), ["Bob's", 'medic'])
+        self.assertEqual(tokenize('scout "'), ['scout', '"'])
+
+    def test_unicode(self):
+        self.assertEqual(tokenize(u'caf\xe9 "☃ man"'), [u'caf\xe9', u'☃ man'])
+
+class FloodControlTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.flood = FloodControl(LIMITS, self.clock)
+
+    def check(self, nick, command, words=(), channel='#pug'):
+        return self.flood.check(nick, channel, command, list(words))
+
+    def test_same_command_bucket(self):
+        verdicts = [self.check('alice', 'add', [str(i)]) for i in range(4)]
+        self.assertEqual(verdicts, [ALLOW, ALLOW, ALLOW, WARN])
+        # Other commands have tokens left
+        self.assertEqual(self.check('alice', 'list'), ALLOW)
+        # One same-command token comes back every ten seconds
+        self.clock.advance(10)
+        self.assertEqual(self.check('alice', 'add', ['x']), ALLOW)
+
+    def test_nick_bucket(self):
+        verdicts = [self.check('alice', command) for command in ['a', 'b', 'c', 'd', 'e', 'f']]
+        self.assertEqual(verdicts, [ALLOW]*5 + [WARN])
+        # Everyone has their own
+        self.assertEqual(self.check('bob', 'a'), ALLOW)
+        self.clock.advance(5)
+        self.assertEqual(self.check('alice', 'g'), ALLOW)
+
+    def test_warns_once(self):
+        for command in 'abcde':
+            self.check('alice', command)
+        self.assertEqual([self.check('alice', command) for command in 'fgh'], [WARN, DROP, DROP])
+        # Back under the limit, then over it again: a new warning
+        self.clock.advance(5)
+        self.assertEqual(self.check('alice', 'i'), ALLOW)
+        self.assertEqual(self.check('alice', 'j'), WARN)
+
+    def test_no_warnings(self):
+        flood = FloodControl(dict(LIMITS, warn=False), self.clock)
+        verdicts = [flood.check('alice', '#pug', command, []) for command in 'abcdef']
+        self.assertEqual(verdicts, [ALLOW]*5 + [DROP])
+
+    def test_duplicate_window(self):
+        self.assertEqual(self.check('alice', 'add', ['scout']), ALLOW)
+        self.assertEqual(self.check('alice', 'add', ['scout']), DROP)
+        # Duplicates don't use up tokens
+        self.assertEqual(self.flood.senders['alice'].bucket.available(), LIMITS['command burst'] - 1)
+        # Different words, place or nick aren't duplicates
+        self.assertEqual(self.check('alice', 'add', ['medic']), ALLOW)
+        self.assertEqual(self.check('alice', 'add', ['scout'], channel='#other'), ALLOW)
+        self.assertEqual(self.check('bob', 'add', ['scout']), ALLOW)
+        self.clock.advance(LIMITS['duplicate window'])
+        self.assertEqual(self.check('bob', 'add', ['scout']), ALLOW)
+
+    def test_forgets_quiet_nicks(self):
+        self.check('alice', 'add')
+        self.clock.advance(self.flood.forget_after)
+        self.check('bob', 'add')
+        self.assertEqual(sorted(self.flood.senders), ['bob'])
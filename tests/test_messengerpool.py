@@ -0,0 +1,218 @@
+from twisted.internet import defer, error, task
+from twisted.trial import unittest
+
+import messengerpool
+import outbound
+from messengerpool import CONNECTED, IDLE, WAITING, MessengerPool
+from network import IRCMessenger
+from tests.helpers import make_settings
+
+class FakeTransport(object):
+    def __init__(self, messenger):
+        self.messenger = messenger
+        self.disconnecting = False
+
+    def abortConnection(self):
+        self.disconnecting = True
+        self.messenger.connectionLost()
+
+    loseConnection = abortConnection
+
+class FakeMessenger(object):
+    """Stands in for an IRCMessenger, handing itself to the factory."""
+    def __init__(self, factory, name):
+        self.factory = factory
+        self.name = self.nickname = name
+        self.should_dispatch = False
+        self.connected = True
+        self.transport = FakeTransport(self)
+        self.broken = False
+        self.sent = []
+        self.lines = []
+        self.reclaims = 0
+
+    def send_message(self, channel, message):
+        if self.broken:
+            raise error.ConnectionLost('broken')
+        self.sent.append((channel, message))
+
+    def sendLine(self, line):
+        self.lines.append(line)
+
+    def reclaim_nick(self):
+        self.reclaims += 1
+
+    def quit(self, reason):
+        self.transport.loseConnection()
+
+    def connectionLost(self):
+        self.connected = False
+        self.factory.transport_lost(self)
+        self.factory.pool.lost(self)
+
+class FakeFactory(object):
+    """What the pool needs from an IRCBotFactory. Connections only
+    happen when the test says so."""
+    def __init__(self, clock, **network):
+        self.settings = make_settings(network=dict({
+            'bot names': ['Bot1', 'Bot2', 'Bot3'],
+            'reconnect time': 1,
+            'max reconnect delay': 8,
+            'messages per minute': 60,
+            'message burst': 1,
+        }, **network))
+        self.clock = clock
+        self.outbound = outbound.MessageScheduler(clock)
+        self.transports = self.outbound.transports
+        self.pool = MessengerPool(self, self.settings['network'], clock)
+        self.outbound.send_failed = self.pool.send_failed
+        self.connecting = []
+
+    def connect(self, name):
+        d = defer.Deferred()
+        self.connecting.append((name, d))
+        return d
+
+    def succeed(self, name):
+        """Connects and signs on the pending attempt for name."""
+        d = self.pending(name)
+        messenger = FakeMessenger(self, name)
+        d.callback(messenger)
+        messenger.bucket = outbound.TokenBucket(1.0, 1, self.clock)
+        if self.pool.signed_on(messenger):
+            self.transports.append(messenger)
+        return messenger
+
+    def fail(self, name):
+        self.pending(name).errback(error.ConnectionRefusedError())
+
+    def pending(self, name):
+        for i, (pending, d) in enumerate(self.connecting):
+            if pending == name:
+                del self.connecting[i]
+                return d
+        raise AssertionError('%s is not connecting' % name)
+
+    def transport_lost(self, transport):
+        if transport in self.transports:
+            self.transports.remove(transport)
+
+class MessengerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def advance(self, seconds, step=0.5):
+        """Moves the clock on a step at a time, so that what it sets off
+        happens on time."""
+        for _ in range(int(seconds / step)):
+            self.clock.advance(step)
+
+    def start(self, **network):
+        factory = FakeFactory(self.clock, **network)
+        factory.pool.start()
+        self.addCleanup(factory.pool.stop)
+        self.clock.advance(0)
+        return factory
+
+    def test_backoff_doubles(self):
+        factory = self.start()
+        delays = []
+        for _ in range(6):
+            factory.fail('Bot1')
+            failed = self.clock.seconds()
+            while not factory.connecting:
+                self.clock.advance(0.5)
+            delays.append(self.clock.seconds() - failed)
+        self.assertEqual(delays, [1, 2, 4, 8, 8, 8])
+
+    def test_pong_resets_backoff(self):
+        factory = self.start()
+        factory.fail('Bot1')
+        self.clock.advance(1)
+        messenger = factory.succeed('Bot1')
+        self.clock.advance(factory.pool.ping_interval)
+        factory.pool.ponged(messenger)
+        self.assertEqual(factory.pool.slots['Bot1'].failures, 0)
+
+    def test_ping_timeout_reconnects(self):
+        factory = self.start()
+        messenger = factory.succeed('Bot1')
+        self.clock.advance(factory.pool.ping_interval)
+        self.assertEqual(len(messenger.lines), 1)
+        self.assertTrue(messenger.lines[0].startswith('PING '))
+        self.clock.advance(factory.pool.ping_timeout + 1)
+        self.assertFalse(messenger.connected)
+        self.assertEqual(factory.transports, [])
+        self.assertEqual(factory.pool.slots['Bot1'].state, WAITING)
+        self.clock.advance(1)
+        self.assertEqual([name for name, _ in factory.connecting], ['Bot1'])
+
+    def test_reclaims_nick_with_each_ping(self):
+        factory = self.start()
+        messenger = factory.succeed('Bot1')
+        messenger.nickname = 'Bot1_'
+        self.clock.advance(factory.pool.ping_interval)
+        self.assertEqual(messenger.reclaims, 1)
+
+    def test_send_errors_retire_messenger(self):
+        factory = self.start(**{'min bots': 2, 'max send errors': 2})
+        first = factory.succeed('Bot1')
+        self.clock.advance(1)
+        second = factory.succeed('Bot2')
+        first.broken = True
+        # Only the broken one has tokens to send with
+        second.bucket.tokens = 0
+        for i in range(4):
+            first.bucket.tokens = 1
+            factory.outbound.push('line %i' % i, '#pug')
+        self.assertEqual(first.sent + second.sent, [])
+        self.assertNotIn(first, factory.transports)
+        self.assertFalse(first.connected)
+        self.assertEqual(factory.pool.slots['Bot1'].state, WAITING)
+        # Nothing was lost on the way
+        self.advance(10)
+        self.assertEqual(second.sent, [('#pug', 'line %i' % i) for i in range(4)])
+
+    def test_pong_resets_send_errors(self):
+        factory = self.start(**{'max send errors': 2})
+        messenger = factory.succeed('Bot1')
+        slot = factory.pool.slots['Bot1']
+        factory.pool.send_failed(messenger, None)
+        self.clock.advance(factory.pool.ping_interval)
+        factory.pool.ponged(messenger)
+        self.assertEqual(slot.send_errors, 0)
+        self.assertEqual(slot.state, CONNECTED)
+
+    def test_scales_with_queue(self):
+        factory = self.start(**{'scale up backlog': 5, 'scale down after': 30})
+        factory.succeed('Bot1')
+        for i in range(20):
+            factory.outbound.push('line %i' % i, '#pug')
+        self.clock.advance(messengerpool.CHECK_INTERVAL)
+        self.assertEqual([name for name, _ in factory.connecting], ['Bot2'])
+        # One at a time
+        self.clock.advance(messengerpool.CHECK_INTERVAL)
+        self.assertEqual(len(factory.connecting), 1)
+        factory.succeed('Bot2')
+        self.clock.advance(messengerpool.CHECK_INTERVAL)
+        self.assertEqual([name for name, _ in factory.connecting], ['Bot3'])
+        factory.succeed('Bot3')
+        self.assertEqual(factory.pool.count(CONNECTED), 3)
+
+        # Once everything is sent and it stays quiet, back down to min bots
+        factory.transports[0].should_dispatch = True
+        for _ in range(60):
+            self.clock.advance(messengerpool.CHECK_INTERVAL)
+            for messenger in factory.transports:
+                if messenger.lines:
+                    factory.pool.ponged(messenger)
+        self.assertEqual(len(factory.outbound), 0)
+        self.clock.advance(100)
+        self.assertEqual(factory.pool.count(CONNECTED), 1)
+        self.assertEqual(factory.pool.slots['Bot1'].state, CONNECTED)
+        self.assertEqual(factory.pool.slots['Bot3'].state, IDLE)
+
+class IRCMessengerTest(unittest.TestCase):
+    def test_send_after_disconnect_fails(self):
+        messenger = IRCMessenger(None, 'Bot1')
+        self.assertRaises(error.ConnectionLost, messenger.send_message, '#pug', 'hello')
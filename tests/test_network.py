@@ -0,0 +1,79 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+import brain
+import commands  # registers the commands dispatch looks up
+import outbound
+import settings
+from network import IRCBotFactory, _mask_pattern
+from serverpool import ServerPool
+from tests.helpers import make_settings
+
+class AdminMaskTest(unittest.TestCase):
+    def test_wildcards(self):
+        admins = _mask_pattern(['alice!*@alice.users.example', 'b?b!~bob@*'])
+        self.assertTrue(admins.match('alice!alice@alice.users.example'))
+        self.assertTrue(admins.match('Alice!ali@ALICE.users.example'))
+        self.assertTrue(admins.match('bob!~bob@host.example'))
+        self.assertTrue(admins.match('bib!~bob@host.example'))
+        self.assertFalse(admins.match('alice!alice@evil.example'))
+        self.assertFalse(admins.match('alice'))
+        self.assertFalse(admins.match('boob!~bob@host.example'))
+
+    def test_brackets_are_literal(self):
+        admins = _mask_pattern(['[alice]!*@*'])
+        self.assertTrue(admins.match('[alice]!a@host'))
+        self.assertFalse(admins.match('a!a@host'))
+
+    def test_none(self):
+        self.assertFalse(_mask_pattern([]).match(''))
+        self.assertFalse(_mask_pattern([]).match('alice!a@host'))
+
+    def test_settings_want_masks(self):
+        make_settings(network={'admins': ['alice!*@*']})
+        self.assertRaises(settings.SettingsError, make_settings, network={'admins': ['alice']})
+
+class FakeMessenger(object):
+    nickname = 'MixBot'
+
+    def __init__(self, clock):
+        self.bucket = outbound.TokenBucket(1.0, 10, clock)
+        self.sent = []
+
+    def send_message(self, channel, message):
+        self.sent.append((channel, message))
+
+    def max_targets(self):
+        return None
+
+class ChannelRoutingTest(unittest.TestCase):
+    def setUp(self):
+        clock = task.Clock()
+        bot_settings = make_settings(network={'channel': '#a', 'bot names': ['MixBot']},
+                                     channels={'#b': {}})
+        server_pool = ServerPool({}, bot_settings['server pool'], clock=clock)
+        self.brains = dict(
+            (channel, brain.BaseBotBrain(bot_settings['channels'][channel], clock=clock, threaded=False,
+                                         server_pool=server_pool))
+            for channel in ('#a', '#b')
+        )
+        self.factory = IRCBotFactory(bot_settings, sorted(self.brains.items()), clock=clock)
+        self.messenger = FakeMessenger(clock)
+        self.factory.transports.append(self.messenger)
+
+    def added(self, channel):
+        return self.brains[channel].players_added()
+
+    def test_channel_command(self):
+        self.factory.received('command', 'alice!a@host', '#b', '!add scout')
+        self.assertEqual((self.added('#a'), self.added('#b')), ([], ['alice']))
+        self.assertEqual(self.messenger.sent, [('#b', 'Players added: alice')])
+
+    def test_pm_to_main_channel(self):
+        self.factory.received('command', 'alice!a@host', 'alice', '!add scout')
+        self.assertEqual((self.added('#a'), self.added('#b')), (['alice'], []))
+        self.assertEqual(self.messenger.sent, [('alice', 'Players added: alice')])
+
+    def test_pm_naming_channel(self):
+        self.factory.received('command', 'alice!a@host', 'alice', '!add #B scout')
+        self.assertEqual((self.added('#a'), self.added('#b')), ([], ['alice']))
@@ -0,0 +1,47 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+from outbound import NOTICE, REPLY, MessageScheduler, TokenBucket
+
+class Transport(object):
+    nickname = 'Bot'
+
+    def __init__(self, clock):
+        self.bucket = TokenBucket(1.0, 1, clock)
+        self.sent = []
+
+    def send_message(self, message, channel):
+        self.sent.append((channel, message))
+
+class MessageSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = MessageScheduler(self.clock)
+        self.transport = Transport(self.clock)
+        self.transport.bucket.take()
+        self.scheduler.transports.append(self.transport)
+
+    def send_all(self):
+        while len(self.scheduler):
+            self.clock.advance(1)
+        return self.transport.sent
+
+    def test_drops_any_waiting_duplicate(self):
+        for message in ['a', 'b', 'a', 'c', 'b']:
+            self.scheduler.push(message, '#pug')
+        self.scheduler.push('a', '#other')
+        self.assertEqual(self.send_all(), [('#pug', 'a'), ('#other', 'a'), ('#pug', 'b'), ('#pug', 'c')])
+
+    def test_sends_again_once_sent(self):
+        self.scheduler.push('a', '#pug')
+        self.send_all()
+        self.scheduler.push('a', '#pug')
+        self.assertEqual(self.send_all(), [('#pug', 'a'), ('#pug', 'a')])
+
+    def test_more_urgent_duplicate_is_queued(self):
+        self.scheduler.push('a', '#pug', priority=REPLY)
+        self.scheduler.push('a', '#pug', priority=NOTICE)
+        self.assertEqual(len(self.scheduler), 1)
+        self.scheduler.push('b', '#pug', priority=NOTICE)
+        self.scheduler.push('b', '#pug', priority=REPLY)
+        self.assertEqual(len(self.scheduler), 3)
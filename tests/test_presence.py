@@ -0,0 +1,68 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+import brain
+from presence import Presence, irc_lower
+from tests.helpers import make_settings
+
+GRACE = 120
+
+class FakeDispatcher(object):
+    def __init__(self):
+        self.sent = []
+
+    def queue_message(self, message, channel=None, priority=None):
+        self.sent.append(message)
+
+class PresenceTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.brain = brain.BaseBotBrain(make_settings(), clock=self.clock, threaded=False)
+        self.addCleanup(self.brain.server_pool.stop)
+        self.brain.dispatcher = FakeDispatcher()
+        self.presence = Presence(self.brain, GRACE, self.clock)
+        self.presence.names(['@Foo', 'bar', '+Baz[m]'])
+        self.presence.names_end()
+        self.brain.player_set_added_classes('Foo', ['scout'])
+
+    def test_irc_lower(self):
+        self.assertEqual(irc_lower('FOO[]\\~'), 'foo{}|^')
+        self.assertEqual(irc_lower('foo{}|^'), 'foo{}|^')
+
+    def test_members_ignore_case(self):
+        for nick in ('Foo', 'foo', 'FOO', 'BAZ{M}'):
+            self.assertIn(nick, self.presence)
+        self.assertNotIn('qux', self.presence)
+        self.presence.joined('QUX')
+        self.presence.left('qux')
+        self.assertEqual(len(self.presence), 3)
+
+    def test_removed_after_grace(self):
+        self.presence.left('foo')
+        self.clock.advance(GRACE - 1)
+        self.assertEqual(self.brain.players_added(), ['Foo'])
+        self.clock.advance(1)
+        self.assertEqual(self.brain.players_added(), [])
+        self.assertEqual(self.brain.dispatcher.sent, ['Removed Foo (left the channel)'])
+
+    def test_kept_if_back_within_grace(self):
+        self.presence.left('Foo')
+        self.clock.advance(GRACE - 1)
+        self.presence.joined('FOO')
+        self.clock.advance(GRACE)
+        self.assertEqual(self.brain.players_added(), ['Foo'])
+        self.assertEqual(self.brain.dispatcher.sent, [])
+
+    def test_kept_if_in_names(self):
+        self.presence.left('Foo')
+        self.presence.names(['foo'])
+        self.presence.names_end()
+        self.clock.advance(GRACE)
+        self.assertEqual(self.brain.players_added(), ['Foo'])
+
+    def test_rename_keeps_classes(self):
+        self.presence.renamed('FOO', 'Foo2')
+        self.assertEqual(self.brain.players_added(), ['Foo2'])
+        self.presence.left('foo2')
+        self.clock.advance(GRACE)
+        self.assertEqual(self.brain.players_added(), [])
@@ -0,0 +1,110 @@
+from twisted.internet import defer, error, reactor, task
+from twisted.trial import unittest
+
+from fakercon import FakeRCONServer, PACKET_BODY
+from rcon import AuthenticationError, RCONClient, RCONError, quote_argument
+from tests.helpers import finished, wait_until
+
+TIMEOUT = 5.0
+
+class QuoteTest(unittest.TestCase):
+    def test_quote(self):
+        self.assertEqual(quote_argument('cp_badlands'), '"cp_badlands"')
+        self.assertEqual(quote_argument(1234), '"1234"')
+
+    def test_unsafe(self):
+        for argument in ('a"; rcon_password x', 'a;quit', 'a\nquit', 'a\rquit'):
+            self.assertRaises(RCONError, quote_argument, argument)
+
+class RCONClientTest(unittest.TestCase):
+    """An RCONClient (timing out on a task.Clock) against the stand-in server."""
+    def setUp(self):
+        self.clock = task.Clock()
+        self.server = FakeRCONServer('secret')
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        self.clients = []
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        yield wait_until(lambda: not self.server.connections)
+        yield self.port.stopListening()
+
+    def client(self, password='secret', retries=0):
+        client = RCONClient('127.0.0.1', self.port.getHost().port, password, TIMEOUT, retries, clock=self.clock)
+        self.clients.append(client)
+        return client
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        self.server.responses['status'] = 'hostname: Test'
+        responses = yield self.client().run(['status', 'sv_password "x"'])
+        self.assertEqual(responses, ['hostname: Test', ''])
+        self.assertEqual(self.server.commands, ['status', 'sv_password "x"'])
+
+    @defer.inlineCallbacks
+    def test_multi_packet_response(self):
+        long_response = ''.join(chr(ord('a') + i % 26) for i in xrange(3*PACKET_BODY + 100))
+        self.server.responses['cvarlist'] = long_response
+        responses = yield self.client().run(['cvarlist', 'status'])
+        self.assertEqual(responses, [long_response, ''])
+
+    @defer.inlineCallbacks
+    def test_keeps_connection(self):
+        client = self.client()
+        yield client.run(['status'])
+        yield client.run(['status'])
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_wrong_password(self):
+        d = self.client(password='wrong', retries=2).run(['status'])
+        d = self.assertFailure(d, AuthenticationError)
+        # Trying again wouldn't help
+        return d.addCallback(lambda _: self.assertEqual(self.server.commands, []))
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        self.server.hang.add('status')
+        d = self.client(retries=1).run(['status'])
+        result = finished(d)
+        for attempt in (1, 2):
+            yield wait_until(lambda: len(self.server.commands) == attempt)
+            self.assertEqual(result, [])
+            self.clock.advance(TIMEOUT)
+        yield self.assertFailure(d, error.TimeoutError)
+
+    @defer.inlineCallbacks
+    def test_timeout_fails_only_its_batch(self):
+        client = self.client()
+        yield client.run(['status'])
+        self.server.hang.add('stuck')
+        stuck = client.run(['stuck'])
+        self.clock.advance(TIMEOUT / 2)
+        # Sent on the same connection, which has stopped answering
+        waiting = client.run(['status'])
+        result = finished(waiting)
+        yield wait_until(lambda: len(self.server.commands) == 3)
+        self.clock.advance(TIMEOUT / 2)
+        yield self.assertFailure(stuck, error.TimeoutError)
+        self.assertEqual(result, [])
+
+        # Later batches get a new connection
+        responses = yield client.run(['status'])
+        self.assertEqual(responses, [''])
+        self.assertEqual(len(self.server.connections), 2)
+
+        # The old one is closed once nothing is waiting on it
+        self.clock.advance(TIMEOUT / 2)
+        yield self.assertFailure(waiting, error.TimeoutError)
+        yield wait_until(lambda: len(self.server.connections) == 1)
+
+    @defer.inlineCallbacks
+    def test_retries_lost_connection(self):
+        client = self.client(retries=1)
+        yield client.run(['status'])
+        for connection in list(self.server.connections):
+            connection.transport.loseConnection()
+        yield wait_until(lambda: not self.server.connections)
+        responses = yield client.run(['status'])
+        self.assertEqual(responses, [''])
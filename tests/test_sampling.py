@@ -0,0 +1,81 @@
+import math
+import random
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+import brain
+from sampling import TeamSampler
+from settings import Rules
+from tests.helpers import make_settings
+
+RULES = Rules('custom', 'random', 0, 60, 1, ['scout', 'soldier', 'medic'],
+              {'scout': 1, 'soldier': 1, 'medic': 1})
+
+MASKS = {
+    'alice': 1, 'bob': 1, 'carol': 3, 'dave': 2,
+    'erin': 6, 'frank': 4, 'grace': 7, 'heidi': 5,
+}
+
+def every_pick(masks, rules):
+    """Every valid pick, each as a frozenset of (name, team, class)."""
+    slots = [(team, cls) for team in brain.TEAMS for cls, limit in sorted(rules.class_limits.items())
+             for _ in range(limit)]
+    picks = set()
+
+    def fill(slot, left, pick):
+        if slot == len(slots):
+            picks.add(frozenset(pick))
+            return
+        team, cls = slots[slot]
+        for name in sorted(left):
+            if masks[name] & rules.class_bit[cls]:
+                fill(slot + 1, left - set([name]), pick + [(name, team, cls)])
+    fill(0, set(masks), [])
+    return picks
+
+def as_set(teams):
+    return frozenset((name, team, cls) for team, players in teams.items() for name, cls in players.items())
+
+class TeamSamplerTest(unittest.TestCase):
+    def test_uniform(self):
+        picks = every_pick(MASKS, RULES)
+        sampler = TeamSampler(MASKS, RULES, rng=random.Random(3))
+        per_pick = 20
+        counts = dict((pick, 0) for pick in picks)
+        for _ in range(per_pick*len(picks)):
+            pick = as_set(sampler.sample())
+            self.assertIn(pick, counts)
+            counts[pick] += 1
+
+        # Pearson's chi-squared against every pick being equally likely,
+        # allowing about four standard deviations over what it averages
+        df = len(picks) - 1
+        chi2 = sum((count - per_pick)**2 / float(per_pick) for count in counts.values())
+        self.assertTrue(chi2 < df + 4*math.sqrt(2*df), (chi2, df))
+
+    def test_players(self):
+        self.assertEqual(TeamSampler(dict(MASKS, zoe=8), RULES).players(), sorted(MASKS))
+
+    def test_impossible(self):
+        self.assertFalse(TeamSampler({'alice': 1, 'bob': 2}, RULES))
+
+class RosterSamplerTest(unittest.TestCase):
+    def setUp(self):
+        self.brain = brain.BaseBotBrain(make_settings(rules={
+            'mode': 'custom', 'class limits': RULES.class_limits,
+        }), clock=task.Clock(), threaded=False)
+        for name, mask in MASKS.items():
+            self.brain.roster.set_mask(name, mask)
+
+    def tearDown(self):
+        self.brain.server_pool.stop()
+
+    def test_kept_until_roster_changes(self):
+        sampler = self.brain._roster_sampler()
+        self.brain.random_pick()
+        self.assertIs(self.brain._roster_sampler(), sampler)
+        self.brain.roster.remove('alice')
+        changed = self.brain._roster_sampler()
+        self.assertIsNot(changed, sampler)
+        self.assertNotIn('alice', changed.players())
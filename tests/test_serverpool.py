@@ -0,0 +1,211 @@
+from twisted.internet import defer, error, reactor, task
+from twisted.trial import unittest
+
+import serverpool
+from fakesrcds import FakeSourceServer
+from serverpool import A2SClient, A2SError, NoServerAvailable, ServerPool, parse_info
+
+POOL_SETTINGS = {
+    'probe interval': 30,
+    'probe timeout': 2.0,
+    'max age': 90,
+    'hold time': 300,
+}
+
+class ParseInfoTest(unittest.TestCase):
+    def test_reply(self):
+        info = parse_info(FakeSourceServer(name='Test', map_name='koth_viaduct', players=7, bots=2).info())
+        self.assertEqual(info, {'name': 'Test', 'map': 'koth_viaduct', 'players': 7, 'max players': 24, 'bots': 2})
+
+    def test_not_a_reply(self):
+        self.assertRaises(A2SError, parse_info, serverpool.A2S_HEADER + 'Afoo')
+        self.assertRaises(A2SError, parse_info, 'garbage')
+
+    def test_truncated(self):
+        data = FakeSourceServer().info()
+        for end in (10, data.index('tf\x00'), len(data) - 10):
+            self.assertRaises(A2SError, parse_info, data[:end])
+
+class FakeServersMixin(object):
+    """Stand-in game servers and a pool (on a task.Clock) to probe them."""
+    def setUp(self):
+        self.clock = task.Clock()
+        self.ports = []
+        self.fakes = {}
+
+    def tearDown(self):
+        return defer.gatherResults([port.stopListening() for port in self.ports])
+
+    def listen(self, protocol):
+        port = reactor.listenUDP(0, protocol, interface='127.0.0.1')
+        self.ports.append(port)
+        return port.getHost().port
+
+    def make_pool(self, **fakes):
+        servers = {}
+        for name, fake in fakes.items():
+            servers[name] = {'server': '127.0.0.1', 'port': 27015, 'query port': self.listen(fake)}
+        self.fakes.update(fakes)
+        pool = ServerPool(servers, POOL_SETTINGS, clock=self.clock)
+        self.listen(pool.client)
+        self.addCleanup(pool.stop)
+        return pool
+
+    def probe_all(self, pool):
+        """Probes every server, letting the silent ones time out."""
+        probed = pool.probe_all()
+        answering = [name for name in sorted(pool.servers) if not self.fakes[name].silent]
+        # Waiting on a probe that's already running shares its answer
+        d = defer.gatherResults([pool.client.query(
+            ('127.0.0.1', pool.servers[name]['query port']), pool.timeout,
+        ) for name in answering])
+
+        def time_out(result):
+            # Only the silent ones are left waiting
+            self.clock.advance(pool.timeout)
+            return probed
+        return d.addCallback(time_out)
+
+class A2SClientTest(FakeServersMixin, unittest.TestCase):
+    def setUp(self):
+        FakeServersMixin.setUp(self)
+        self.client = A2SClient(self.clock)
+        self.client_port = self.listen(self.client)
+
+    @defer.inlineCallbacks
+    def test_query(self):
+        fake = FakeSourceServer(players=3)
+        info = yield self.client.query(('127.0.0.1', self.listen(fake)), 2.0)
+        self.assertEqual(info['players'], 3)
+        self.assertEqual(info['latency'], 0)
+        self.assertEqual(fake.queries, 1)
+
+    @defer.inlineCallbacks
+    def test_challenge(self):
+        fake = FakeSourceServer(players=3, challenge=True)
+        info = yield self.client.query(('127.0.0.1', self.listen(fake)), 2.0)
+        self.assertEqual(info['players'], 3)
+        # Once without the challenge, once with it
+        self.assertEqual(fake.queries, 2)
+
+    def test_timeout(self):
+        fake = FakeSourceServer()
+        fake.silent = True
+        d = self.client.query(('127.0.0.1', self.listen(fake)), 2.0)
+        self.clock.advance(2.0)
+        return self.assertFailure(d, error.TimeoutError)
+
+    @defer.inlineCallbacks
+    def test_shared_query(self):
+        fake = FakeSourceServer()
+        address = ('127.0.0.1', self.listen(fake))
+        infos = yield defer.gatherResults([self.client.query(address, 2.0), self.client.query(address, 2.0)])
+        self.assertEqual(infos[0], infos[1])
+        self.assertEqual(fake.queries, 1)
+
+class ServerPoolTest(FakeServersMixin, unittest.TestCase):
+    def silent(self):
+        fake = FakeSourceServer()
+        fake.silent = True
+        return fake
+
+    @defer.inlineCallbacks
+    def test_states(self):
+        pool = self.make_pool(empty=FakeSourceServer(), busy=FakeSourceServer(players=4), down=self.silent(),
+                              bots=FakeSourceServer(players=2, bots=2))
+        yield self.probe_all(pool)
+        states = dict((name, status['state']) for name, status in pool.status.items())
+        self.assertEqual(states, {
+            'empty': serverpool.EMPTY,
+            'busy': serverpool.BUSY,
+            'down': serverpool.UNKNOWN,
+            'bots': serverpool.EMPTY,
+        })
+        self.assertEqual(pool.status['down']['latency'], None)
+        self.assertEqual(pool.free(), 3)
+
+    @defer.inlineCallbacks
+    def test_timeout_forgets_answer(self):
+        fake = FakeSourceServer()
+        pool = self.make_pool(s0=fake)
+        yield self.probe_all(pool)
+        self.assertEqual(pool.status['s0']['state'], serverpool.EMPTY)
+        fake.silent = True
+        yield self.probe_all(pool)
+        self.assertEqual(pool.status['s0']['state'], serverpool.UNKNOWN)
+        self.assertEqual(pool.status['s0']['players'], None)
+
+    @defer.inlineCallbacks
+    def test_answer_expires(self):
+        pool = self.make_pool(s0=FakeSourceServer())
+        yield self.probe_all(pool)
+        self.clock.advance(POOL_SETTINGS['max age'])
+        self.assertEqual(pool.status['s0']['state'], serverpool.UNKNOWN)
+
+    @defer.inlineCallbacks
+    def test_acquire_order(self):
+        pool = self.make_pool(s0=FakeSourceServer(), s1=FakeSourceServer(players=5), s2=self.silent())
+        yield self.probe_all(pool)
+        # Empty first, then unknown, never busy, and never twice
+        self.assertEqual(pool.acquire(), 's0')
+        self.assertEqual(pool.acquire(), 's2')
+        self.assertRaises(NoServerAvailable, pool.acquire)
+        self.assertEqual(pool.free(), 0)
+
+    @defer.inlineCallbacks
+    def test_least_recently_used(self):
+        pool = self.make_pool(a=FakeSourceServer(), b=FakeSourceServer(), c=FakeSourceServer())
+        yield self.probe_all(pool)
+        order = []
+        for _ in xrange(6):
+            order.append(pool.acquire())
+            self.clock.advance(POOL_SETTINGS['hold time'])
+            yield self.probe_all(pool)
+        self.assertEqual(order, ['a', 'b', 'c', 'a', 'b', 'c'])
+
+    @defer.inlineCallbacks
+    def test_reserved_until_players_join(self):
+        fake = FakeSourceServer()
+        pool = self.make_pool(s0=fake)
+        yield self.probe_all(pool)
+        pool.acquire()
+        # Nobody has joined yet
+        yield self.probe_all(pool)
+        self.assertEqual(pool.status['s0']['state'], serverpool.RESERVED)
+        fake.players = 12
+        yield self.probe_all(pool)
+        self.assertEqual(pool.status['s0']['state'], serverpool.BUSY)
+        fake.players = 0
+        yield self.probe_all(pool)
+        self.assertEqual(pool.acquire(), 's0')
+
+    @defer.inlineCallbacks
+    def test_reserved_until_hold_time(self):
+        fake = FakeSourceServer()
+        pool = self.make_pool(s0=fake)
+        yield self.probe_all(pool)
+        pool.acquire()
+        fake.silent = True
+        yield self.probe_all(pool)
+        self.assertEqual(pool.status['s0']['state'], serverpool.RESERVED)
+        self.clock.advance(POOL_SETTINGS['hold time'])
+        self.assertEqual(pool.status['s0']['state'], serverpool.UNKNOWN)
+        self.assertEqual(pool.acquire(), 's0')
+
+    def test_heaps_stay_small(self):
+        pool = ServerPool(dict(('s%i' % i, {'server': '127.0.0.1', 'port': 27015}) for i in range(4)),
+                          POOL_SETTINGS, clock=self.clock)
+        self.addCleanup(pool.stop)
+        # Servers going between empty and busy, for a long uptime
+        # without a PUG ever being picked
+        for players in [0, 5] * 500:
+            for name in sorted(pool.servers):
+                pool._probed({'players': players, 'bots': 0, 'latency': 0.01}, name)
+            self.assertTrue(all(len(heap) <= 2*len(pool.servers) for heap in pool._heaps.values()))
+            self.assertEqual(pool.free(), 4 if players == 0 else 0)
+        for players in [5, 0] * 10:
+            pool._probed({'players': players, 'bots': 0, 'latency': 0.01}, 's2')
+        self.assertEqual(pool.free(), 1)
+        self.assertEqual(pool.acquire(), 's2')
+        self.assertEqual(pool.free(), 0)
+        self.assertRaises(NoServerAvailable, pool.acquire)
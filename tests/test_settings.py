@@ -0,0 +1,71 @@
+from twisted.trial import unittest
+
+from settings import Rules, SettingsError
+from tests.helpers import make_settings
+
+class ChannelSettingsTest(unittest.TestCase):
+    def test_shared_key_rejected(self):
+        self.assertRaises(SettingsError, make_settings, network={'channel': '#a'},
+                          channels={'#b': {'servers': {}}})
+        self.assertRaises(SettingsError, make_settings, network={'channel': '#a'},
+                          channels={'#b': {'network': {'bot names': ['Other']}}})
+
+    def test_channel_overrides(self):
+        bot_settings = make_settings(network={'channel': '#a', 'admins': ['alice!*@*']}, channels={
+            '#b': {'network': {'admins': ['bob!*@*']}, 'rules': {'mode': 'sixes'}},
+        })
+        channels = bot_settings['channels']
+        self.assertEqual(sorted(channels), ['#a', '#b'])
+        self.assertEqual(channels['#a']['network']['admins'], ['alice!*@*'])
+        self.assertEqual(channels['#b']['network']['admins'], ['bob!*@*'])
+        self.assertEqual(channels['#b']['network']['channel'], '#b')
+
+    def test_rules_per_channel(self):
+        bot_settings = make_settings(network={'channel': '#a'}, channels={'#b': {'rules': {'mode': 'sixes'}}})
+        a, b = bot_settings['channels']['#a']['rules'], bot_settings['channels']['#b']['rules']
+        self.assertIsInstance(a, Rules)
+        self.assertIsInstance(b, Rules)
+        self.assertEqual((a.mode, b.mode), ('highlander', 'sixes'))
+        self.assertIs(bot_settings['rules'], a)
+
+    def test_same_database_rejected(self):
+        self.assertRaises(SettingsError, make_settings, database={'name': 'bot.sqlite'},
+                          network={'channel': '#a'}, channels={'#b': {}})
+        make_settings(database={'name': 'a.sqlite'}, network={'channel': '#a'},
+                      channels={'#b': {'database': {'name': 'b.sqlite'}}})
+        # In memory, each channel gets its own anyway
+        make_settings(network={'channel': '#a'}, channels={'#b': {}})
+
+class RulesTest(unittest.TestCase):
+    def setUp(self):
+        self.rules = Rules('custom', 'random', 0.02, 60, 1, ['scout', 'soldier', 'demo', 'medic'],
+                           {'scout': 2, 'soldier': 2, 'medic': 1})
+
+    def test_immutable(self):
+        self.assertRaises(AttributeError, setattr, self.rules, 'max_games', 2)
+        self.assertRaises(AttributeError, setattr, self.rules, 'new', 1)
+        self.assertEqual(self.rules.max_games, 1)
+
+    def test_compiled(self):
+        self.assertEqual(self.rules.limits, (2, 2, 0, 1))
+        self.assertEqual(self.rules.class_limits, {'scout': 2, 'soldier': 2, 'medic': 1})
+        self.assertEqual(self.rules.game_size, 10)
+        self.assertEqual(self.rules.classes_in(self.rules.pickable), ('scout', 'soldier', 'medic'))
+
+    def test_mask_round_trip(self):
+        for classes in [(), ('scout',), ('soldier', 'demo'), ('scout', 'soldier', 'demo', 'medic')]:
+            self.assertEqual(self.rules.classes_in(self.rules.mask(classes)), classes)
+        # Order and repeats don't matter, and unknown classes are left out
+        self.assertEqual(self.rules.mask(['medic', 'scout', 'scout', 'pyro']), self.rules.mask(['scout', 'medic']))
+        for mask in range(1 << len(self.rules.valid_classes)):
+            self.assertEqual(self.rules.mask(self.rules.classes_in(mask)), mask)
+
+    def test_class_sort_key(self):
+        self.assertEqual(sorted(['medic', 'pyro', 'scout'], key=self.rules.class_sort_key), ['scout', 'medic', 'pyro'])
+
+    def test_limits_on_unknown_classes(self):
+        self.assertRaises(SettingsError, Rules, 'custom', 'random', 0.02, 60, 1, ['scout'], {'scout': 1, 'pyro': 1})
+        self.assertRaises(SettingsError, make_settings, rules={
+            'mode': 'custom', 'valid classes': ['scout'], 'class limits': {'scout': 1, 'pyro': 1},
+        })
+        self.assertRaises(SettingsError, make_settings, rules={'mode': 'custom'})
@@ -0,0 +1,107 @@
+import sqlite3
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import storage
+
+def names(conn, kind):
+    return set(row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = ? AND name NOT LIKE 'sqlite_%'", (kind,)))
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = storage.connect(':memory:')
+        self.addCleanup(self.conn.close)
+
+    def test_migrates_new_database(self):
+        self.assertEqual(storage.schema_version(self.conn), 0)
+        storage.migrate(self.conn)
+        self.assertEqual(storage.schema_version(self.conn), len(storage.MIGRATIONS))
+        self.assertEqual(names(self.conn, 'table'), set([
+            'player', 'player_pug_history', 'players_added', 'player_class_stats', 'player_stats',
+        ]))
+        self.assertEqual(names(self.conn, 'index'), set([
+            'players_added_player_id', 'player_pug_history_player_class',
+        ]))
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(players_added)")]
+        self.assertIn('added_at', columns)
+
+    def test_migrating_twice_does_nothing(self):
+        storage.migrate(self.conn)
+        self.conn.execute("INSERT INTO player (name) VALUES ('alice')")
+        schema = sorted(self.conn.execute("SELECT type, name, sql FROM sqlite_master"))
+        storage.migrate(self.conn)
+        self.assertEqual(storage.schema_version(self.conn), len(storage.MIGRATIONS))
+        self.assertEqual(sorted(self.conn.execute("SELECT type, name, sql FROM sqlite_master")), schema)
+        self.assertEqual(self.conn.execute("SELECT name FROM player").fetchall(), [('alice',)])
+
+    def test_resumes_where_it_stopped(self):
+        storage.migrate(self.conn, storage.MIGRATIONS[:2])
+        self.assertEqual(storage.schema_version(self.conn), 2)
+        storage.migrate(self.conn)
+        self.assertEqual(storage.schema_version(self.conn), len(storage.MIGRATIONS))
+
+    def test_failed_migration_rolls_back(self):
+        migrations = [["CREATE TABLE a (x INTEGER)"], ["CREATE TABLE b (x INTEGER)", "NOT SQL"]]
+        self.assertRaises(Exception, storage.migrate, self.conn, migrations)
+        self.assertEqual(storage.schema_version(self.conn), 1)
+        self.assertEqual(names(self.conn, 'table'), set(['a']))
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = storage.connect(':memory:')
+        self.addCleanup(self.conn.close)
+        self.conn.execute("CREATE TABLE t (x INTEGER)")
+
+    def rows(self):
+        return self.conn.execute("SELECT x FROM t ORDER BY x").fetchall()
+
+    def test_commits(self):
+        with storage.transaction(self.conn):
+            self.conn.execute("INSERT INTO t VALUES (1)")
+            self.conn.execute("INSERT INTO t VALUES (2)")
+        self.assertEqual(self.rows(), [(1,), (2,)])
+
+    def test_raising_writes_nothing(self):
+        def fail():
+            with storage.transaction(self.conn):
+                self.conn.execute("INSERT INTO t VALUES (1)")
+                raise ValueError('stop')
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.rows(), [])
+        # And the connection is usable afterwards
+        with storage.transaction(self.conn):
+            self.conn.execute("INSERT INTO t VALUES (3)")
+        self.assertEqual(self.rows(), [(3,)])
+
+class DatabaseThreadTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = storage.connect(':memory:')
+        self.conn.execute("CREATE TABLE t (x INTEGER)")
+        self.db = storage.DatabaseThread()
+        self.addCleanup(self.conn.close)
+        self.addCleanup(self.db._pool.stop)
+
+    def insert(self, x):
+        self.conn.execute("INSERT INTO t VALUES (?)", (x,))
+
+    def read(self):
+        return [x for x, in self.conn.execute("SELECT x FROM t ORDER BY rowid")]
+
+    @defer.inlineCallbacks
+    def test_reads_see_queued_writes_in_order(self):
+        # None of the writes are waited on before the read is queued
+        writes = [self.db.run(self.insert, x) for x in xrange(100)]
+        rows = yield self.db.run(self.read)
+        self.assertEqual(rows, range(100))
+        self.assertTrue(all(d.called for d in writes))
+
+    @defer.inlineCallbacks
+    def test_errors_reach_the_caller(self):
+        failed = self.db.run(self.conn.execute, "NOT SQL")
+        after = self.db.run(self.insert, 1)
+        yield self.assertFailure(failed, sqlite3.OperationalError)
+        yield after
+        rows = yield self.db.run(self.read)
+        self.assertEqual(rows, [1])